@@ -0,0 +1,196 @@
+"""End-to-end benchmarks of ``BinderUser.run`` against a local mock binder.
+
+Each scenario runs in a fresh process, against a ``binderbot.testing`` hub
+running in another process, so that the client's CPU time and peak RSS are
+measured on their own. Per-phase wall times (the totals of the trace
+spans), client CPU time and peak RSS are written to a JSON results file::
+
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py --notebooks 1 --notebooks 8 --latency 0.05
+
+Two results files, e.g. from two commits, can then be compared::
+
+    python benchmarks/run_benchmarks.py --compare before.json after.json
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import nbformat
+
+from binderbot.binderbot import BinderUser
+from binderbot.trace import Tracer
+
+def make_notebook(n_cells, output_bytes):
+    """A notebook whose cells each print about ``output_bytes`` characters."""
+    source = f"print('x' * {output_bytes})" if output_bytes else "x = 1"
+    cells = [nbformat.v4.new_code_cell(source) for _ in range(n_cells)]
+    return nbformat.v4.new_notebook(cells=cells)
+
+
+def start_hub(root_dir, latency, build_time):
+    proc = subprocess.Popen([sys.executable, '-m', 'binderbot.testing', str(root_dir),
+                             '--latency', str(latency),
+                             '--phase', f'building:{build_time}'],
+                            stdout=subprocess.PIPE, text=True)
+    url = proc.stdout.readline().strip()
+    return proc, url
+
+
+def run_scenario(scenario):
+    """Run one scenario in this process and return its measurements."""
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        nb = make_notebook(scenario['cells'], scenario['output_bytes'])
+        filenames = []
+        for n in range(scenario['notebooks']):
+            fname = tmp / f'notebook_{n}.ipynb'
+            with fname.open('w', encoding='utf-8') as f:
+                nbformat.write(nb, f)
+            filenames.append(str(fname.relative_to(tmp)))
+        (tmp / 'out').mkdir()
+
+        hub, url = start_hub(tmp / 'hub', scenario['latency'], scenario['build_time'])
+        os.chdir(tmp)
+        try:
+            tracer = Tracer()
+
+            async def run():
+                async with BinderUser(url, 'org/repo', 'master', tracer=tracer) as jovyan:
+                    errors = await jovyan.run(filenames, output_dir='out',
+                                              engine=scenario['engine'],
+                                              concurrency=scenario['concurrency'])
+                    await jovyan.teardown()
+                    return errors
+
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+            errors = asyncio.run(run())
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+        finally:
+            hub.terminate()
+            hub.wait()
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    return {
+        'scenario': scenario,
+        'wall_time': wall,
+        'client_cpu_time': cpu,
+        'peak_rss_bytes': maxrss,
+        'phases': tracer.totals(),
+        'errors': {fname: repr(e) for fname, e in errors.items()},
+    }
+
+
+def scenario_name(scenario):
+    return ' '.join(f'{k}={v}' for k, v in sorted(scenario.items()))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after):
+    with open(before) as f:
+        old = {scenario_name(r['scenario']): r for r in json.load(f)['results']}
+    with open(after) as f:
+        new = {scenario_name(r['scenario']): r for r in json.load(f)['results']}
+    for name in sorted(old.keys() & new.keys()):
+        click.echo(name)
+        rows = [('wall_time', old[name]['wall_time'], new[name]['wall_time']),
+                ('client_cpu_time', old[name]['client_cpu_time'], new[name]['client_cpu_time']),
+                ('peak_rss_bytes', old[name]['peak_rss_bytes'], new[name]['peak_rss_bytes'])]
+        for phase in sorted(old[name]['phases'].keys() & new[name]['phases'].keys()):
+            rows.append((phase, old[name]['phases'][phase]['total'],
+                         new[name]['phases'][phase]['total']))
+        for label, a, b in rows:
+            ratio = b / a if a else float('nan')
+            click.echo(f'    {label:<20} {a:>14.4g} {b:>14.4g} {ratio:>8.2f}x')
+
+
+@click.command()
+@click.option('-o', '--output', default='benchmark-results.json',
+              help='Where to write the results.')
+@click.option('--notebooks', multiple=True, type=int, help='Numbers of notebooks.')
+@click.option('--cells', multiple=True, type=int, help='Numbers of cells per notebook.')
+@click.option('--output-bytes', multiple=True, type=int,
+              help='Characters printed by each cell.')
+@click.option('--latency', multiple=True, type=float,
+              help='Seconds of latency added to every request.')
+@click.option('--engine', multiple=True, type=click.Choice(['nbconvert', 'client']))
+@click.option('--concurrency', multiple=True, type=int)
+@click.option('--build-time', default=0.0, help='Seconds the mock build takes.')
+@click.option('--compare', 'compare_files', nargs=2, type=click.Path(exists=True),
+              help='Compare two results files instead of running.')
+@click.option('--run-scenario', hidden=True)
+def main(output, notebooks, cells, output_bytes, latency, engine, concurrency,
+         build_time, compare_files, run_scenario):
+    """Benchmark binderbot against a local mock binder."""
+    if compare_files:
+        compare(*compare_files)
+        return
+    if run_scenario:
+        click.echo(json.dumps(run_scenario_and_report(json.loads(run_scenario))))
+        return
+
+    grid = {
+        'notebooks': notebooks or (1, 8),
+        'cells': cells or (10, 200),
+        'output_bytes': output_bytes or (0, 100000),
+        'latency': latency or (0.0, 0.05),
+        'engine': engine or ('client',),
+        'concurrency': concurrency or (1,),
+        'build_time': (build_time,),
+    }
+    results = []
+    for values in itertools.product(*grid.values()):
+        scenario = dict(zip(grid, values))
+        click.echo(f'⌛️ {scenario_name(scenario)}', err=True)
+        out = subprocess.check_output([sys.executable, __file__, '--run-scenario',
+                                       json.dumps(scenario)],
+                                      stderr=subprocess.DEVNULL, text=True)
+        result = json.loads(out.splitlines()[-1])
+        click.echo(f"   {result['wall_time']:.3f}s wall, "
+                   f"{result['client_cpu_time']:.3f}s cpu, "
+                   f"{result['peak_rss_bytes'] / 2**20:.1f} MiB", err=True)
+        results.append(result)
+
+    with open(output, 'w') as f:
+        json.dump({'revision': git_revision(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'results': results}, f, indent=1)
+    click.echo(f'✅ Results written to {output}', err=True)
+
+
+def run_scenario_and_report(scenario):
+    # BinderUser.run prints progress to stdout; keep it out of the report
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        return run_scenario(scenario)
+    finally:
+        sys.stdout = stdout
+
+
+if __name__ == '__main__':
+    main()
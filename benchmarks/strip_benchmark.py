@@ -0,0 +1,75 @@
+"""Micro-benchmark of stripping the outputs of notebooks before upload.
+
+Compares ``open_nb_and_strip_output``, which works on the raw JSON, with
+the nbformat and nbconvert path it replaced (``nbformat.read`` with schema
+validation, then ``ClearOutputPreprocessor``), on notebooks with many
+cells and large outputs::
+
+    python benchmarks/strip_benchmark.py
+    python benchmarks/strip_benchmark.py --cells 1000 --output-bytes 100000 --repeat 3
+"""
+
+import os
+import tempfile
+import time
+
+import click
+import nbformat
+
+from binderbot.binderbot import open_nb_and_strip_output
+
+
+def make_notebook(n_cells, output_bytes):
+    """A notebook whose cells each have about ``output_bytes`` of outputs."""
+    cells = []
+    for n in range(n_cells):
+        cell = nbformat.v4.new_code_cell(f"print('x' * {output_bytes})\nx = {n}",
+                                         execution_count=n + 1)
+        cell.outputs = [nbformat.v4.new_output('stream', text='x' * output_bytes),
+                        nbformat.v4.new_output('execute_result', execution_count=n + 1,
+                                               data={'text/plain': str(n)})]
+        cells.append(cell)
+    return nbformat.v4.new_notebook(cells=cells)
+
+
+def strip_with_nbconvert(fname):
+    from nbconvert.preprocessors import ClearOutputPreprocessor
+    with open(fname) as f:
+        nb = nbformat.read(f, as_version=4)
+    ClearOutputPreprocessor().preprocess(nb, {})
+    return nb
+
+
+def best_time(fn, fname, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(fname)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--cells', 'cell_counts', multiple=True, type=int,
+              help='Number of cells of a notebook (several allowed).')
+@click.option('--output-bytes', default=10000, help='Characters of output per cell.')
+@click.option('--repeat', default=5, help='Runs per notebook, the best one is kept.')
+def main(cell_counts, output_bytes, repeat):
+    """Time stripping notebooks of growing size with both methods."""
+    # import nbconvert up front, so that its import is not timed
+    import nbconvert.preprocessors  # noqa: F401
+
+    print(f"{'cells':>7}{'size (MB)':>11}{'nbconvert (s)':>15}{'raw json (s)':>14}{'speedup':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_cells in cell_counts or (10, 100, 1000):
+            fname = os.path.join(tmp, f'{n_cells}.ipynb')
+            with open(fname, 'w') as f:
+                nbformat.write(make_notebook(n_cells, output_bytes), f)
+            size = os.path.getsize(fname) / 1024 ** 2
+            before = best_time(strip_with_nbconvert, fname, repeat)
+            after = best_time(open_nb_and_strip_output, fname, repeat)
+            print(f"{n_cells:>7}{size:>11.1f}{before:>15.4f}{after:>14.4f}{before / after:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -9,22 +9,58 @@ from enum import Enum, auto
 import aiohttp
 import pathlib
 import socket
+import struct
 import uuid
 import random
 from yarl import URL
 import asyncio
-import async_timeout
 import structlog
 import time
 import json
 import textwrap
 import re
+import shutil
+import base64
+import concurrent.futures
+import functools
+import itertools
+import tempfile
+import zipfile
 
 import nbformat
-from nbconvert.preprocessors import ClearOutputPreprocessor
+
+from .cache import resolve_ref
+from .connection import make_connector, make_session
+from .events import EventStreamParser
+from .history import estimate_remaining, slow_launch_threshold
+from .kernelpool import KernelPool
+from .retry import RetryPolicy, is_retriable
+from .outputs import trim_outputs, trim_outputs_source
+from .trace import Tracer
+from . import zygote
 
 logger = structlog.get_logger()
 
+# bytes sent per request when uploading large files, like JupyterLab
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# bytes read from the response at a time when downloading to disk
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# seconds a cell that timed out has to stop once interrupted
+INTERRUPT_TIMEOUT = 30
+
+# cell metadata about outputs, cleared with them
+OUTPUT_METADATA_FIELDS = ('collapsed', 'scrolled')
+# metadata kept when stripping it, as execution depends on it
+KEPT_NOTEBOOK_METADATA = ('kernelspec', 'language_info')
+KEPT_CELL_METADATA = ('tags',)
+
+# retry policies by operation name, the default one covers the others
+DEFAULT_RETRY_POLICIES = {
+    'default': RetryPolicy(),
+    # builds are long, so wait a little longer before trying again
+    'start_binder': RetryPolicy(base_delay=5, max_delay=60, budget=600),
+}
+
 # https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
 def _ansi_escape(text):
     return re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])').sub('', text)
@@ -34,6 +70,179 @@ class OperationError(Exception):
     pass
 
 
+def deserialize_binary_message(data):
+    """Decode a kernel message sent in a binary websocket frame.
+
+    Jupyter sends messages with buffers as the number of parts and their
+    offsets, as 32-bit big-endian integers, followed by the message as JSON
+    and its buffers.
+    """
+    n_parts, = struct.unpack('!I', data[:4])
+    if n_parts < 1 or 4 * (n_parts + 1) > len(data):
+        raise ValueError(f'Bad number of parts {n_parts}')
+    offsets = list(struct.unpack('!' + 'I' * n_parts, data[4:4 * (n_parts + 1)]))
+    parts = [data[start:stop] for start, stop in zip(offsets, offsets[1:] + [None])]
+    msg = json.loads(parts[0].decode('utf8'))
+    msg['buffers'] = parts[1:]
+    return msg
+
+
+class KernelChannel:
+    """A long-lived websocket to a kernel's ``channels`` endpoint.
+
+    A single reader task routes incoming messages to a queue per parent
+    ``msg_id``, so many requests can share the connection and be in
+    flight at once.
+    """
+
+    def __init__(self, session, url, log, headers=None, tracer=None):
+        self.session = session
+        self.url = url
+        self.log = log
+        self.headers = headers
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.ws = None
+        self._reader = None
+        self._queues = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def closed(self):
+        return self.ws is not None and self.ws.closed
+
+    async def connect(self):
+        async with self._lock:
+            if self.ws is not None:
+                return
+            self.log.msg('WS: Connecting', action='kernel-connect', phase='start')
+            start_time = time.monotonic()
+            with self.tracer.span('ws-connect'):
+                self.ws = await self.session.ws_connect(self.url, headers=self.headers)
+            self._reader = asyncio.ensure_future(self._read())
+            self.log.msg('WS: Connected', action='kernel-connect', phase='complete',
+                         duration=time.monotonic() - start_time)
+
+    async def _read(self):
+        try:
+            async for frame in self.ws:
+                if frame.type == aiohttp.WSMsgType.TEXT:
+                    msg = frame.json()
+                elif frame.type == aiohttp.WSMsgType.BINARY:
+                    # messages with buffers, e.g. from widgets
+                    try:
+                        msg = deserialize_binary_message(frame.data)
+                    except (struct.error, ValueError) as e:
+                        self.log.msg(f'WS: Skipping undecodable binary message {e}',
+                                     action='kernel-connect', phase='binary-message')
+                        continue
+                elif frame.type == aiohttp.WSMsgType.ERROR:
+                    # hand the error to everyone waiting and give up
+                    for queue in self._queues.values():
+                        queue.put_nowait(frame)
+                    return
+                else:
+                    continue
+                msg_id = msg.get('parent_header', {}).get('msg_id')
+                queue = self._queues.get(msg_id)
+                if queue is not None:
+                    queue.put_nowait(msg)
+        finally:
+            # the connection is gone, wake up anyone still waiting
+            for queue in self._queues.values():
+                queue.put_nowait(None)
+
+    async def send(self, msg):
+        """Send a message and return the queue its replies will arrive on."""
+        queue = asyncio.Queue()
+        self._queues[msg['header']['msg_id']] = queue
+        await self.ws.send_json(msg)
+        return queue
+
+    def release(self, msg_id):
+        self._queues.pop(msg_id, None)
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+
+
+class RunOptions:
+    """How each notebook is run and saved.
+
+    nb_timeout - maximum execution time (in seconds) for each notebook
+    extra_env_vars - environment variables set for the notebooks
+    download - whether to save the executed notebooks in ``output_dir``
+    engine - ``'nbconvert'`` (execute in the binder with nbconvert),
+             ``'client'`` (send cell by cell over the kernel websocket) or
+             ``'zygote'`` (execute in a fork server in the binder that has
+             imported the ``preload`` modules once for all notebooks)
+    validate - check that notebooks are valid before upload and after download
+    strip_metadata - drop the metadata running the notebooks does not need
+    trim - options of ``trim_outputs`` applied to executed notebooks
+    batch_upload - upload the notebooks in one archive before they run
+    batch_download - download them in one archive once all have run,
+                     along with the files matching the glob ``artifacts``
+    """
+
+    def __init__(self, nb_timeout=600, extra_env_vars=None, download=True,
+                 output_dir=".", engine='nbconvert', preload=(), validate=False,
+                 strip_metadata=False, trim=None, batch_upload=False,
+                 batch_download=False, artifacts=()):
+        if engine not in ('nbconvert', 'client', 'zygote'):
+            raise ValueError(f"Unknown engine {engine!r}")
+        self.nb_timeout = nb_timeout
+        self.extra_env_vars = extra_env_vars or {}
+        self.download = download
+        self.output_dir = pathlib.Path(output_dir or ".")
+        self.engine = engine
+        self.preload = preload
+        self.validate = validate
+        self.strip_metadata = strip_metadata
+        self.trim = trim
+        self.batch_upload = batch_upload
+        self.batch_download = batch_download
+        self.artifacts = artifacts
+
+
+class _Results:
+    """What became of the notebooks run by ``BinderUser.run_queue``."""
+
+    def __init__(self, cache=None, cache_keys=None, batch_download=False):
+        self.errors = {}
+        self.cache = cache
+        self.cache_keys = cache_keys or {}
+        # executed notebooks waiting to be downloaded in one archive
+        self.executed = [] if batch_download else None
+        self.taken = []
+        self.done = set()
+
+    def take(self, queue):
+        """Take the next notebook from ``queue``, or None if it is empty."""
+        if queue.empty():
+            return None
+        fname = queue.get_nowait()
+        self.taken.append(fname)
+        return fname
+
+    def unfinished(self):
+        """Notebooks taken that have neither succeeded nor failed yet."""
+        return [fname for fname in self.taken
+                if fname not in self.done and fname not in self.errors]
+
+    def failed(self, fname, error):
+        self.errors[fname] = error
+        print(f'❌ error running {fname}: {error}')
+
+    def succeeded(self, fname, output=None):
+        """Record a notebook run, and cache it if it was saved at ``output``."""
+        if output is not None and self.cache is not None and fname in self.cache_keys:
+            self.cache.put(self.cache_keys[fname], output)
+        self.done.add(fname)
+        print(f"✅ {fname}", flush=True)
+
+
 class BinderUser:
     class States(Enum):
         CLEAR = 1
@@ -42,117 +251,554 @@ class BinderUser:
         KERNEL_STARTED = 4
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession(headers={'User-Agent': 'BinderBot-cli v0.1'})
+        self.session = make_session(self.connector)
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
+        if self._preconnect_task is not None:
+            self._preconnect_task.cancel()
+        for kernel_id in list(self._channels):
+            await self.close_channel(kernel_id)
         await self.session.close()
 
-    def __init__(self, binder_url, repo, ref):
+    def __init__(self, binder_url, repo, ref, tracer=None, connector=None,
+                 retry_policies=None, history=None):
         """
         A simulated BinderHub user.
         binderhub_url - base url of the binderhub
+        tracer - a Tracer recording timed spans, may be shared between users
+        connector - an aiohttp connector from ``make_connector`` to share
+                    its connection pool with other users
+        retry_policies - RetryPolicy to use for each operation, by name;
+                         the one under ``'default'`` covers the others
+        history - a BuildHistory in which to record launches, and from
+                  which to estimate how long they take
         """
         self.binder_url = URL(binder_url)
         self.repo = repo
         self.ref = ref
         self.state = BinderUser.States.CLEAR
         self.log = logger.bind()
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.connector = connector
+        self.retry_policies = dict(DEFAULT_RETRY_POLICIES, **(retry_policies or {}))
+        self.history = history
+        # whether the binder is saved in a session store, to be reused
+        self.saved = False
+        self._channels = {}
+        self._preconnect_task = None
+        # notebooks already uploaded in an archive
+        self._uploaded = set()
+        # directories made in the binder for uploads
+        self._directories = set()
+        # whether the fork server running notebooks was started
+        self._zygote = False
+
+    async def _retry(self, operation, fn, idempotent=True):
+        """Await ``fn()``, retrying it as the policy for ``operation`` says."""
+        policy = self.retry_policies.get(operation, self.retry_policies['default'])
+        return await policy.call(operation, fn, self.log, self.tracer,
+                                 idempotent=idempotent)
+
+    async def _request(self, operation, method, url, **kwargs):
+        """Make an authenticated request to the notebook server.
+
+        The body is read before returning, and errors are retried as the
+        policy for ``operation`` says, fewer of them for a POST, which
+        isn't idempotent. Raises ``ClientResponseError`` for an error status.
+        """
+        headers = dict(kwargs.pop('headers', {}), Authorization=f'token {self.token}')
+
+        async def request():
+            async with self.session.request(method, url, headers=headers, **kwargs) as resp:
+                await resp.read()
+                resp.raise_for_status()
+                return resp
+
+        return await self._retry(operation, request, idempotent=method != 'POST')
+
+    async def start_binder(self, timeout=3000, spawn_refresh_time=20, stream_timeout=120):
+        """Launch a binder and wait until its server is ready.
+
+        If the build's event stream is cut, or stays silent (not even a
+        heartbeat) for ``stream_timeout`` seconds, the same build is
+        reconnected to after ``spawn_refresh_time`` seconds (or the delay the
+        server asked for) instead of launching again.
+
+        With a ``history``, each launch is recorded, and past ones give an
+        ETA at each phase and a warning if this one is unusually slow.
+        """
+        with self.tracer.span('launch', repo=self.repo, ref=self.ref):
+            await self._retry('start_binder', lambda: self._start_binder(
+                timeout, spawn_refresh_time=spawn_refresh_time,
+                stream_timeout=stream_timeout))
 
-    async def start_binder(self, timeout=3000, spawn_refresh_time=20):
+    async def _start_binder(self, timeout, spawn_refresh_time=20, stream_timeout=120):
         start_time = time.monotonic()
         self.log.msg(f'Binder: Starting', action='binder-start', phase='start')
+        launch_url = self.binder_url / 'build/gh/' / self.repo / self.ref
+        parser = EventStreamParser()
+
+        # past launches of the same repo tell how long this one should take
+        started_at = time.time()
+        past = self.history.launches(self.binder_url, self.repo, self.ref) \
+            if self.history is not None else []
+        slow_after = slow_launch_threshold(past)
+        transitions = []
+        outcome = 'error'
+
+        # each build phase lasts until the next one is reported
+        wait_start = phase_start = time.monotonic()
+        current_phase = None
+
+        def handle(data):
+            """Handle a build event, returning True once the server is ready."""
+            nonlocal current_phase, phase_start, outcome
+            phase = data.get('phase')
+            if phase != current_phase:
+                now = time.monotonic()
+                if current_phase is not None:
+                    self.tracer.record(f'build-{current_phase}', phase_start, now)
+                current_phase, phase_start = phase, now
+                transitions.append((phase, now - start_time))
+                eta = estimate_remaining(past, phase, now - start_time)
+                if eta is not None and phase not in ('ready', 'failed'):
+                    self.log.msg(f'Binder: {phase}, ready in about {eta:.0f}s', action='binder-start',
+                                 phase='eta', build_phase=phase, eta=eta, launches=len(past))
+                    print(f"⌛️ Binder {phase}, ready in about {eta:.0f}s", flush=True)
+            if phase == 'failed':
+                outcome = 'failed'
+                self.log.msg('Binder: Build Failed {}'.format(data['message']), action='binder-start',
+                             phase='build-failed', duration=time.monotonic() - start_time)
+                raise OperationError()
+            if phase == 'ready':
+                outcome = 'ready'
+                self.tracer.record('build-wait', wait_start, time.monotonic())
+                self.notebook_url = URL(data['url'])
+                self.token = data['token']
+                self.log.msg(f'Binder: Got token and url ({self.notebook_url})', action='binder-ready',
+                             phase='build-token', duration=time.monotonic() - start_time)
+                return True
+            self.log.msg(f'Binder: Waiting on event stream (phase: {phase})', action='binder-start', phase='event-stream')
+            return False
 
         try:
-            launch_url = self.binder_url / 'build/gh/' / self.repo / self.ref
-            self.log.msg(f'Binder: Get {launch_url}', action='binder-start', phase='get-launch-url')
-            resp = await self.session.get(launch_url)
-        except Exception as e:
-            self.log.msg('Binder: Failed {}'.format(str(e)), action='binder-start', phase='attempt-failed')
-            raise e
-
-        async for line in resp.content:
-            line = line.decode('utf8')
-            if line.startswith('data:'):
-                data = json.loads(line.split(':', 1)[1])
-                phase = data.get('phase')
-                if phase == 'failed':
-                    self.log.msg('Binder: Build Failed {}'.format(data['message']), action='binder-start',
-                                 phase='build-failed', duration=time.monotonic() - start_time)
-                    raise OperationError()
-                if phase == 'ready':
-                    self.notebook_url = URL(data['url'])
-                    self.token = data['token']
-                    self.log.msg(f'Binder: Got token and url ({self.notebook_url})', action='binder-ready',
-                                 phase='build-token', duration=time.monotonic() - start_time)
-                    break
-                if time.monotonic() - start_time >= timeout:
+            reconnects = 0
+            while True:
+                headers = {'Accept': 'text/event-stream'}
+                if parser.last_event_id is not None:
+                    headers['Last-Event-ID'] = parser.last_event_id
+                try:
+                    self.log.msg(f'Binder: Get {launch_url}', action='binder-start', phase='get-launch-url')
+                    resp = await self.session.get(launch_url, headers=headers,
+                                                  timeout=aiohttp.ClientTimeout(sock_read=stream_timeout))
+                    resp.raise_for_status()
+                except Exception as e:
+                    # until the build has started, failures are left to the retry policy
+                    if not reconnects or not is_retriable(e):
+                        self.log.msg('Binder: Failed {}'.format(str(e)), action='binder-start', phase='attempt-failed')
+                        raise
+                    lost = e
+                else:
+                    try:
+                        async for line in resp.content:
+                            event = parser.feed(line.decode('utf8'))
+                            if event is not None and handle(json.loads(event.data)):
+                                self.preconnect()
+                                self.state = BinderUser.States.BINDER_STARTED
+                                return
+                            elapsed = time.monotonic() - start_time
+                            if slow_after is not None and elapsed > slow_after:
+                                self.log.msg('Binder: Launch slower than usual',
+                                             action='binder-start', phase='slow', duration=elapsed,
+                                             usual=slow_after)
+                                print(f"⚠️ Binder launch taking {elapsed:.0f}s, "
+                                      f"90% of previous ones took under {slow_after:.0f}s", flush=True)
+                                slow_after = None
+                            if elapsed >= timeout:
+                                outcome = 'timeout'
+                                self.log.msg('Binder: Build timeout', action='binder-start', phase='failed', duration=time.monotonic() - start_time)
+                                raise OperationError()
+                        lost = 'end of stream'
+                    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                            asyncio.TimeoutError) as e:
+                        lost = e
+                    finally:
+                        # the stream isn't read to the end, so its connection can't be reused
+                        resp.close()
+
+                parser.reset()
+                # the server may ask for its own reconnection delay
+                delay = parser.retry if parser.retry is not None else spawn_refresh_time
+                if time.monotonic() - start_time + delay >= timeout:
+                    outcome = 'timeout'
                     self.log.msg('Binder: Build timeout', action='binder-start', phase='failed', duration=time.monotonic() - start_time)
                     raise OperationError()
-                self.log.msg(f'Binder: Waiting on event stream (phase: {phase})', action='binder-start', phase='event-stream')
+                reconnects += 1
+                self.log.msg(f'Binder: Event stream lost ({lost!r}), reconnecting in {delay}s',
+                             action='binder-start', phase='reconnect', reconnects=reconnects,
+                             heartbeats=parser.heartbeats)
+                with self.tracer.span('reconnect-wait', reconnect=reconnects):
+                    await asyncio.sleep(delay)
+        finally:
+            if self.history is not None and transitions:
+                self.history.record(self.binder_url, self.repo, self.ref, started_at,
+                                    time.monotonic() - start_time, transitions, outcome)
+
+    def preconnect(self):
+        """Open a connection to the notebook server in the background.
+
+        Called as soon as ``notebook_url`` is known, so that the DNS lookup
+        and connection setup overlap with whatever comes next, and the
+        connection is then waiting in the pool.
+        """
+        async def preconnect():
+            headers = {'Authorization': f'token {self.token}'}
+            try:
+                async with self.session.get(self.notebook_url / 'api/status',
+                                            headers=headers, allow_redirects=False) as resp:
+                    await resp.read()
+            except aiohttp.ClientError as e:
+                self.log.msg(f'Binder: Preconnect failed {e}', action='binder-ready',
+                             phase='preconnect-failed')
+
+        self._preconnect_task = asyncio.ensure_future(preconnect())
+
+    async def resume_binder(self, notebook_url, token):
+        """Reuse a binder started earlier, if it is still running.
+
+        Returns True if the server answered an authenticated request,
+        False if it is gone.
+        """
+        assert self.state == BinderUser.States.CLEAR
+
+        self.log.msg(f'Binder: Checking {notebook_url}', action='binder-resume', phase='start')
+        start_time = time.monotonic()
+        with self.tracer.span('resume'):
+            try:
+                headers = {'Authorization': f'token {token}'}
+                # a culled server redirects to the hub, so don't follow redirects
+                async with self.session.get(URL(notebook_url) / 'api/status', headers=headers,
+                                            allow_redirects=False) as resp:
+                    status = resp.status
+            except Exception as e:
+                self.log.msg('Binder: Saved server unreachable {}'.format(str(e)),
+                             action='binder-resume', phase='gone')
+                return False
 
+        if status != 200:
+            self.log.msg('Binder: Saved server gone', action='binder-resume', phase='gone',
+                         status=status)
+            return False
 
-        # todo: double check phase is really always "ready" at this point
+        self.notebook_url = URL(notebook_url)
+        self.token = token
+        self.preconnect()
+        self.log.msg(f'Binder: Reusing {self.notebook_url}', action='binder-ready',
+                     phase='resumed', duration=time.monotonic() - start_time)
         self.state = BinderUser.States.BINDER_STARTED
+        return True
+
+    async def start_or_resume_binder(self, session_store, slot=0, timeout=3000, sha=None):
+        """Reuse the binder saved in ``session_store``, or start and save a new one.
+
+        A saved binder is only reused if it was launched from the commit
+        ``sha`` that the ref resolves to now, and is shut down otherwise,
+        so that moving a branch launches a new one. Without a ``sha`` a new
+        binder is started but not saved. ``self.saved`` tells whether the
+        binder is kept in the store, to be left running.
+        """
+        saved = session_store.get(self.binder_url, self.repo, self.ref, slot)
+        if sha is None:
+            print(f"⚠️ Could not resolve {self.repo}@{self.ref} to a commit, "
+                  f"starting a new binder.")
+            await self.start_binder(timeout=timeout)
+            return
+        if saved is not None and saved.get('sha') != sha:
+            self.log.msg(f'Binder: Saved server is for {saved.get("sha")}, not {sha}',
+                         action='binder-resume', phase='stale')
+            await self._shutdown_saved(saved)
+        elif saved is not None:
+            if await self.resume_binder(saved['notebook_url'], saved['token']):
+                self.saved = True
+                return
+        await self.start_binder(timeout=timeout)
+        session_store.put(self.binder_url, self.repo, self.ref,
+                          self.notebook_url, self.token, slot, sha=sha)
+        self.saved = True
+
+    async def _shutdown_saved(self, saved):
+        """Shut down a saved binder being replaced, so that it isn't left running."""
+        try:
+            headers = {'Authorization': f"token {saved['token']}"}
+            async with self.session.post(URL(saved['notebook_url']) / 'api/shutdown',
+                                         headers=headers, allow_redirects=False) as resp:
+                status = resp.status
+        except Exception as e:
+            self.log.msg('Binder: Saved server shutdown failed {}'.format(str(e)),
+                         action='binder-stop', phase='failed')
+            return
+        self.log.msg('Binder: Saved server shut down', action='binder-stop',
+                     phase='complete', status=status)
 
     async def shutdown_binder(self):
-        # TODO: figure out how to shut down the binder using the API
-        # can we use the jupyterhub API:
-        # https://jupyterhub.readthedocs.io/en/stable/reference/rest.html#enabling-users-to-spawn-multiple-named-servers-via-the-api
-        pass
+        """Ask the notebook server to shut itself down.
+
+        The hub then notices the server is gone and cleans up the pod.
+        """
+        assert self.state != BinderUser.States.CLEAR
+
+        self.log.msg('Binder: Shutting down', action='binder-stop', phase='start')
+        start_time = time.monotonic()
+        with self.tracer.span('shutdown'):
+            try:
+                headers = {'Authorization': f'token {self.token}'}
+                resp = await self.session.post(self.notebook_url / 'api/shutdown', headers=headers)
+            except Exception as e:
+                self.log.msg('Binder: Shutdown failed {}'.format(str(e)), action='binder-stop', phase='failed')
+                raise OperationError()
+
+        if resp.status >= 400:
+            self.log.msg('Binder: Shutdown failed {}'.format(str(resp)), action='binder-stop', phase='failed')
+            raise OperationError()
+
+        self.log.msg('Binder: Shut down', action='binder-stop', phase='complete',
+                     duration=time.monotonic() - start_time)
+        self.state = BinderUser.States.CLEAR
+
+    async def teardown(self, shutdown=True):
+        """Stop the default kernel and shut down the binder, if started.
+
+        With ``shutdown=False`` the binder is left running for reuse.
+        Failures are logged but not raised, so this is safe to call
+        while handling another error. A fork server is stopped with the
+        binder, or left running for reuse with it.
+        """
+        if shutdown and self._zygote and self.state == BinderUser.States.KERNEL_STARTED:
+            try:
+                await self.stop_zygote()
+            except OperationError:
+                pass
+        if self.state == BinderUser.States.KERNEL_STARTED:
+            try:
+                await self.stop_kernel()
+            except OperationError:
+                pass
+        if shutdown and self.state == BinderUser.States.BINDER_STARTED:
+            try:
+                await self.shutdown_binder()
+            except OperationError:
+                pass
 
     async def start_kernel(self):
-        assert self.state == BinderUser.States.BINDER_STARTED
+        """Start a new kernel and return its id.
+
+        The first kernel started becomes the default kernel used by
+        ``run_code`` when no ``kernel_id`` is given.
+        """
+        assert self.state in (BinderUser.States.BINDER_STARTED,
+                              BinderUser.States.KERNEL_STARTED)
 
         self.log.msg('Kernel: Starting', action='kernel-start', phase='start')
         start_time = time.monotonic()
 
-        try:
-            headers = {'Authorization': f'token {self.token}'}
-            resp = await self.session.post(self.notebook_url / 'api/kernels', headers=headers)
-        except Exception as e:
-            self.log.msg('Kernel: Start failed {}'.format(str(e)), action='kernel-start', phase='failed', duration=time.monotonic() - start_time)
-            raise OperationError()
+        with self.tracer.span('kernel-start'):
+            try:
+                resp = await self._request('start_kernel', 'POST',
+                                           self.notebook_url / 'api/kernels')
+            except Exception as e:
+                self.log.msg('Kernel: Start failed {}'.format(str(e)), action='kernel-start', phase='failed', duration=time.monotonic() - start_time)
+                raise OperationError()
 
         if resp.status != 201:
             self.log.msg('Kernel: Start failed', action='kernel-start', phase='failed')
             raise OperationError()
-        self.kernel_id = (await resp.json())['id']
-        self.log.msg('Kernel: Started', action='kernel-start', phase='complete')
-        self.state = BinderUser.States.KERNEL_STARTED
+        kernel_id = (await resp.json())['id']
+        self.log.msg('Kernel: Started', action='kernel-start', phase='complete',
+                     kernel_id=kernel_id, duration=time.monotonic() - start_time)
+        if self.state == BinderUser.States.BINDER_STARTED:
+            self.kernel_id = kernel_id
+            self.state = BinderUser.States.KERNEL_STARTED
+        return kernel_id
 
-    async def stop_kernel(self):
+    async def stop_kernel(self, kernel_id=None):
         assert self.state == BinderUser.States.KERNEL_STARTED
+        kernel_id = kernel_id or self.kernel_id
 
-        self.log.msg('Kernel: Stopping', action='kernel-stop', phase='start')
+        self.log.msg('Kernel: Stopping', action='kernel-stop', phase='start', kernel_id=kernel_id)
         start_time = time.monotonic()
-        try:
-            headers = {'Authorization': f'token {self.token}'}
-            resp = await self.session.delete(self.notebook_url / 'api/kernels' / self.kernel_id, headers=headers)
-        except Exception as e:
-            self.log.msg('Kernel:Failed Stopped {}'.format(str(e)), action='kernel-stop', phase='failed')
-            raise OperationError()
+        with self.tracer.span('kernel-stop', kernel_id=kernel_id):
+            await self.close_channel(kernel_id)
+            try:
+                resp = await self._request('stop_kernel', 'DELETE',
+                                           self.notebook_url / 'api/kernels' / kernel_id)
+            except Exception as e:
+                self.log.msg('Kernel:Failed Stopped {}'.format(str(e)), action='kernel-stop', phase='failed')
+                raise OperationError()
 
         if resp.status != 204:
             self.log.msg('Kernel:Failed Stopped {}'.format(str(resp)), action='kernel-stop', phase='failed')
             raise OperationError()
 
-        self.log.msg('Kernel: Stopped', action='kernel-stop', phase='complete')
-        self.state = BinderUser.States.BINDER_STARTED
+        self.log.msg('Kernel: Stopped', action='kernel-stop', phase='complete', kernel_id=kernel_id)
+        if kernel_id == self.kernel_id:
+            self.state = BinderUser.States.BINDER_STARTED
+
+    async def interrupt_kernel(self, kernel_id=None):
+        """Interrupt the code running on a kernel."""
+        kernel_id = kernel_id or self.kernel_id
+        self.log.msg('Kernel: Interrupting', action='kernel-interrupt', phase='start',
+                     kernel_id=kernel_id)
+        await self._request('interrupt_kernel', 'POST',
+                            self.notebook_url / 'api/kernels' / kernel_id / 'interrupt')
 
     # https://github.com/jupyter/jupyter/wiki/Jupyter-Notebook-Server-API#notebook-and-file-contents-api
     async def get_contents(self, path):
-        headers = {'Authorization': f'token {self.token}'}
-        resp = await self.session.get(self.notebook_url / 'api/contents' / path, headers=headers)
-        resp_json = await resp.json()
+        start_time = time.monotonic()
+        with self.tracer.span('download', path=path):
+            resp = await self._request('get_contents', 'GET',
+                                       self.notebook_url / 'api/contents' / path)
+            resp_json = await resp.json()
+        self.log.msg(f'Contents: Downloaded {path}', action='contents-get', phase='complete',
+                     duration=time.monotonic() - start_time)
         return resp_json['content']
 
-    async def put_contents(self, path, nb_data):
+    async def download_file(self, path, local_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Stream a file from the server straight to ``local_path``.
+
+        The raw file is fetched from the ``/files`` endpoint, so unlike
+        ``get_contents`` it is never parsed or held in memory as a whole.
+        ``local_path`` is only replaced once the download is complete.
+        """
+        start_time = time.monotonic()
+        local_path = pathlib.Path(local_path)
+        tmp = local_path.with_name(local_path.name + '.part')
+        headers = {'Authorization': f'token {self.token}'}
+
+        async def download():
+            # a retry starts the file over
+            async with self.session.get(self.notebook_url / 'files' / path,
+                                        headers=headers) as resp:
+                resp.raise_for_status()
+                with tmp.open('wb') as f:
+                    async for chunk in resp.content.iter_chunked(chunk_size):
+                        f.write(chunk)
+
+        with self.tracer.span('download', path=path):
+            try:
+                await self._retry('get_contents', download)
+                os.replace(tmp, local_path)
+            finally:
+                if tmp.exists():
+                    tmp.unlink()
+        self.log.msg(f'Contents: Downloaded {path}', action='contents-get', phase='complete',
+                     size=local_path.stat().st_size, duration=time.monotonic() - start_time)
+
+    async def put_contents(self, path, nb, payload=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Upload a notebook.
+
+        ``payload`` is the request body for ``nb`` if already serialized
+        with ``notebook_payload``. A notebook bigger than ``chunk_size`` is
+        sent as a file in several requests, serialized as it is sent.
+        """
+        start_time = time.monotonic()
+        await self._make_directories(path)
+        if payload is None:
+            chunks = iter_notebook_bytes(nb, chunk_size)
+            # a second chunk means it doesn't fit in one request
+            next(chunks, None)
+            if next(chunks, None) is None:
+                payload = notebook_payload(nb)
+        if payload is not None and len(payload) <= chunk_size:
+            with self.tracer.span('upload', path=path):
+                await self._request('put_contents', 'PUT',
+                                    self.notebook_url / 'api/contents' / path,
+                                    headers={'Content-Type': 'application/json'},
+                                    data=payload)
+        else:
+            async def upload():
+                # chunks are appended, so a retry starts the file over
+                chunks = iter_notebook_bytes(nb, chunk_size)
+
+                async def read_chunk():
+                    return next(chunks, b'')
+
+                await self._put_chunks(path, read_chunk)
+
+            with self.tracer.span('upload', path=path):
+                await self._retry('put_contents', upload)
+        self.log.msg(f'Contents: Uploaded {path}', action='contents-put', phase='complete',
+                     duration=time.monotonic() - start_time)
+
+    async def upload_file(self, local_path, path=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Upload any file, reading it ``chunk_size`` bytes at a time.
+
+        Files bigger than one chunk use the contents API's chunked upload,
+        so memory use stays bounded and no request body gets too big for
+        proxies in front of the server. ``path`` on the server defaults to
+        ``local_path``, or its basename if absolute. Missing parent
+        directories are made first.
+        """
+        if path is None:
+            path = os.path.basename(local_path) if os.path.isabs(local_path) else local_path
+        start_time = time.monotonic()
+        size = os.path.getsize(local_path)
+        loop = asyncio.get_event_loop()
+        await self._make_directories(path)
+
+        async def upload():
+            # chunks are appended, so a retry starts the file over
+            with open(local_path, 'rb') as f:
+                async def read_chunk():
+                    return await loop.run_in_executor(None, f.read, chunk_size)
+                await self._put_chunks(path, read_chunk, size)
+
+        with self.tracer.span('upload', path=path, size=size):
+            await self._retry('put_contents', upload)
+        self.log.msg(f'Contents: Uploaded {path}', action='contents-put', phase='complete',
+                     size=size, duration=time.monotonic() - start_time)
+
+    async def _make_directories(self, path):
+        """Make the parent directories of ``path``, which uploads don't create."""
+        parents = pathlib.PurePosixPath(path).parents
+        for directory in reversed([str(p) for p in parents if str(p) != '.']):
+            if directory in self._directories:
+                continue
+            await self._request('put_contents', 'PUT',
+                                self.notebook_url / 'api/contents' / directory,
+                                json={'type': 'directory'})
+            self._directories.add(directory)
+
+    async def _put_chunks(self, path, read_chunk, size=None):
+        """Upload the bytes returned by ``read_chunk`` until it returns nothing.
+
+        Chunks are numbered from 1 and the last one is sent as -1, after
+        which the server finalizes the file. Data fitting in a single chunk
+        is sent as a regular upload instead, as a lone chunk -1 would be
+        appended to any existing file. Chunks aren't retried one by one,
+        as a retried chunk could be appended twice.
+        """
         headers = {'Authorization': f'token {self.token}'}
-        data = {'content': nb_data, "type": "notebook"}
-        resp = await self.session.put(self.notebook_url / 'api/contents' / path,
-                                      json=data, headers=headers)
-        resp.raise_for_status()
+        model = {'type': 'file', 'format': 'base64',
+                 'name': pathlib.PurePosixPath(path).name, 'path': path}
+        chunk = await read_chunk()
+        n, sent = 1, 0
+        while True:
+            next_chunk = await read_chunk()
+            model['content'] = base64.b64encode(chunk).decode('ascii')
+            if n > 1 or next_chunk:
+                model['chunk'] = n if next_chunk else -1
+            async with self.session.put(self.notebook_url / 'api/contents' / path,
+                                        headers=headers, json=model) as resp:
+                resp.raise_for_status()
+            sent += len(chunk)
+            if 'chunk' in model:
+                self.log.msg(f'Contents: Uploaded chunk {n} of {path}', action='contents-put',
+                             phase='chunk', sent=sent, size=size)
+            if not next_chunk:
+                break
+            chunk = next_chunk
+            n += 1
 
     def request_execute_code(self, msg_id, code):
         return {
@@ -176,86 +822,124 @@ class BinderUser:
             "channel": "shell"
         }
 
-    async def run_code(self, code):
-        """Run code and return stdout, stderr."""
+    async def get_channel(self, kernel_id=None):
+        """Return the connected channel for ``kernel_id``, opening it if needed."""
+        kernel_id = kernel_id or self.kernel_id
+        channel = self._channels.get(kernel_id)
+        if channel is None or channel.closed:
+            channel_url = self.notebook_url / 'api/kernels' / kernel_id / 'channels'
+            headers = {'Authorization': f'token {self.token}'}
+            channel = KernelChannel(self.session, channel_url, self.log,
+                                    headers=headers, tracer=self.tracer)
+            self._channels[kernel_id] = channel
+        await channel.connect()
+        return channel
+
+    async def close_channel(self, kernel_id=None):
+        channel = self._channels.pop(kernel_id or self.kernel_id, None)
+        if channel is not None:
+            await channel.close()
+
+    async def run_code(self, code, kernel_id=None):
+        """Run code and return stdout, stderr.
+
+        The code runs on ``kernel_id``, or on the default kernel if not given.
+        Calls share one websocket per kernel and may be in flight at once.
+        """
         assert self.state == BinderUser.States.KERNEL_STARTED
+        kernel_id = kernel_id or self.kernel_id
+
+        try:
+            channel = await self._retry('ws_connect', lambda: self.get_channel(kernel_id))
+        except Exception as e:
+            self.log.msg('WS: Failed {}'.format(str(e)), action='kernel-connect', phase='failure')
+            raise OperationError()
 
-        channel_url = self.notebook_url / 'api/kernels' / self.kernel_id / 'channels'
-        self.log.msg('WS: Connecting', action='kernel-connect', phase='start')
-        is_connected = False
+        self.log.msg('Code Execute: Started', action='code-execute', phase='start')
+        exec_start_time = time.monotonic()
+        msg_id = str(uuid.uuid4())
+        with self.tracer.span('run-code', kernel_id=kernel_id):
+            return await self._run_code(channel, msg_id, code, exec_start_time)
+
+    async def _run_code(self, channel, msg_id, code, exec_start_time):
         try:
-            async with self.session.ws_connect(channel_url) as ws:
-                is_connected = True
-                self.log.msg('WS: Connected', action='kernel-connect', phase='complete')
-                start_time = time.monotonic()
-                self.log.msg('Code Execute: Started', action='code-execute', phase='start')
-                exec_start_time = time.monotonic()
-                msg_id = str(uuid.uuid4())
-                await ws.send_json(self.request_execute_code(msg_id, code))
-
-                stdout = ''
-                stderr = ''
-
-                async for msg_text in ws:
-                    if msg_text.type != aiohttp.WSMsgType.TEXT:
-                        self.log.msg(
-                            'WS: Unexpected message type',
-                            action='code-execute', phase='failure',
-                            message_type=msg_text.type, message=str(msg_text),
-                            duration=time.monotonic() - exec_start_time
-                        )
+            replies = await channel.send(self.request_execute_code(msg_id, code))
+
+            stdout = ''
+            stderr = ''
+
+            while True:
+                msg = await replies.get()
+                if not isinstance(msg, dict):
+                    self.log.msg(
+                        'WS: Unexpected message type',
+                        action='code-execute', phase='failure',
+                        message_type=getattr(msg, 'type', None), message=str(msg),
+                        duration=time.monotonic() - exec_start_time
+                    )
+                    raise OperationError()
+
+                # These are responses to our request
+                self.log.msg(f'Code Execute: Receive response', action='code-execute', phase='receive-stream',
+                             channel=msg['channel'], msg_type=msg['msg_type'])
+                if msg['channel'] == 'shell':
+                    if msg['msg_type'] == 'execute_reply':
+                        status = msg['content']['status']
+                        if status == 'ok':
+                            self.log.msg('Code Execute: Status OK', action='code-execute', phase='success')
+                            break
+                        else:
+                            self.log.msg('Code Execute: Status {status}', action='code-execute', phase='error')
+                            raise OperationError()
+                if msg['channel'] == 'iopub':
+                    response = None
+                    msg_type = msg.get('msg_type')
+                    # don't really know what this is doing
+                    #if msg_type == 'execute_result':
+                    #    response = msg['content']['data']['text/plain']
+                    if msg_type == 'error':
+                        traceback = _ansi_escape('\n'.join(msg['content']['traceback']))
+                        self.log.msg('Code Execute: Error', action='code-execute',
+                                     phase='error',
+                                     traceback=traceback)
                         raise OperationError()
+                    elif msg_type == 'stream':
+                        response = msg['content']['text']
+                        name =  msg['content']['name']
+                        if name == 'stdout':
+                            stdout += response
+                        elif name == 'stderr':
+                            stderr += response
+                        #print(response)
+            self.log.msg(
+                'Code Execute: complete',
+                action='code-execute', phase='complete',
+                duration=time.monotonic() - exec_start_time)
 
-                    msg = msg_text.json()
-
-                    if 'parent_header' in msg and msg['parent_header'].get('msg_id') == msg_id:
-                        # These are responses to our request
-                        self.log.msg(f'Code Execute: Receive response', action='code-execute', phase='receive-stream',
-                                     channel=msg['channel'], msg_type=msg['msg_type'])
-                        if msg['channel'] == 'shell':
-                            if msg['msg_type'] == 'execute_reply':
-                                status = msg['content']['status']
-                                if status == 'ok':
-                                    self.log.msg('Code Execute: Status OK', action='code-execute', phase='success')
-                                    break
-                                else:
-                                    self.log.msg('Code Execute: Status {status}', action='code-execute', phase='error')
-                                    raise OperationError()
-                        if msg['channel'] == 'iopub':
-                            response = None
-                            msg_type = msg.get('msg_type')
-                            # don't really know what this is doing
-                            #if msg_type == 'execute_result':
-                            #    response = msg['content']['data']['text/plain']
-                            if msg_type == 'error':
-                                traceback = _ansi_escape('\n'.join(msg['content']['traceback']))
-                                self.log.msg('Code Execute: Error', action='code-execute',
-                                             phase='error',
-                                             traceback=traceback)
-                                raise OperationError()
-                            elif msg_type == 'stream':
-                                response = msg['content']['text']
-                                name =  msg['content']['name']
-                                if name == 'stdout':
-                                    stdout += response
-                                elif name == 'stderr':
-                                    stderr += response
-                                #print(response)
-                self.log.msg(
-                    'Code Execute: complete',
-                    action='code-execute', phase='complete',
-                    duration=time.monotonic() - exec_start_time)
-
-                return stdout, stderr
+            return stdout, stderr
 
         except Exception as e:
             if type(e) is OperationError:
                 raise
-            if is_connected:
-                self.log.msg('Code Execute: Failed {}'.format(str(e)), action='code-execute', phase='failure')
-            else:
-                self.log.msg('WS: Failed {}'.format(str(e)), action='kernel-connect', phase='failure')
+            self.log.msg('Code Execute: Failed {}'.format(str(e)), action='code-execute', phase='failure')
             raise OperationError()
+        finally:
+            channel.release(msg_id)
+
+    async def kernel_memory(self, kernel_id=None):
+        """Return the resident memory of a kernel's process, in bytes."""
+        code = """
+        import os
+        try:
+            with open('/proc/self/statm') as f:
+                print(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE'))
+        except OSError:
+            # peak rather than current memory, in kilobytes on Linux
+            import resource
+            print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        """
+        stdout, stderr = await self.run_code(code, kernel_id=kernel_id)
+        return int(stdout)
 
     async def list_notebooks(self):
         code = """
@@ -267,10 +951,15 @@ class BinderUser:
         return json.loads(stdout)
 
     async def execute_notebook(self, notebook_filename, timeout=600,
-                               env_vars={}):
+                               env_vars={}, kernel_id=None, trim=None):
+        """Execute an uploaded notebook in the binder with nbconvert.
+
+        With ``trim``, a dict of ``trim_outputs`` options, the outputs are
+        trimmed in the binder before the notebook is saved there.
+        """
         env_var_str = str(env_vars)
         # https://nbconvert.readthedocs.io/en/latest/execute_api.html
-        code = f"""
+        code = textwrap.dedent(f"""
         import os
         import nbformat
         os.environ.update({env_var_str})
@@ -281,57 +970,965 @@ class BinderUser:
             nb = nbformat.read(f, as_version=4)
         ep.preprocess(nb, dict())
         print("OK")
+        """)
+        if trim:
+            code += trim_outputs_source() + textwrap.dedent(f"""
+            print("Trimmed", trim_outputs(nb, **{trim!r}), "characters of output")
+            """)
+        code += textwrap.dedent(f"""
         print("Saving {notebook_filename}")
         with open("{notebook_filename}", 'w', encoding='utf-8') as f:
             nbformat.write(nb, f)
         print("OK")
+        """)
+        with self.tracer.span('execute', path=notebook_filename):
+            return await self.run_code(code, kernel_id=kernel_id)
+
+    async def start_zygote(self, preload=()):
+        """Start the fork server running notebooks, unless it already runs.
+
+        The server first imports the ``preload`` modules, so that every
+        notebook it runs starts with them. Returns the outcome of each
+        import, keyed by module name.
+        """
+        code = f"""
+        import json, socket, subprocess, sys
+        try:
+            with socket.socket(socket.AF_UNIX) as s:
+                s.connect({zygote.SOCKET_PATH!r})
+                s.sendall(b'{{"ping": true}}\\n')
+                status = json.loads(s.makefile().readline())
+        except (OSError, ValueError):
+            with open({zygote.SCRIPT_PATH!r}, 'w') as f:
+                f.write({zygote.zygote_source()!r})
+            proc = subprocess.Popen([sys.executable, {zygote.SCRIPT_PATH!r},
+                                     {zygote.SOCKET_PATH!r}, {json.dumps(list(preload))!r}],
+                                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    start_new_session=True)
+            line = proc.stdout.readline()
+            if not line:
+                raise RuntimeError('Fork server failed to start')
+            status = json.loads(line)
+        print(json.dumps(status['preloaded']))
+        """
+        start_time = time.monotonic()
+        with self.tracer.span('zygote-start', preload=len(preload)):
+            stdout, stderr = await self.run_code(code)
+        self._zygote = True
+        preloaded = json.loads(stdout)
+        self.log.msg('Zygote: Started', action='zygote-start', phase='complete',
+                     preloaded=preloaded, duration=time.monotonic() - start_time)
+        for name, outcome in preloaded.items():
+            if outcome != 'ok':
+                print(f"⚠️ Could not preload {name}: {outcome}", flush=True)
+        return preloaded
+
+    async def stop_zygote(self):
+        """Stop the fork server, letting notebooks it is running finish."""
+        await self.run_code(f"""
+        import socket
+        with socket.socket(socket.AF_UNIX) as s:
+            s.connect({zygote.SOCKET_PATH!r})
+            s.sendall(b'{{"stop": true}}\\n')
+            s.makefile().readline()
+        """)
+        self._zygote = False
+
+    async def execute_notebook_zygote(self, notebook_filename, timeout=600,
+                                      env_vars={}, kernel_id=None, trim=None):
+        """Execute an uploaded notebook in a child forked by the fork server.
+
+        Like ``execute_notebook``, the executed notebook is saved in the
+        binder, but it starts with the preloaded modules already imported.
+        """
+        request = json.dumps({'path': notebook_filename, 'timeout': timeout,
+                              'env': env_vars, 'trim': trim})
+        code = f"""
+        import json, socket
+        with socket.socket(socket.AF_UNIX) as s:
+            s.connect({zygote.SOCKET_PATH!r})
+            s.sendall({request!r}.encode('utf8') + b'\\n')
+            reply = json.loads(s.makefile().readline())
+        print("Processed {notebook_filename}", reply['status'])
+        if reply['status'] != 'ok':
+            raise RuntimeError(f"{{reply['ename']}}: {{reply['evalue']}}")
+        """
+        with self.tracer.span('execute', path=notebook_filename):
+            return await self.run_code(code, kernel_id=kernel_id)
+
+    async def execute_cell(self, source, kernel_id=None, timeout=None):
+        """Execute one cell on a kernel and return its outputs.
+
+        Outputs are assembled locally from iopub messages as they arrive.
+        Returns ``(execution_count, outputs)``; raises OperationError if the
+        cell raises.
+        """
+        assert self.state == BinderUser.States.KERNEL_STARTED
+
+        try:
+            channel = await self._retry('ws_connect', lambda: self.get_channel(kernel_id))
+        except Exception as e:
+            self.log.msg('WS: Failed {}'.format(str(e)), action='kernel-connect', phase='failure')
+            raise OperationError()
+
+        msg_id = str(uuid.uuid4())
+        request = self.request_execute_code(msg_id, '')
+        # cell sources are sent verbatim, not dedented
+        request['content']['code'] = source
+        execution_count = None
+        outputs = []
+        error = None
+        # the reply on shell and the idle status on iopub may arrive in any order
+        got_reply = got_idle = False
+
+        async def receive(replies):
+            nonlocal execution_count, outputs, error, got_reply, got_idle
+            while not (got_reply and got_idle):
+                msg = await replies.get()
+                if not isinstance(msg, dict):
+                    self.log.msg('WS: Unexpected message type', action='cell-execute',
+                                 phase='failure', message=str(msg))
+                    raise OperationError()
+                msg_type = msg['msg_type']
+                content = msg['content']
+                if msg['channel'] == 'shell':
+                    if msg_type == 'execute_reply':
+                        got_reply = True
+                        execution_count = content.get('execution_count')
+                    continue
+                if msg_type == 'status':
+                    got_idle = content['execution_state'] == 'idle'
+                elif msg_type == 'execute_input':
+                    execution_count = content.get('execution_count')
+                elif msg_type == 'clear_output':
+                    outputs = []
+                elif msg_type == 'stream' and outputs and \
+                        outputs[-1].get('name') == content['name']:
+                    outputs[-1]['text'] += content['text']
+                elif msg_type in ('stream', 'display_data', 'execute_result', 'error'):
+                    outputs.append(nbformat.v4.output_from_msg(msg))
+                    if msg_type == 'error':
+                        error = content
+
+        try:
+            replies = await channel.send(request)
+            try:
+                await asyncio.wait_for(receive(replies), timeout)
+            except asyncio.TimeoutError:
+                self.log.msg('Cell Execute: Timeout', action='cell-execute', phase='failure')
+                # like nbconvert, so that the kernel can run the next cell
+                await self.interrupt_kernel(kernel_id)
+                await asyncio.wait_for(receive(replies), INTERRUPT_TIMEOUT)
+                raise OperationError(f'Cell execution timed out after {timeout} seconds')
+        except OperationError:
+            raise
+        except Exception as e:
+            self.log.msg('Cell Execute: Failed {}'.format(str(e)), action='cell-execute', phase='failure')
+            raise OperationError()
+        finally:
+            channel.release(msg_id)
+
+        if error is not None:
+            traceback = _ansi_escape('\n'.join(error['traceback']))
+            self.log.msg('Cell Execute: Error', action='cell-execute', phase='error',
+                         traceback=traceback)
+            raise OperationError(f"{error['ename']}: {error['evalue']}")
+        return execution_count, outputs
+
+    async def execute_notebook_cells(self, nb, timeout=600, env_vars={},
+                                     kernel_id=None):
+        """Execute a notebook cell by cell on an already started kernel.
+
+        Unlike ``execute_notebook``, nothing is written in the binder: each
+        code cell of ``nb`` is sent as its own ``execute_request`` and
+        ``nb`` is filled in place with the outputs. The kernel's namespace
+        is reset first, but imported modules stay warm.
         """
-        return await self.run_code(code)
+        env_var_str = str(env_vars)
+        code = f"""
+        import os
+        os.environ.update({env_var_str})
+        try:
+            get_ipython().reset(new_session=False)
+        except NameError:
+            pass
+        """
+        start_time = time.monotonic()
+        code_cells = [cell for cell in nb.cells if cell.cell_type == 'code']
+        with self.tracer.span('execute', cells=len(code_cells)):
+            await self.run_code(code, kernel_id=kernel_id)
+            for n, cell in enumerate(code_cells, 1):
+                self.log.msg(f'Cell Execute: {n}/{len(code_cells)}', action='cell-execute',
+                             phase='start', cell=n, n_cells=len(code_cells))
+                with self.tracer.span('cell', cell=n):
+                    cell.execution_count, cell.outputs = await self.execute_cell(
+                        cell.source, kernel_id=kernel_id, timeout=timeout)
+        self.log.msg('Cell Execute: Notebook complete', action='cell-execute',
+                     phase='complete', duration=time.monotonic() - start_time)
+        return nb
+
+    async def upload_local_notebook(self, notebook_filename, nb=None, payload=None):
+        """Upload a notebook, stripping it first unless ``nb`` is given.
 
-    async def upload_local_notebook(self, notebook_filename):
-        nb = open_nb_and_strip_output(notebook_filename)
+        ``payload`` is passed on to ``put_contents``.
+        """
+        if nb is None:
+            nb = open_nb_and_strip_output(notebook_filename)
         # probably want to use basename instead
-        await self.put_contents(notebook_filename, nb)
+        await self.put_contents(notebook_filename, nb, payload)
+
+    async def upload_local_files(self, filenames):
+        """Upload auxiliary files the notebooks need, e.g. data files."""
+        for fname in filenames:
+            print(f"⌛️ Uploading {fname}...", flush=True)
+            await self.upload_file(fname)
+
+    async def upload_archive(self, notebooks=None, filenames=()):
+        """Upload notebooks and files as one zip archive, unpacked in the binder.
+
+        ``notebooks`` maps paths to notebooks and ``filenames`` are local
+        files, stored like ``upload_file`` would. Many small files then cost
+        one transfer and one ``run_code`` instead of a request each.
+        """
+        notebooks = notebooks or {}
+        # not hidden, as Jupyter refuses to create hidden files
+        archive = f'binderbot-upload-{uuid.uuid4().hex}.zip'
+        loop = asyncio.get_event_loop()
+        with tempfile.TemporaryDirectory() as tmp, \
+                self.tracer.span('upload-archive', files=len(notebooks) + len(filenames)):
+            local_archive = os.path.join(tmp, 'upload.zip')
+            await loop.run_in_executor(None, make_archive, local_archive,
+                                       notebooks, filenames)
+            await self.upload_file(local_archive, path=archive)
+        await self.run_code(f"""
+        import os, zipfile
+        with zipfile.ZipFile({archive!r}) as archive:
+            archive.extractall()
+        os.remove({archive!r})
+        """)
+        self._uploaded.update(notebooks)
+
+    async def upload_inputs(self, notebooks, options=None, upload_files=(), prepared=None):
+        """Upload what the notebooks need before they run.
 
-    async def run(self, filenames, binder_start_timeout=600, nb_timeout=600,
-                  extra_env_vars=None, download=True, output_dir="."):
+        With ``options.batch_upload`` the ``notebooks`` (unless they are sent
+        cell by cell) go in one archive with ``upload_files``, and are not
+        uploaded again when they run. Otherwise only ``upload_files`` are
+        uploaded here, one by one.
+        """
+        options = options or RunOptions()
+        if not options.batch_upload:
+            await self.upload_local_files(upload_files)
+            return
+        stripped = {}
+        if options.engine != 'client':
+            for fname in notebooks:
+                try:
+                    stripped[fname], _ = await self._prepare_notebook(fname, prepared, options)
+                except Exception:
+                    # the error is reported when the notebook runs
+                    continue
+        if stripped or upload_files:
+            print(f"⌛️ Uploading {len(stripped) + len(upload_files)} files "
+                  f"in one archive...", flush=True)
+            await self.upload_archive(stripped, upload_files)
 
-        extra_env_vars = extra_env_vars or {}
-        output_dir = pathlib.Path(output_dir or ".")
+    async def launch(self, lookup, options=None, upload_files=(), prepared=None,
+                     timeout=600, session_store=None, slot=0, sha=None, name='Binder',
+                     queue=None):
+        """Start the binder and its kernel, and upload the inputs of the notebooks.
 
-        # It's assumed that we've started.
-        await self.start_binder(timeout=binder_start_timeout)
+        ``lookup`` is the future from ``prepare_run``, only awaited once
+        the binder is started; its ``(filenames, cache_keys)`` are returned.
+        If the ``queue`` it fills was emptied by other binders meanwhile,
+        no kernel is started and nothing is uploaded. With a
+        ``session_store``, the binder saved in ``slot`` is resumed if it
+        is still running and was launched from commit ``sha``.
+        """
+        if session_store is not None:
+            await self.start_or_resume_binder(session_store, slot=slot, timeout=timeout,
+                                              sha=sha)
+        else:
+            await self.start_binder(timeout=timeout)
+        # shared by the binders of a run, so one being cancelled keeps it going
+        notebooks, cache_keys = await asyncio.shield(lookup)
+        if queue is not None and queue.empty():
+            print(f"✅ {name} started, but no notebooks are left for it.")
+            return notebooks, cache_keys
         await self.start_kernel()
-        print("✅ Binder and kernel started successfully.")
-        # could think about asyncifying this whole loop
-        # for now, we run one notebook at a time to avoid overloading the binder
-        errors = {}
-        for fname in filenames:
+        print(f"✅ {name} and kernel started successfully.")
+        await self.upload_inputs(notebooks, options, upload_files, prepared=prepared)
+        return notebooks, cache_keys
+
+    async def run(self, filenames, binder_start_timeout=600, options=None,
+                  concurrency=1, pipeline=False, kernel_pool=None, cache=None,
+                  session_store=None, upload_files=(), **option_kwargs):
+        """Start the binder and run notebooks on it, see ``run_queue``.
+
+        ``options`` is a ``RunOptions``, by default made of ``option_kwargs``.
+        Returns a dict of errors keyed by notebook filename.
+        """
+        options = options or RunOptions(**option_kwargs)
+
+        with self.tracer.span('run'):
+            queue = asyncio.Queue()
+            lookup, prepared, sha = await prepare_run(
+                filenames, queue, self.repo, self.ref, self.binder_url, options,
+                cache=cache, tracer=self.tracer, resolve=session_store is not None)
+            if lookup is None:
+                return {}
+            try:
+                _, cache_keys = await self.launch(
+                    lookup, options, upload_files, prepared=prepared,
+                    timeout=binder_start_timeout, session_store=session_store, sha=sha)
+            finally:
+                lookup.cancel()
+            return await self.run_queue(queue, options, concurrency=concurrency,
+                                        pipeline=pipeline, kernel_pool=kernel_pool,
+                                        cache=cache, cache_keys=cache_keys,
+                                        prepared=prepared)
+
+    async def run_queue(self, queue, options=None, concurrency=1, pipeline=False,
+                        kernel_pool=None, cache=None, cache_keys=None, prepared=None):
+        """Run notebooks taken from ``queue`` until it is empty.
+
+        The queue may be shared with other users, so that notebooks are
+        spread across several binders. Up to ``concurrency`` notebooks run
+        at once, each on a kernel of a ``KernelPool`` if ``kernel_pool``
+        holds its options. With ``pipeline``, notebooks are uploaded and
+        downloaded while others execute. Results of the notebooks in
+        ``cache_keys`` are stored in ``cache``, and ``prepared`` may map
+        filenames to futures from ``prepare_notebooks``. Returns a dict of
+        errors keyed by notebook filename, including every notebook taken
+        and left unfinished if the run fails as a whole.
+        """
+        options = options or RunOptions()
+        assert self.state == BinderUser.States.KERNEL_STARTED
+        if options.engine == 'zygote':
+            await self.start_zygote(options.preload)
+
+        results = _Results(cache, cache_keys,
+                           batch_download=options.batch_download and options.download)
+        prepared = prepared or {}
+        # up to `concurrency` workers pull notebooks from the queue;
+        # each one drives its own kernel so executions don't block each other
+        n_workers = max(1, min(concurrency, queue.qsize()))
+        pool = KernelPool(self, **kernel_pool) if kernel_pool else None
+        if pool is not None:
+            kernels = [None] * n_workers
+            pool.start()
+        else:
+            # started before any notebook is taken, so that a kernel failing
+            # to start leaves the notebooks to other binders
+            kernels = await self._start_worker_kernels(n_workers)
+
+        async def take():
+            return results.take(queue)
+
+        async def process(fname, kernel_id):
+            await self._run_notebook(fname, kernel_id, options, results, prepared)
+
+        try:
+            if pipeline and options.engine != 'client':
+                await self._run_pipeline(queue, options, results, prepared, kernels,
+                                         pool=pool)
+            else:
+                await _gather_or_cancel(*[
+                    self._run_worker(take, process, results, kernel_id=kernel_id,
+                                     pool=pool)
+                    for kernel_id in kernels
+                ])
+        except Exception as e:
+            # the notebooks taken and not run to the end fail with the run
+            for fname in results.unfinished():
+                results.failed(fname, e)
+            return results.errors
+        finally:
+            if pool is not None:
+                await pool.close()
+            else:
+                await self._stop_worker_kernels(kernels)
+        executed = results.executed
+        if executed or (executed is not None and options.artifacts):
+            print(f"⌛️ Downloading {len(executed)} notebooks in one archive...", flush=True)
+            try:
+                await self.download_archive(executed, options.output_dir,
+                                            patterns=options.artifacts)
+            except Exception as e:
+                for fname in executed:
+                    results.errors[fname] = e
+                print(f'❌ error downloading notebooks: {e}')
+                return results.errors
+            for fname in executed:
+                try:
+                    self._save_result(fname, options, results)
+                except Exception as e:
+                    results.failed(fname, e)
+        return results.errors
+
+    async def download_archive(self, paths, output_dir=".", patterns=()):
+        """Download files in one compressed archive and extract them.
+
+        The files at ``paths``, and those matching the glob ``patterns``,
+        are zipped in the binder, streamed to disk in one request and
+        extracted into ``output_dir`` by several threads. Returns the
+        extracted paths.
+        """
+        # not hidden, as Jupyter doesn't serve hidden files
+        archive = f'binderbot-download-{uuid.uuid4().hex}.zip'
+        loop = asyncio.get_event_loop()
+        with self.tracer.span('download-archive', files=len(paths)):
+            try:
+                await self.run_code(f"""
+                import glob, os, zipfile
+                paths = {list(paths)!r}
+                for pattern in {list(patterns)!r}:
+                    paths.extend(p for p in sorted(glob.glob(pattern, recursive=True))
+                                 if os.path.isfile(p))
+                with zipfile.ZipFile({archive!r}, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    for path in dict.fromkeys(paths):
+                        archive.write(path)
+                """)
+                with tempfile.TemporaryDirectory() as tmp:
+                    local_archive = os.path.join(tmp, 'download.zip')
+                    await self.download_file(archive, local_archive)
+                    with self.tracer.span('extract'):
+                        return await loop.run_in_executor(None, extract_archive,
+                                                          local_archive, output_dir)
+            finally:
+                await self.run_code(f"""
+                import os
+                if os.path.exists({archive!r}):
+                    os.remove({archive!r})
+                """)
+
+    async def _start_worker_kernels(self, n_workers):
+        """Kernels for ``n_workers`` workers: the default one, then new ones.
+
+        If one fails to start, the others are stopped and the error raised.
+        """
+        started = await asyncio.gather(*[self.start_kernel()
+                                         for _ in range(n_workers - 1)],
+                                       return_exceptions=True)
+        failures = [k for k in started if isinstance(k, BaseException)]
+        if failures:
+            await self._stop_worker_kernels(
+                [None] + [k for k in started if not isinstance(k, BaseException)])
+            raise failures[0]
+        return [self.kernel_id] + started
+
+    async def _stop_worker_kernels(self, kernels):
+        # the first worker's kernel is the default one, stopped with the binder
+        for kernel_id in kernels[1:]:
+            try:
+                await self.stop_kernel(kernel_id)
+            except OperationError:
+                pass
+
+    async def _run_worker(self, take, process, results, kernel_id=None, pool=None):
+        """Call ``process(fname, kernel_id)`` on notebooks from ``take()``.
+
+        ``take`` returns None once there are no notebooks left. With a
+        ``pool``, each notebook runs on a kernel borrowed from it instead.
+        """
+        while True:
+            fname = await take()
+            if fname is None:
+                break
             try:
-                print(f"⌛️ Uploading {fname}...", end="", flush=False)
-                await self.upload_local_notebook(fname)
-                print("✅", flush=True)
-                print(f"⌛️ Executing {fname}...", end="", flush=False)
-                await self.execute_notebook(fname, timeout=nb_timeout,
-                                            env_vars=extra_env_vars)
-                print("✅", flush=True)
-                if download:
-                    print(f"⌛️ Downloading and saving {fname}...")
-                    nb_data = await self.get_contents(fname)
-                    nb = nbformat.from_dict(nb_data)
-                    output = output_dir / fname
-                    with output.open('w', encoding='utf-8') as f:
-                        nbformat.write(nb, f)
-                    print("✅")
+                if pool is None:
+                    await process(fname, kernel_id)
+                else:
+                    async with pool.kernel() as pooled_kernel_id:
+                        await process(fname, pooled_kernel_id)
             except Exception as e:
-                errors[fname] = e
-                print(f'❌ error running {fname}: {e}')
-        return errors
+                results.failed(fname, e)
+
+    async def _run_pipeline(self, queue, options, results, prepared, kernels, pool=None):
+        """Run notebooks from ``queue`` in overlapping stages.
+
+        One task uploads notebooks, a worker per kernel executes them and
+        one task downloads them, so that a notebook is uploaded and another
+        one downloaded while a third runs. Stages hand notebooks over
+        through queues holding at most one per worker, so that the upload
+        stage does not take notebooks that other binders could run.
+        """
+        concurrency = len(kernels)
+        to_execute = asyncio.Queue(maxsize=concurrency)
+        to_download = asyncio.Queue(maxsize=concurrency)
+        # when each notebook in the pipeline was taken
+        started = {}
+
+        def end_notebook(fname, error=None):
+            # the notebook span, as _run_notebook records it, across stages
+            start_time = started.pop(fname)
+            attrs = {'path': fname} if error is None else {'path': fname, 'error': repr(error)}
+            self.tracer.record('notebook', start_time, time.monotonic(), **attrs)
+            if error is None:
+                self.log.msg(f'Notebook: {fname} complete', action='notebook',
+                             phase='complete', duration=time.monotonic() - start_time)
+
+        async def upload():
+            while True:
+                fname = results.take(queue)
+                if fname is None:
+                    break
+                started[fname] = time.monotonic()
+                try:
+                    nb, payload = await self._prepare_notebook(fname, prepared, options)
+                    await self._upload_stage(fname, nb, payload)
+                except Exception as e:
+                    end_notebook(fname, e)
+                    results.failed(fname, e)
+                    continue
+                await to_execute.put(fname)
+            for _ in range(concurrency):
+                await to_execute.put(None)
+
+        async def execute(fname, kernel_id):
+            try:
+                await self._execute_stage(fname, kernel_id, options)
+            except Exception as e:
+                end_notebook(fname, e)
+                raise
+            await to_download.put(fname)
+
+        async def execute_worker(kernel_id):
+            await self._run_worker(to_execute.get, execute, results,
+                                   kernel_id=kernel_id, pool=pool)
+            await to_download.put(None)
+
+        async def download_all():
+            running = concurrency
+            while running:
+                fname = await to_download.get()
+                if fname is None:
+                    running -= 1
+                    continue
+                try:
+                    await self._download_stage(fname, options, results)
+                except Exception as e:
+                    end_notebook(fname, e)
+                    results.failed(fname, e)
+                else:
+                    end_notebook(fname)
+
+        try:
+            # a stage failing as a whole would leave the others waiting
+            await _gather_or_cancel(upload(), download_all(),
+                                    *[execute_worker(kernel_id) for kernel_id in kernels])
+        except Exception as e:
+            # notebooks handed over between stages fail with the pipeline
+            for stage_queue in (to_execute, to_download):
+                while not stage_queue.empty():
+                    fname = stage_queue.get_nowait()
+                    if fname is not None:
+                        results.failed(fname, e)
+            raise
+
+    async def _run_notebook(self, fname, kernel_id, options, results, prepared):
+        start_time = time.monotonic()
+        with self.tracer.span('notebook', path=fname):
+            await self._process_notebook(fname, kernel_id, options, results, prepared)
+        self.log.msg(f'Notebook: {fname} complete', action='notebook', phase='complete',
+                     duration=time.monotonic() - start_time)
+
+    async def _prepare_notebook(self, fname, prepared, options):
+        with self.tracer.span('prepare'):
+            if prepared and fname in prepared:
+                return await prepared[fname]
+            return prepare_notebook(fname, validate=options.validate,
+                                    strip_metadata=options.strip_metadata)
+
+    async def _process_notebook(self, fname, kernel_id, options, results, prepared):
+        nb, payload = await self._prepare_notebook(fname, prepared, options)
+        if options.engine == 'client':
+            print(f"⌛️ Executing {fname} cell by cell...", flush=True)
+            await self.execute_notebook_cells(nb, timeout=options.nb_timeout,
+                                              env_vars=options.extra_env_vars,
+                                              kernel_id=kernel_id)
+            if not options.download:
+                results.succeeded(fname)
+                return
+            print(f"⌛️ Saving {fname}...", flush=True)
+            if options.trim:
+                trim_outputs(nb, **options.trim)
+            output = options.output_dir / fname
+            with self.tracer.span('write', path=fname), \
+                    output.open('w', encoding='utf-8') as f:
+                nbformat.write(nb, f)
+            results.succeeded(fname, output)
+            return
+
+        await self._upload_stage(fname, nb, payload)
+        await self._execute_stage(fname, kernel_id, options)
+        await self._download_stage(fname, options, results)
+
+    async def _upload_stage(self, fname, nb, payload):
+        if fname not in self._uploaded:
+            print(f"⌛️ Uploading {fname}...", flush=True)
+            await self.upload_local_notebook(fname, nb, payload)
+
+    async def _execute_stage(self, fname, kernel_id, options):
+        print(f"⌛️ Executing {fname}...", flush=True)
+        execute = self.execute_notebook_zygote if options.engine == 'zygote' \
+            else self.execute_notebook
+        await execute(fname, timeout=options.nb_timeout, env_vars=options.extra_env_vars,
+                      kernel_id=kernel_id, trim=options.trim)
+
+    async def _download_stage(self, fname, options, results):
+        if not options.download:
+            results.succeeded(fname)
+        elif results.executed is not None:
+            # downloaded later with the others
+            results.executed.append(fname)
+        else:
+            print(f"⌛️ Downloading and saving {fname}...", flush=True)
+            await self.download_file(fname, options.output_dir / fname)
+            self._save_result(fname, options, results)
+
+    def _save_result(self, fname, options, results):
+        """Check and cache a downloaded notebook."""
+        output = options.output_dir / fname
+        if options.validate:
+            with self.tracer.span('validate', path=fname):
+                validate_notebook(output)
+        results.succeeded(fname, output)
+
+
+async def _gather_or_cancel(*aws):
+    """Like ``asyncio.gather``, but cancelling the others once one fails.
+
+    The cancelled tasks are awaited, so that none is left running.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def validate_notebook(fname):
+    """Raise OperationError unless ``fname`` is a valid notebook."""
+    try:
+        nbformat.validate(nbformat.read(str(fname), as_version=nbformat.NO_CONVERT))
+    except Exception as e:
+        raise OperationError(f'{fname} is not a valid notebook: {e}')
+
+
+def notebook_bytes(nb):
+    """Serialize a notebook in the same layout as ``nbformat.write``."""
+    return (json.dumps(nb, indent=1, sort_keys=True, ensure_ascii=False)
+            + '\n').encode('utf8')
+
+
+def iter_notebook_bytes(nb, chunk_size):
+    """Serialize a notebook like ``notebook_bytes``, ``chunk_size`` bytes at a time."""
+    encoder = json.JSONEncoder(indent=1, sort_keys=True, ensure_ascii=False)
+    buf = bytearray()
+    for text in itertools.chain(encoder.iterencode(nb), ['\n']):
+        buf += text.encode('utf8')
+        while len(buf) >= chunk_size:
+            yield bytes(buf[:chunk_size])
+            del buf[:chunk_size]
+    if buf:
+        yield bytes(buf)
+
+
+def make_archive(path, notebooks, filenames=()):
+    """Write notebooks and local files to a zip archive at ``path``.
+
+    Files are stored under the paths ``BinderUser.upload_file`` would use.
+    """
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for fname, nb in notebooks.items():
+            archive.writestr(fname, notebook_bytes(nb))
+        for fname in filenames:
+            arcname = os.path.basename(fname) if os.path.isabs(fname) else fname
+            archive.write(fname, arcname)
+
+
+def extract_archive(path, dest, max_workers=4):
+    """Extract a zip archive into ``dest`` with several threads.
+
+    Each thread reads its own share of the members through its own handle,
+    so decompression and writing overlap. Returns the extracted names.
+    """
+    with zipfile.ZipFile(path) as archive:
+        names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    # made here, as threads making the same directory at once would collide;
+    # ZipFile.extract drops the same parts of the paths
+    for name in names:
+        parts = [part for part in name.split('/')[:-1] if part not in ('', '.', '..')]
+        os.makedirs(os.path.join(dest, *parts), exist_ok=True)
+
+    def extract(names):
+        with zipfile.ZipFile(path) as archive:
+            for name in names:
+                archive.extract(name, dest)
+
+    groups = [names[i::max_workers] for i in range(max_workers)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(extract, groups))
+    return names
+
+
+def notebook_payload(nb):
+    """Serialize the contents API request body for uploading ``nb``."""
+    return json.dumps({'content': nb, 'type': 'notebook'}).encode('utf8')
+
+
+def prepare_notebook(fname, validate=False, strip_metadata=False):
+    """Strip a notebook and serialize it for upload.
+
+    Returns ``(nb, payload)``. The payload is None for a notebook too big
+    for one request, which is serialized as it is uploaded instead.
+    """
+    nb = open_nb_and_strip_output(fname, validate=validate, strip_metadata=strip_metadata)
+    payload = notebook_payload(nb)
+    if len(payload) > UPLOAD_CHUNK_SIZE:
+        payload = None
+    return nb, payload
+
+
+def prepare_notebooks(filenames, max_workers=None, validate=False, strip_metadata=False):
+    """Prepare notebooks in a thread pool.
+
+    Returns a dict mapping each filename to a future of ``(nb, payload)``,
+    so that preparation can overlap with launching the binder.
+    """
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    prepare = functools.partial(prepare_notebook, validate=validate,
+                                strip_metadata=strip_metadata)
+    prepared = {fname: loop.run_in_executor(executor, prepare, fname)
+                for fname in filenames}
+    # already submitted work still runs to completion
+    executor.shutdown(wait=False)
+    return prepared
+
+
+async def use_cached_results(cache, filenames, repo, sha, binder_url, options=None,
+                             prepared=None, on_miss=None):
+    """Write cached results to ``options.output_dir`` and find the notebooks to run.
+
+    ``sha`` is the commit the ref resolves to. Returns ``(misses,
+    cache_keys)``, where ``cache_keys`` maps each missed notebook to the
+    key its result should be stored under. ``on_miss`` is called with
+    each missed notebook as soon as it is found.
+    """
+    options = options or RunOptions()
+    prepared = prepared or {}
+    env_var_names = list(options.extra_env_vars)
+    misses = []
+    cache_keys = {}
+    for fname in filenames:
+        try:
+            if fname in prepared:
+                nb, _ = await prepared[fname]
+            else:
+                nb = open_nb_and_strip_output(fname)
+        except Exception:
+            # not cacheable; the error is reported when the notebook runs
+            misses.append(fname)
+            if on_miss is not None:
+                on_miss(fname)
+            continue
+        key = cache.key(nb, repo, sha, binder_url, env_var_names,
+                        options={'engine': options.engine, 'trim': options.trim})
+        cached = cache.get(key)
+        if cached is None:
+            misses.append(fname)
+            cache_keys[fname] = key
+            if on_miss is not None:
+                on_miss(fname)
+        else:
+            shutil.copyfile(cached, options.output_dir / fname)
+            print(f"✅ {fname} (cached)", flush=True)
+    return misses, cache_keys
 
 
-def open_nb_and_strip_output(fname):
-    cop = ClearOutputPreprocessor()
-    with open(fname) as f:
-        nb = nbformat.read(f, as_version=4)
-    cop.preprocess(nb, dict())
+async def prepare_run(filenames, queue, repo, ref, binder_url, options, cache=None,
+                      tracer=None, resolve=False):
+    """Start preparing notebooks, and write those found in ``cache``.
+
+    Returns ``(lookup, prepared, sha)``: a future of the notebooks left to
+    run and the keys their results go under in the cache, which puts
+    those notebooks on ``queue``; ``prepare_notebooks`` futures; and the
+    commit of ``ref``. The ref is resolved for the cache, or if ``resolve``
+    is set; ``sha`` is None otherwise, or if it can't be resolved. This
+    returns as soon as a notebook is found to run, so that the binder can
+    be launched during the rest of the lookup, and ``lookup`` is None if
+    all of them were cached.
+    """
+    tracer = tracer if tracer is not None else Tracer()
+    # strip the notebooks in the background while the binder starts
+    prepared = prepare_notebooks(filenames, validate=options.validate,
+                                 strip_metadata=options.strip_metadata)
+    sha = None
+    if cache is not None or resolve:
+        with tracer.span('resolve-ref'):
+            async with make_session() as session:
+                sha = await resolve_ref(session, repo, ref)
+    if cache is not None and sha is None:
+        print(f"⚠️ Could not resolve {repo}@{ref} to a commit, not using the cache.")
+    if cache is None or sha is None:
+        for fname in filenames:
+            queue.put_nowait(fname)
+        lookup = asyncio.get_event_loop().create_future()
+        lookup.set_result((list(filenames), None))
+        return lookup, prepared, sha
+
+    missed = asyncio.Event()
+
+    async def look_up():
+        with tracer.span('cache-lookup'):
+            misses, cache_keys = await use_cached_results(
+                cache, filenames, repo, sha, binder_url, options=options,
+                prepared=prepared, on_miss=lambda fname: missed.set())
+        for fname in misses:
+            queue.put_nowait(fname)
+        return misses, cache_keys
+
+    lookup = asyncio.ensure_future(look_up())
+    waiter = asyncio.ensure_future(missed.wait())
+    try:
+        await asyncio.wait([lookup, waiter], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        waiter.cancel()
+    if lookup.done() and not lookup.result()[0]:
+        print("✅ All notebooks found in cache, not starting binder.")
+        return None, prepared, sha
+    return lookup, prepared, sha
+
+
+async def run_on_binders(binder_url, repo, ref, filenames, options=None, servers=1,
+                         binder_start_timeout=600, concurrency=1, pipeline=False,
+                         kernel_pool=None, cache=None, session_store=None,
+                         upload_files=(), tracer=None, connector_options=None,
+                         retry_policies=None, history=None):
+    """Run notebooks on ``servers`` binders launched in parallel.
+
+    The binders share one work queue, so a faster server takes more
+    notebooks, and each runs them as ``BinderUser.run_queue`` does.
+    Binders are torn down at the end, unless they are saved in and reused
+    from a ``session_store``. They share one connection pool, created with
+    ``make_connector(**connector_options)``, and record their launches in
+    the BuildHistory ``history``. Returns a dict of errors keyed by
+    notebook filename.
+    """
+    options = options or RunOptions()
+    tracer = tracer if tracer is not None else Tracer()
+    with tracer.span('run', servers=servers):
+        queue = asyncio.Queue()
+        lookup, prepared, sha = await prepare_run(
+            filenames, queue, repo, ref, binder_url, options, cache=cache,
+            tracer=tracer, resolve=session_store is not None)
+        if lookup is None:
+            return {}
+        errors = {}
+        # binders still launching, and the number running notebooks
+        launching = {}
+        running = 0
+
+        async def run_on_binder(n):
+            nonlocal running
+            async with BinderUser(binder_url, repo, ref, tracer=tracer,
+                                  connector=connector,
+                                  retry_policies=retry_policies,
+                                  history=history) as jovyan:
+                with tracer.span('binder', index=n):
+                    try:
+                        try:
+                            _, cache_keys = await jovyan.launch(
+                                lookup, options, upload_files, prepared=prepared,
+                                timeout=binder_start_timeout, session_store=session_store,
+                                slot=n, sha=sha, name=f'Binder {n}', queue=queue)
+                        finally:
+                            del launching[n]
+                        if queue.empty():
+                            return
+                        running += 1
+                        try:
+                            errors.update(await jovyan.run_queue(
+                                queue, options, concurrency=concurrency,
+                                pipeline=pipeline, kernel_pool=kernel_pool, cache=cache,
+                                cache_keys=cache_keys, prepared=prepared))
+                        finally:
+                            running -= 1
+                        if queue.empty() and not running:
+                            # nothing is left for binders still launching
+                            for task in launching.values():
+                                task.cancel()
+                    finally:
+                        await jovyan.teardown(shutdown=not jovyan.saved)
+
+        connector = make_connector(**(connector_options or {}))
+        try:
+            for n in range(servers):
+                launching[n] = asyncio.ensure_future(run_on_binder(n))
+            results = await asyncio.gather(*launching.values(), return_exceptions=True)
+        finally:
+            await connector.close()
+        # the notebooks to run are only queued once the lookup is done
+        await asyncio.wait([lookup])
+    launch_errors = [r for r in results if isinstance(r, Exception)]
+    for e in launch_errors:
+        print(f'❌ error starting binder: {e!r}')
+    if lookup.exception() is not None:
+        return {fname: lookup.exception() for fname in filenames}
+    # anything left over means no binder was able to take it
+    while not queue.empty():
+        fname = queue.get_nowait()
+        errors[fname] = launch_errors[0] if launch_errors else OperationError()
+    return errors
+
+
+def strip_notebook(nb, strip_metadata=False):
+    """Clear the outputs of notebook ``nb``, a dict as parsed from JSON, in place.
+
+    Like nbconvert's ``ClearOutputPreprocessor``, execution counts and the
+    cell metadata about outputs go too. With ``strip_metadata``, so does
+    all metadata but the cell tags and the notebook's kernelspec and
+    language_info, which execution depends on. Sources split in lines are
+    joined, as nbformat does.
+    """
+    if strip_metadata:
+        metadata = nb.get('metadata', {})
+        nb['metadata'] = {k: metadata[k] for k in KEPT_NOTEBOOK_METADATA if k in metadata}
+    for cell in nb.get('cells', []):
+        # sources may be saved split in lines, nbformat joins them on reading
+        if isinstance(cell.get('source'), list):
+            cell['source'] = ''.join(cell['source'])
+        if strip_metadata and 'metadata' in cell:
+            cell['metadata'] = {k: v for k, v in cell['metadata'].items()
+                                if k in KEPT_CELL_METADATA}
+        if cell.get('cell_type') != 'code':
+            continue
+        cell['outputs'] = []
+        cell['execution_count'] = None
+        for field in OUTPUT_METADATA_FIELDS:
+            cell.get('metadata', {}).pop(field, None)
     return nb
+
+
+def open_nb_and_strip_output(fname, validate=False, strip_metadata=False):
+    """Read a notebook and clear its outputs, returning a ``NotebookNode``.
+
+    The file is parsed once as plain JSON and only checked against the
+    nbformat schema with ``validate``. Notebooks older than version 4 go
+    through nbformat to be converted.
+    """
+    with open(fname, 'rb') as f:
+        nb = json.loads(f.read().decode('utf8'))
+    if nb.get('nbformat') != 4:
+        nb = nbformat.convert(nbformat.from_dict(nb), 4)
+    strip_notebook(nb, strip_metadata=strip_metadata)
+    if validate:
+        try:
+            nbformat.validate(nb)
+        except nbformat.ValidationError as e:
+            raise OperationError(f'{fname} is not a valid notebook: {e}')
+    return nbformat.from_dict(nb)
@@ -0,0 +1,172 @@
+"""On-disk cache of executed notebooks.
+
+Results are keyed by a hash of everything that determines the outcome of a
+run: the stripped notebook, the repo, the resolved commit, the binder and
+the names of the environment variables passed through.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import time
+
+import structlog
+
+logger = structlog.get_logger()
+
+_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return pathlib.Path(cache_home) / 'binderbot'
+
+
+async def resolve_ref(session, repo, ref):
+    """Resolve a branch or tag of a GitHub repo to a commit sha.
+
+    The GitHub API is authenticated with ``$GITHUB_TOKEN`` if set, as it
+    only allows 60 anonymous requests an hour. If it fails, e.g. over that
+    limit, ``git ls-remote`` is tried instead. Returns None if the ref
+    can't be resolved.
+    """
+    if _SHA_RE.match(ref):
+        return ref
+    url = f'https://api.github.com/repos/{repo}/commits/{ref}'
+    headers = {'Accept': 'application/vnd.github.v3.sha'}
+    if os.environ.get('GITHUB_TOKEN'):
+        headers['Authorization'] = f"token {os.environ['GITHUB_TOKEN']}"
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 200:
+                sha = (await resp.text()).strip()
+                if _SHA_RE.match(sha):
+                    return sha
+            logger.msg(f'Cache: Could not resolve {repo}@{ref} with the GitHub API',
+                       action='cache', phase='resolve-failed', status=resp.status)
+    except Exception as e:
+        logger.msg(f'Cache: Could not resolve {repo}@{ref} with the GitHub API: {e}',
+                   action='cache', phase='resolve-failed')
+    return await ls_remote(repo, ref)
+
+
+async def ls_remote(repo, ref, timeout=30):
+    """Resolve a branch or tag with ``git ls-remote``, or return None."""
+    env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'git', 'ls-remote', f'https://github.com/{repo}', ref, env=env,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    except OSError as e:
+        logger.msg(f'Cache: Could not run git ls-remote: {e}', action='cache',
+                   phase='resolve-failed')
+        return None
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        return None
+    sha = pick_ref(stdout.decode('utf8', 'replace'), ref)
+    if sha is None:
+        logger.msg(f'Cache: Could not resolve {repo}@{ref} with git ls-remote',
+                   action='cache', phase='resolve-failed', returncode=proc.returncode)
+    return sha
+
+
+def pick_ref(ls_remote_output, ref):
+    """The commit a branch or tag points to, from ``git ls-remote`` output."""
+    shas = {}
+    for line in ls_remote_output.splitlines():
+        sha, _, name = line.partition('\t')
+        shas[name] = sha
+    # branches first, like binderhub; an annotated tag points to its commit with ^{}
+    for name in (f'refs/heads/{ref}', f'refs/tags/{ref}^{{}}', f'refs/tags/{ref}'):
+        if _SHA_RE.match(shas.get(name, '')):
+            return shas[name]
+    return None
+
+
+class ResultCache:
+    """A directory of executed notebooks, evicted by size and age.
+
+    cache_dir - where to keep the notebooks (default ~/.cache/binderbot)
+    max_size - total size in bytes to keep, least recently used go first
+    max_age - seconds after which an entry is dropped
+    """
+
+    def __init__(self, cache_dir=None, max_size=2 * 1024 ** 3,
+                 max_age=30 * 24 * 3600):
+        self.cache_dir = pathlib.Path(cache_dir or default_cache_dir())
+        self.max_size = max_size
+        self.max_age = max_age
+        self.log = logger.bind()
+
+    @staticmethod
+    def key(nb, repo, ref, binder_url, env_var_names=(), options=None):
+        """Hash a stripped notebook together with the run parameters.
+
+        ``options`` holds any other settings changing the saved result.
+        """
+        nb = dict(nb)
+        # cell ids may be generated at random when reading old notebooks
+        nb['cells'] = [{k: v for k, v in cell.items() if k != 'id'}
+                       for cell in nb.get('cells', [])]
+        h = hashlib.sha256()
+        h.update(json.dumps(nb, sort_keys=True).encode('utf8'))
+        for part in (repo, ref, str(binder_url).rstrip('/'),
+                     ','.join(sorted(env_var_names))):
+            h.update(b'\0' + part.encode('utf8'))
+        if options:
+            h.update(b'\0' + json.dumps(options, sort_keys=True).encode('utf8'))
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f'{key}.ipynb'
+
+    def get(self, key):
+        """Return the path of the cached notebook for ``key``, or None."""
+        path = self._path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        if time.time() - stat.st_mtime > self.max_age:
+            path.unlink()
+            return None
+        # mark as recently used
+        os.utime(path)
+        self.log.msg(f'Cache: Hit {key}', action='cache', phase='hit')
+        return path
+
+    def put(self, key, fname):
+        """Copy the executed notebook ``fname`` into the cache."""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        shutil.copyfile(fname, tmp)
+        os.replace(tmp, path)
+        self.log.msg(f'Cache: Stored {key}', action='cache', phase='store')
+        self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the oldest ones until under max_size."""
+        now = time.time()
+        entries = []
+        for path in self.cache_dir.glob('*/*.ipynb'):
+            stat = path.stat()
+            if now - stat.st_mtime > self.max_age:
+                path.unlink()
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            path.unlink()
+            total -= size
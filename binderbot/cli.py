@@ -5,16 +5,14 @@ import os
 import sys
 
 import click
-import nbformat
 
-from .binderbot import BinderUser
+# the rest of binderbot pulls in aiohttp, nbformat and the like, so it is
+# only imported once the arguments are parsed; --help stays fast
 
 # https://github.com/pallets/click/issues/85#issuecomment-43378930
 def coro(f):
-    f = asyncio.coroutine(f)
     def wrapper(*args, **kwargs):
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(f(*args, **kwargs))
+        return asyncio.run(f(*args, **kwargs))
     return update_wrapper(wrapper, f)
 
 @click.command()
@@ -30,15 +28,105 @@ def coro(f):
               help="Maximum execution time (in second) for each notebook.")
 @click.option("--binder-start-timeout", default=600,
               help="Maximum time (in seconds) to wait for binder to start.")
+@click.option("--history-file", type=click.Path(dir_okay=False),
+              help="SQLite file in which to record binder launches, to show "
+                   "an ETA and warn about slow builds in later runs.")
+@click.option("--auto-start-timeout", is_flag=True,
+              help="Set the binder start timeout from the launches recorded "
+                   "in --history-file, once there are enough of them.")
 @click.option("--pass-env-var", "-e", multiple=True,
               help="Environment variables to pass to the binder execution environment.")
 @click.option("--download/--no-download", default=True,
               help="Whether to use download the executed notebooks.")
+@click.option("--validate/--no-validate", default=False,
+              help="Whether to check that the notebooks are valid, before "
+                   "uploading and after downloading them.")
+@click.option("--strip-metadata", is_flag=True,
+              help="Drop the notebook and cell metadata that running the "
+                   "notebooks does not need, e.g. widget state and extension "
+                   "settings, before uploading them.")
+@click.option("--max-output-size", type=click.IntRange(min=0),
+              help="Truncate text outputs and drop other outputs bigger than "
+                   "this many characters.")
+@click.option("--drop-mime-type", "drop_mime_types", multiple=True,
+              help="Mime type of outputs to drop, e.g. 'image/png' or 'image/*'.")
+@click.option("--strip-widget-state", is_flag=True,
+              help="Drop the saved state of interactive widgets.")
+@click.option("--concurrency", default=1, type=click.IntRange(min=1),
+              help="Number of notebooks to execute at once on the binder.")
+@click.option("--pipeline/--no-pipeline", default=False,
+              help="Whether to upload and download notebooks while others "
+                   "execute, instead of one step after the other.")
+@click.option("--kernel-pool-size", default=0, type=click.IntRange(min=0),
+              help="Number of idle kernels to keep started in advance, and "
+                   "run each notebook on one of them, with --engine client. "
+                   "0 for no pool.")
+@click.option("--kernel-max-uses", type=click.IntRange(min=1),
+              help="Notebooks a pooled kernel runs before it is replaced.")
+@click.option("--kernel-max-memory", type=click.IntRange(min=1),
+              help="Memory (in MiB) above which a pooled kernel is replaced.")
+@click.option("--servers", default=1, type=click.IntRange(min=1),
+              help="Number of binders to launch and spread the notebooks over.")
+@click.option("--engine", default="nbconvert",
+              type=click.Choice(["nbconvert", "client", "zygote"]),
+              help="Run notebooks with nbconvert inside the binder, send "
+                   "them cell by cell from binderbot, or run them in forks "
+                   "of a process that has imported the --preload modules.")
+@click.option("--preload", multiple=True,
+              help="Module to import once in the binder for all notebooks, "
+                   "with --engine zygote.")
+@click.option("--cache/--no-cache", default=True,
+              help="Whether to reuse saved results of unchanged notebooks.")
+@click.option("--cache-dir", type=click.Path(file_okay=False, dir_okay=True),
+              help="Directory for cached results (default ~/.cache/binderbot).")
+@click.option("--session-file", type=click.Path(dir_okay=False),
+              help="File in which to save running binders. Saved binders for "
+                   "the same repo and ref are reused and left running.")
+@click.option("--upload-file", "upload_files", multiple=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help="Extra file, e.g. data, to upload to the binder before "
+                   "running the notebooks.")
+@click.option("--batch-upload/--no-batch-upload", default=False,
+              help="Whether to upload all notebooks and extra files in one "
+                   "archive, instead of one request each.")
+@click.option("--batch-download/--no-batch-download", default=False,
+              help="Whether to download all executed notebooks in one "
+                   "compressed archive once they have all run.")
+@click.option("--download-artifact", "artifacts", multiple=True,
+              help="Glob pattern of files produced in the binder to download "
+                   "with the notebooks, with --batch-download.")
+@click.option("--pool-size", default=100, type=click.IntRange(min=0),
+              help="Maximum number of open HTTP connections, 0 for no limit.")
+@click.option("--pool-size-per-host", default=0, type=click.IntRange(min=0),
+              help="Maximum number of open HTTP connections to one host, "
+                   "0 for no limit.")
+@click.option("--keepalive-timeout", default=30.0,
+              help="Seconds an idle HTTP connection is kept for reuse.")
+@click.option("--dns-cache-ttl", default=300,
+              help="Seconds DNS lookups are cached.")
+@click.option("--max-retries", default=3, type=click.IntRange(min=0),
+              help="Times to retry an operation failing for a transient "
+                   "reason, like a dropped connection or a 503 response.")
+@click.option("--trace-file", type=click.Path(dir_okay=False),
+              help="File in which to write the timed phases of the run as a "
+                   "Chrome trace.")
 @click.argument('filenames', nargs=-1, type=click.Path(exists=True))
 @coro
 async def main(binder_url, repo, ref, output_dir, nb_timeout,
-               binder_start_timeout, pass_env_var, download, filenames):
+               binder_start_timeout, history_file, auto_start_timeout,
+               pass_env_var, download, validate, strip_metadata,
+               max_output_size, drop_mime_types, strip_widget_state,
+               concurrency, pipeline, kernel_pool_size, kernel_max_uses,
+               kernel_max_memory, servers, engine, preload, cache, cache_dir,
+               session_file, upload_files, batch_upload, batch_download, artifacts,
+               pool_size, pool_size_per_host, keepalive_timeout, dns_cache_ttl,
+               max_retries, trace_file, filenames):
     """Run local notebooks on a remote binder."""
+    from .binderbot import DEFAULT_RETRY_POLICIES, RunOptions, run_on_binders
+    from .cache import ResultCache
+    from .history import BuildHistory
+    from .sessions import SessionStore
+    from .trace import Tracer
 
     # validate filename inputs
     non_notebook_files = [fname for fname in filenames
@@ -55,23 +143,79 @@ async def main(binder_url, repo, ref, output_dir, nb_timeout,
 
     extra_env_vars = {k: os.environ[k] for k in pass_env_var}
 
+    # results are only cached when the notebooks are saved
+    result_cache = ResultCache(cache_dir) if cache and download else None
+
+    session_store = SessionStore(session_file) if session_file else None
+
+    history = BuildHistory(history_file) if history_file else None
+    if auto_start_timeout:
+        if history is None:
+            raise click.UsageError("--auto-start-timeout needs --history-file")
+        suggested = history.suggest_timeout(binder_url, repo, ref)
+        if suggested is not None:
+            binder_start_timeout = suggested
+            click.echo(f"✅ Binder start timeout set to {suggested}s from past launches")
+
+    # outputs are trimmed in the binder, before they are downloaded
+    trim = {}
+    if max_output_size is not None:
+        trim['max_output_size'] = max_output_size
+    if drop_mime_types:
+        trim['drop_mime_types'] = list(drop_mime_types)
+    if strip_widget_state:
+        trim['strip_widget_state'] = True
+
+    kernel_pool = None
+    if kernel_pool_size and engine != 'client':
+        # other engines start a kernel of their own for each notebook
+        raise click.UsageError("--kernel-pool-size needs --engine client")
+    if kernel_pool_size:
+        kernel_pool = {'size': kernel_pool_size, 'max_uses': kernel_max_uses,
+                       'max_memory': kernel_max_memory and kernel_max_memory * 1024 ** 2}
+    elif kernel_max_uses or kernel_max_memory:
+        raise click.UsageError("--kernel-max-uses and --kernel-max-memory "
+                               "need --kernel-pool-size")
+
+    options = RunOptions(nb_timeout=nb_timeout, extra_env_vars=extra_env_vars,
+                         download=download, output_dir=output_dir, engine=engine,
+                         preload=preload, validate=validate,
+                         strip_metadata=strip_metadata, trim=trim or None,
+                         batch_upload=batch_upload, batch_download=batch_download,
+                         artifacts=artifacts)
+
+    retry_policies = {name: policy.replace(max_retries=max_retries)
+                      for name, policy in DEFAULT_RETRY_POLICIES.items()}
+
+    tracer = Tracer()
+
     # inputs look good, start up binder
-    async with BinderUser(binder_url, repo, ref) as jovyan:
-        errors = await jovyan.run(filenames,
-                                  binder_start_timeout=binder_start_timeout,
-                                  nb_timeout=nb_timeout,
-                                  extra_env_vars=extra_env_vars,
-                                  download=download,
-                                  output_dir=output_dir)
-
-        await jovyan.stop_kernel()
-
-        if len(errors) > 0:
-            raise RuntimeError(str(errors))
-
-        # TODO: shut down binder
-        # await jovyan.shutdown_binder()
-        # can we do this with a context manager so that it shuts down in case of errors?
+    try:
+        errors = await run_on_binders(binder_url, repo, ref, filenames,
+                                      options=options,
+                                      servers=servers,
+                                      binder_start_timeout=binder_start_timeout,
+                                      concurrency=concurrency,
+                                      pipeline=pipeline,
+                                      kernel_pool=kernel_pool,
+                                      cache=result_cache,
+                                      session_store=session_store,
+                                      upload_files=upload_files,
+                                      connector_options={
+                                          'limit': pool_size,
+                                          'limit_per_host': pool_size_per_host,
+                                          'keepalive_timeout': keepalive_timeout,
+                                          'ttl_dns_cache': dns_cache_ttl},
+                                      retry_policies=retry_policies,
+                                      history=history,
+                                      tracer=tracer)
+    finally:
+        if trace_file:
+            tracer.write(trace_file)
+            click.echo(f"✅ Trace written to {trace_file}")
+
+    if len(errors) > 0:
+        raise RuntimeError(str(errors))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+"""HTTP connection pooling shared between binder users.
+
+Every ``BinderUser`` has its own ``aiohttp.ClientSession``, so cookies
+stay separate, but sessions can share one connector. Users talking to the
+same hub then reuse each other's keep-alive connections and cached DNS
+lookups, and stay within one overall connection limit.
+"""
+
+import aiohttp
+
+USER_AGENT = 'BinderBot-cli v0.1'
+
+
+def make_connector(limit=100, limit_per_host=0, keepalive_timeout=30,
+                   ttl_dns_cache=300):
+    """Create a connector that can be shared by many sessions.
+
+    limit - total number of open connections (0 for no limit)
+    limit_per_host - open connections to one host (0 for no limit)
+    keepalive_timeout - seconds an idle connection is kept for reuse
+    ttl_dns_cache - seconds DNS lookups are cached
+    """
+    return aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                keepalive_timeout=keepalive_timeout,
+                                ttl_dns_cache=ttl_dns_cache)
+
+
+def make_session(connector=None):
+    """Create a client session, using a shared ``connector`` if given.
+
+    A shared connector is left open when the session closes.
+    """
+    if connector is None:
+        connector = make_connector()
+        owner = True
+    else:
+        owner = False
+    return aiohttp.ClientSession(connector=connector, connector_owner=owner,
+                                 headers={'User-Agent': USER_AGENT})
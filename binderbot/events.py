@@ -0,0 +1,65 @@
+"""Parsing of the server-sent events stream reporting a binder build.
+
+https://html.spec.whatwg.org/multipage/server-sent-events.html
+"""
+
+
+class Event:
+    """One dispatched event: its type, data and the id last seen."""
+
+    def __init__(self, event='message', data='', id=None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    def __repr__(self):
+        return f'Event({self.event!r}, {self.data!r}, id={self.id!r})'
+
+
+class EventStreamParser:
+    """Turn the lines of an event stream into events.
+
+    Fields accumulate until a blank line dispatches the event, so ``data``
+    may span several lines. Comment lines are heartbeats and are only
+    counted. The last event id is kept across ``reset``, so that a
+    reconnection can ask to resume after it.
+    """
+
+    def __init__(self):
+        self.last_event_id = None
+        # reconnection delay asked for by the server, in seconds
+        self.retry = None
+        self.heartbeats = 0
+        self.reset()
+
+    def reset(self):
+        """Drop a partly received event, e.g. when the connection is lost."""
+        self._event = None
+        self._data = []
+
+    def feed(self, line):
+        """Feed one line and return the event it completes, if any."""
+        line = line.rstrip('\r\n')
+        if not line:
+            if not self._data:
+                self.reset()
+                return None
+            event = Event(self._event or 'message', '\n'.join(self._data),
+                          self.last_event_id)
+            self.reset()
+            return event
+        if line.startswith(':'):
+            self.heartbeats += 1
+            return None
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            self._data.append(value)
+        elif field == 'event':
+            self._event = value
+        elif field == 'id' and '\0' not in value:
+            self.last_event_id = value
+        elif field == 'retry' and value.isdigit():
+            self.retry = int(value) / 1000
+        return None
@@ -0,0 +1,158 @@
+"""A history of binder launches, for telling how long the next one takes.
+
+Each launch records when the build reached every phase reported by the
+event stream (waiting, building, pushing, launching, ready), keyed by
+binder url, repo and ref, in a SQLite database. Later launches of the same
+repo use it to show an ETA and to warn about an abnormally slow build, and
+it can suggest a binder start timeout from the observed launch times.
+"""
+
+import math
+import pathlib
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS launches (
+    id INTEGER PRIMARY KEY,
+    binder_url TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS launches_by_repo
+    ON launches (binder_url, repo, ref, outcome, started_at);
+CREATE TABLE IF NOT EXISTS phases (
+    launch_id INTEGER NOT NULL REFERENCES launches (id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_by_launch ON phases (launch_id);
+"""
+
+
+def percentile(values, q):
+    """The ``q``-th percentile of ``values`` by the nearest-rank method."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Launch:
+    """A past successful launch: its duration and when each phase started.
+
+    Phase times are in seconds after the launch started.
+    """
+
+    def __init__(self, duration, phases):
+        self.duration = duration
+        self.phases = phases
+
+    def remaining(self, phase):
+        """Seconds it took from reaching ``phase`` to being ready, or None."""
+        at = self.phases.get(phase)
+        return None if at is None else self.duration - at
+
+
+def estimate_remaining(launches, phase, elapsed):
+    """Median seconds left before the server is ready, or None.
+
+    Based on how long the past ``launches`` took from reaching ``phase``,
+    or from their start if none of them went through that phase.
+    """
+    remaining = [r for r in (launch.remaining(phase) for launch in launches)
+                 if r is not None]
+    if remaining:
+        return max(0.0, percentile(remaining, 50))
+    if launches:
+        return max(0.0, percentile([launch.duration for launch in launches], 50) - elapsed)
+    return None
+
+
+def slow_launch_threshold(launches, q=90, min_launches=5):
+    """Seconds after which a launch is slower than usual, or None.
+
+    That is the ``q``-th percentile of the past launch times, once there
+    are at least ``min_launches`` of them.
+    """
+    if len(launches) < min_launches:
+        return None
+    return percentile([launch.duration for launch in launches], q)
+
+
+class BuildHistory:
+    """Past binder launches saved in a SQLite database.
+
+    path - database file, created if missing
+    window - number of recent successful launches estimates are based on
+    """
+
+    def __init__(self, path, window=50):
+        self.path = pathlib.Path(path)
+        self.window = window
+
+    @staticmethod
+    def _key(binder_url, repo, ref):
+        return str(binder_url).rstrip('/'), repo, ref
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # several binderbot processes may share the file
+        db = sqlite3.connect(str(self.path), timeout=30)
+        db.execute('PRAGMA foreign_keys = ON')
+        db.executescript(_SCHEMA)
+        return db
+
+    def record(self, binder_url, repo, ref, started_at, duration, phases, outcome):
+        """Save a launch.
+
+        started_at - when the launch started, as a Unix time
+        duration - seconds until the server was ready or the launch gave up
+        phases - ``(phase, seconds after the start)`` of each phase change
+        outcome - ``'ready'`` if the server started, else why it did not
+        """
+        db = self._connect()
+        try:
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO launches (binder_url, repo, ref, started_at, duration, outcome) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    self._key(binder_url, repo, ref) + (started_at, duration, outcome))
+                db.executemany('INSERT INTO phases (launch_id, phase, at) VALUES (?, ?, ?)',
+                               [(cursor.lastrowid, phase, at) for phase, at in phases])
+        finally:
+            db.close()
+
+    def launches(self, binder_url, repo, ref):
+        """The most recent successful launches, as a list of ``Launch``."""
+        db = self._connect()
+        try:
+            rows = db.execute(
+                'SELECT id, duration FROM launches '
+                'WHERE binder_url = ? AND repo = ? AND ref = ? AND outcome = ? '
+                'ORDER BY started_at DESC LIMIT ?',
+                self._key(binder_url, repo, ref) + ('ready', self.window)).fetchall()
+            launches = []
+            for launch_id, duration in rows:
+                phases = {}
+                for phase, at in db.execute('SELECT phase, at FROM phases '
+                                            'WHERE launch_id = ? ORDER BY at', (launch_id,)):
+                    # a phase may be reported several times, keep when it began
+                    phases.setdefault(phase, at)
+                launches.append(Launch(duration, phases))
+            return launches
+        finally:
+            db.close()
+
+    def suggest_timeout(self, binder_url, repo, ref, q=95, margin=1.5, min_launches=5):
+        """A binder start timeout in seconds from past launch times, or None.
+
+        That is ``margin`` times the ``q``-th percentile of the recent
+        launch times, once there are at least ``min_launches`` of them.
+        """
+        durations = [launch.duration for launch in self.launches(binder_url, repo, ref)]
+        if len(durations) < min_launches:
+            return None
+        return math.ceil(percentile(durations, q) * margin)
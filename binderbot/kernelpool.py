@@ -0,0 +1,127 @@
+"""A pool of kernels started ahead of time.
+
+Starting a kernel takes a few seconds, which otherwise adds up on every
+notebook that needs a fresh one. ``KernelPool`` keeps some kernels started
+and idle, hands them out to notebook workers, and replaces a kernel in the
+background once it has run enough notebooks or grown too big, so that
+kernel start latency is off the critical path.
+"""
+
+import asyncio
+import contextlib
+
+
+class KernelPool:
+    """Warm kernels of a started ``BinderUser``, recycled by use and memory.
+
+    size - idle kernels to keep started in advance
+    max_uses - notebooks a kernel runs before it is replaced, None for no limit
+    max_memory - bytes of memory above which a kernel is replaced once it is
+                 given back, None to never check
+
+    A kernel given back after a failure is always replaced, since it may be
+    stuck or left in an unknown state. The pool's kernels are started in
+    addition to the user's default kernel.
+    """
+
+    def __init__(self, user, size=1, max_uses=None, max_memory=None):
+        self.user = user
+        self.size = size
+        self.max_uses = max_uses
+        self.max_memory = max_memory
+        self.log = user.log
+        self._idle = asyncio.Queue()
+        # notebooks run by each kernel of the pool
+        self._uses = {}
+        self._starting = 0
+        self._tasks = set()
+        self._closed = False
+
+    def start(self):
+        """Start filling the pool in the background."""
+        self._refill()
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _refill(self):
+        while not self._closed and self._idle.qsize() + self._starting < self.size:
+            self._starting += 1
+            self._spawn(self._start_kernel())
+
+    async def _start_kernel(self):
+        try:
+            kernel_id = await self.user.start_kernel()
+        except Exception as e:
+            # handed to whoever waits, instead of leaving them waiting forever
+            self._idle.put_nowait(e)
+        else:
+            self._uses[kernel_id] = 0
+            self._idle.put_nowait(kernel_id)
+        finally:
+            self._starting -= 1
+
+    async def _stop_kernel(self, kernel_id):
+        self._uses.pop(kernel_id, None)
+        try:
+            await self.user.stop_kernel(kernel_id)
+        except Exception as e:
+            self.log.msg(f'Kernel pool: Stopping {kernel_id} failed {e}',
+                         action='kernel-pool', phase='stop-failed', kernel_id=kernel_id)
+
+    async def acquire(self):
+        """Take an idle kernel, waiting for one to start if needed."""
+        with self.user.tracer.span('kernel-acquire'):
+            self._refill()
+            kernel_id = await self._idle.get()
+        # replace the kernel taken, or the start that failed
+        self._refill()
+        if isinstance(kernel_id, Exception):
+            raise kernel_id
+        return kernel_id
+
+    async def release(self, kernel_id, failed=False):
+        """Give a kernel back, replacing it if it is due for recycling."""
+        self._uses[kernel_id] += 1
+        reason = None
+        if failed:
+            reason = 'failed'
+        elif self.max_uses is not None and self._uses[kernel_id] >= self.max_uses:
+            reason = 'uses'
+        elif self.max_memory is not None:
+            try:
+                if await self.user.kernel_memory(kernel_id) > self.max_memory:
+                    reason = 'memory'
+            except Exception:
+                reason = 'failed'
+        if reason is None and not self._closed:
+            self._idle.put_nowait(kernel_id)
+            return
+        self.log.msg(f'Kernel pool: Recycling {kernel_id}', action='kernel-pool',
+                     phase='recycle', kernel_id=kernel_id, reason=reason,
+                     uses=self._uses[kernel_id])
+        self._spawn(self._stop_kernel(kernel_id))
+        self._refill()
+
+    @contextlib.asynccontextmanager
+    async def kernel(self):
+        """Borrow a kernel for the duration of the ``async with`` block."""
+        kernel_id = await self.acquire()
+        failed = True
+        try:
+            yield kernel_id
+            failed = False
+        finally:
+            await self.release(kernel_id, failed=failed)
+
+    async def close(self):
+        """Stop the idle kernels, once those still starting have started."""
+        self._closed = True
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        while not self._idle.empty():
+            kernel_id = self._idle.get_nowait()
+            if not isinstance(kernel_id, Exception):
+                await self._stop_kernel(kernel_id)
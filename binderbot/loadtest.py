@@ -0,0 +1,230 @@
+"""Load test a BinderHub with simulated users.
+
+Each simulated user launches a binder, starts a kernel, runs some code,
+stops the kernel and shuts the binder down, like the hubtraf users that
+``BinderUser`` was adapted from. Users arrive spread evenly over a ramp-up
+period, or at random at a given mean arrival rate, and the latencies and
+failures of each phase are summarized at the end::
+
+    binderbot-loadtest --repo binder-examples/requirements --users 20 --ramp-up 60
+"""
+
+import asyncio
+import json
+import random
+import sys
+import time
+
+import click
+
+from .binderbot import DEFAULT_RETRY_POLICIES, BinderUser
+from .connection import make_connector
+from .history import percentile
+from .trace import Tracer
+
+# phases each user goes through, in order
+PHASES = ('start_binder', 'start_kernel', 'run_code', 'stop_kernel')
+
+DEFAULT_CODE = "import time; time.sleep(1); print('hello')"
+
+
+def arrival_times(users, ramp_up=0, arrival_rate=None, seed=None):
+    """Seconds after the start at which each user arrives.
+
+    With an ``arrival_rate`` (users per second) arrivals are a Poisson
+    process, otherwise they are spread evenly over ``ramp_up`` seconds.
+    """
+    if arrival_rate:
+        rng = random.Random(seed)
+        times, t = [], 0.0
+        for _ in range(users):
+            times.append(t)
+            t += rng.expovariate(arrival_rate)
+        return times
+    if users <= 1:
+        return [0.0] * users
+    return [ramp_up * n / (users - 1) for n in range(users)]
+
+
+async def simulate_user(n, binder_url, repo, ref, code, results, origin,
+                        binder_start_timeout=600, tracer=None, connector=None,
+                        max_retries=0):
+    """Take one user through all phases, appending a result per phase.
+
+    Each result is a dict with the ``user``, ``phase``, ``start`` and
+    ``end`` times in seconds since ``origin`` and whether it succeeded.
+    A failed phase ends the user's session. Operations are retried up to
+    ``max_retries`` times, by default never, so that failures are counted
+    instead of hidden by retries.
+    """
+    retry_policies = {name: policy.replace(max_retries=max_retries)
+                      for name, policy in DEFAULT_RETRY_POLICIES.items()}
+    async with BinderUser(binder_url, repo, ref, tracer=tracer, connector=connector,
+                          retry_policies=retry_policies) as jovyan:
+        calls = {
+            'start_binder': lambda: jovyan.start_binder(timeout=binder_start_timeout),
+            'start_kernel': jovyan.start_kernel,
+            'run_code': lambda: jovyan.run_code(code),
+            'stop_kernel': jovyan.stop_kernel,
+        }
+        try:
+            for phase in PHASES:
+                start = time.monotonic()
+                try:
+                    await calls[phase]()
+                except Exception as e:
+                    results.append({'user': n, 'phase': phase, 'ok': False,
+                                    'start': start - origin,
+                                    'end': time.monotonic() - origin,
+                                    'error': repr(e)})
+                    return False
+                results.append({'user': n, 'phase': phase, 'ok': True,
+                                'start': start - origin,
+                                'end': time.monotonic() - origin})
+            return True
+        finally:
+            await jovyan.teardown()
+
+
+async def run_loadtest(binder_url, repo, ref, users, ramp_up=0, arrival_rate=None,
+                       code=DEFAULT_CODE, binder_start_timeout=600, seed=None,
+                       tracer=None, connector_options=None, max_retries=0):
+    """Run ``users`` simulated users and return the results of their phases.
+
+    The users share one connection pool, created with
+    ``make_connector(**connector_options)``, and retry operations up to
+    ``max_retries`` times.
+    """
+    results = []
+    origin = time.monotonic()
+
+    async def arrive(n, at):
+        await asyncio.sleep(at)
+        print(f"⌛️ User {n} arriving", flush=True)
+        if await simulate_user(n, binder_url, repo, ref, code, results, origin,
+                               binder_start_timeout=binder_start_timeout,
+                               tracer=tracer, connector=connector,
+                               max_retries=max_retries):
+            print(f"✅ User {n} done", flush=True)
+        else:
+            print(f"❌ User {n} failed", flush=True)
+
+    times = arrival_times(users, ramp_up, arrival_rate, seed)
+    connector = make_connector(**(connector_options or {}))
+    try:
+        await asyncio.gather(*[arrive(n, at) for n, at in enumerate(times)])
+    finally:
+        await connector.close()
+    return results
+
+
+def summarize(results, interval=10):
+    """Latency percentiles and failure rates per phase, and throughput.
+
+    Throughput is the number of users completing all phases, and the
+    number failing, in each ``interval`` seconds of the test.
+    """
+    phases = {}
+    for phase in PHASES:
+        done = [r for r in results if r['phase'] == phase]
+        latencies = [r['end'] - r['start'] for r in done if r['ok']]
+        failures = sum(not r['ok'] for r in done)
+        phases[phase] = {
+            'count': len(done),
+            'failures': failures,
+            'failure_rate': failures / len(done) if done else 0.0,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+        }
+
+    # a user ends with its last phase, successful or not
+    ends = {}
+    for r in results:
+        if r['user'] not in ends or r['end'] > ends[r['user']]['end']:
+            ends[r['user']] = r
+    n_buckets = int(max((r['end'] for r in ends.values()), default=0) // interval) + 1
+    throughput = [{'start': b * interval, 'completed': 0, 'failed': 0}
+                  for b in range(n_buckets)]
+    for r in ends.values():
+        bucket = throughput[int(r['end'] // interval)]
+        if r['ok'] and r['phase'] == PHASES[-1]:
+            bucket['completed'] += 1
+        else:
+            bucket['failed'] += 1
+    return {'users': len(ends), 'phases': phases, 'throughput': throughput}
+
+
+def format_summary(summary):
+    def fmt(value):
+        return f'{value:8.3f}' if value is not None else f'{"-":>8}'
+
+    lines = [f"{'phase':<14}{'count':>7}{'failed':>8}{'p50':>9}{'p90':>9}{'p99':>9}"]
+    for phase, stats in summary['phases'].items():
+        lines.append(f"{phase:<14}{stats['count']:>7}"
+                     f"{stats['failure_rate']:>7.0%} "
+                     f"{fmt(stats['p50'])} {fmt(stats['p90'])} {fmt(stats['p99'])}")
+    lines.append('')
+    lines.append(f"{'time (s)':<14}{'completed':>10}{'failed':>8}")
+    for bucket in summary['throughput']:
+        lines.append(f"{bucket['start']:<14g}{bucket['completed']:>10}{bucket['failed']:>8}")
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--binder-url', default='https://binder.pangeo.io',
+              help='URL of binder service.')
+@click.option('--repo', help='The GitHub repo to use for the binder image.')
+@click.option('--ref', default='master',
+              help='The branch or commit`.')
+@click.option('--users', default=10, type=click.IntRange(min=1),
+              help='Number of simulated users.')
+@click.option('--ramp-up', default=0.0,
+              help='Seconds over which the users arrive, evenly spread.')
+@click.option('--arrival-rate', type=float,
+              help='Mean users arriving per second, at random. Overrides --ramp-up.')
+@click.option('--code', default=DEFAULT_CODE,
+              help='Code each user runs on its kernel.')
+@click.option("--binder-start-timeout", default=600,
+              help="Maximum time (in seconds) to wait for binder to start.")
+@click.option('--interval', default=10.0,
+              help='Seconds per bucket when reporting throughput over time.')
+@click.option('--seed', type=int, help='Random seed for the arrival times.')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='File in which to write the results and summary as JSON.')
+@click.option("--pool-size", default=100, type=click.IntRange(min=0),
+              help="Maximum number of open HTTP connections, 0 for no limit.")
+@click.option("--pool-size-per-host", default=0, type=click.IntRange(min=0),
+              help="Maximum number of open HTTP connections to one host, "
+                   "0 for no limit.")
+@click.option("--max-retries", default=0, type=click.IntRange(min=0),
+              help="Times to retry an operation failing for a transient "
+                   "reason. By default failures are not retried, but counted.")
+@click.option("--trace-file", type=click.Path(dir_okay=False),
+              help="File in which to write the timed phases of all users as a "
+                   "Chrome trace.")
+def main(binder_url, repo, ref, users, ramp_up, arrival_rate, code,
+         binder_start_timeout, interval, seed, output, pool_size,
+         pool_size_per_host, max_retries, trace_file):
+    """Load test a BinderHub with simulated users."""
+    tracer = Tracer()
+    results = asyncio.run(run_loadtest(binder_url, repo, ref, users,
+                                       ramp_up=ramp_up, arrival_rate=arrival_rate,
+                                       code=code,
+                                       binder_start_timeout=binder_start_timeout,
+                                       seed=seed, tracer=tracer,
+                                       max_retries=max_retries,
+                                       connector_options={
+                                           'limit': pool_size,
+                                           'limit_per_host': pool_size_per_host}))
+    summary = summarize(results, interval=interval)
+    click.echo(format_summary(summary))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'summary': summary, 'results': results}, f, indent=1)
+    if trace_file:
+        tracer.write(trace_file)
+
+
+if __name__ == "__main__":
+    sys.exit(main())  # pragma: no cover
@@ -0,0 +1,74 @@
+"""Trimming of notebook outputs.
+
+Executed notebooks can carry huge outputs (images, dashboards, reprs of big
+objects) that are not needed when all that matters is whether they ran.
+``trim_outputs`` shrinks them. It is run inside the binder on notebooks
+executed there, before they are downloaded, so it only uses the standard
+library and is sent over as source code.
+"""
+
+import inspect
+
+
+def trim_outputs(nb, max_output_size=None, drop_mime_types=(),
+                 strip_widget_state=False):
+    """Shrink the outputs of notebook ``nb`` in place.
+
+    max_output_size - characters above which a stream or ``text/plain``
+                      output is truncated and any other mime type dropped
+    drop_mime_types - mime types to drop, may use wildcards like ``image/*``
+    strip_widget_state - drop the ipywidgets state saved in the metadata
+
+    Removed outputs are replaced by a note saying so. Returns the number
+    of characters removed.
+    """
+    import fnmatch
+    import json
+
+    def size(value):
+        return len(value) if isinstance(value, str) else len(json.dumps(value))
+
+    def note(removed, what):
+        return f'[{removed} characters of {what} removed by binderbot]'
+
+    def truncate(text, what):
+        if isinstance(text, list):
+            text = ''.join(text)
+        removed = len(text) - max_output_size
+        return text[:max_output_size] + '\n' + note(removed, what) + '\n', removed
+
+    removed = 0
+    if strip_widget_state:
+        state = nb.get('metadata', {}).pop('widgets', None)
+        if state is not None:
+            removed += size(state)
+
+    for cell in nb.get('cells', []):
+        for output in cell.get('outputs', []):
+            if output.get('output_type') == 'stream':
+                if max_output_size is not None and size(output['text']) > max_output_size:
+                    output['text'], n = truncate(output['text'], 'output')
+                    removed += n
+                continue
+            data = output.get('data')
+            if not data:
+                continue
+            dropped = {}
+            for mime in list(data):
+                too_big = max_output_size is not None and size(data[mime]) > max_output_size
+                if too_big and mime == 'text/plain':
+                    data[mime], n = truncate(data[mime], mime)
+                    removed += n
+                elif too_big or any(fnmatch.fnmatch(mime, pattern)
+                                    for pattern in drop_mime_types):
+                    dropped[mime] = size(data.pop(mime))
+                    output.get('metadata', {}).pop(mime, None)
+            removed += sum(dropped.values())
+            if dropped and 'text/plain' not in data:
+                data['text/plain'] = note(sum(dropped.values()), ', '.join(dropped))
+    return removed
+
+
+def trim_outputs_source():
+    """Source code defining ``trim_outputs``, for running it in a binder."""
+    return inspect.getsource(trim_outputs)
@@ -0,0 +1,110 @@
+"""Retrying operations that fail for transient reasons.
+
+A binder launch can take many minutes, so a single dropped connection or
+overloaded proxy should not throw it away. ``RetryPolicy`` retries an
+operation after connection errors, timeouts and server errors (5xx and
+429), waiting with exponential backoff and full jitter, and honouring
+``Retry-After`` when the server sends it. Other errors are raised at once.
+A request that isn't idempotent, like starting a kernel, is only retried
+when it can't have been handled, so that it doesn't take effect twice.
+"""
+
+import asyncio
+import email.utils
+import random
+import time
+
+import aiohttp
+
+RETRIABLE_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+# statuses for requests refused before being handled
+UNHANDLED_STATUSES = frozenset([429, 503])
+
+
+def is_retriable(error, idempotent=True):
+    """Whether ``error`` is transient, so that trying again may work.
+
+    A request that isn't ``idempotent`` may have been handled despite a
+    timeout or server error, so it's only retried if it never reached the
+    server, or was refused with 429 or 503.
+    """
+    if not idempotent:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in UNHANDLED_STATUSES
+        return isinstance(error, aiohttp.ClientConnectorError)
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRIABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                              asyncio.TimeoutError))
+
+
+def retry_after(error):
+    """Seconds to wait that the server asked for with ``Retry-After``, or None."""
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """How often and how long to retry an operation.
+
+    max_retries - retries after the first attempt, 0 to never retry
+    base_delay - seconds to wait before the first retry, doubled each time
+    max_delay - longest wait between two attempts
+    budget - seconds after the first attempt beyond which no retry starts
+    """
+
+    def __init__(self, max_retries=3, base_delay=1, max_delay=30, budget=120):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    def replace(self, **changes):
+        """Return a copy of the policy with some settings changed."""
+        settings = dict(max_retries=self.max_retries, base_delay=self.base_delay,
+                        max_delay=self.max_delay, budget=self.budget)
+        settings.update(changes)
+        return RetryPolicy(**settings)
+
+    def delay(self, retry, error=None):
+        """Seconds to wait before retry number ``retry`` (from 0)."""
+        # full jitter keeps many clients from retrying in lockstep
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        requested = retry_after(error)
+        if requested is not None:
+            delay = max(delay, min(requested, self.max_delay))
+        return delay
+
+    async def call(self, operation, fn, log, tracer, idempotent=True):
+        """Await ``fn()``, retrying it after transient errors.
+
+        Each retry is logged and the waits are recorded in ``tracer`` as
+        ``retry-wait`` spans. The last error is raised once retries or the
+        budget run out. See ``is_retriable`` for ``idempotent``.
+        """
+        start_time = time.monotonic()
+        retry = 0
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                if not is_retriable(e, idempotent) or retry >= self.max_retries:
+                    raise
+                delay = self.delay(retry, e)
+                if time.monotonic() - start_time + delay > self.budget:
+                    raise
+                retry += 1
+                log.msg(f'Retry: {operation} failed ({e!r}), retry {retry} in {delay:.1f}s',
+                        action='retry', phase=operation, retry=retry, delay=delay)
+                with tracer.span('retry-wait', operation=operation, retry=retry):
+                    await asyncio.sleep(delay)
@@ -0,0 +1,61 @@
+"""A small file-backed store of running binder servers.
+
+Saving the notebook url and token of a binder lets later invocations for
+the same repo and ref reuse the server instead of launching a new one, as
+long as the ref still points to the commit the server was launched from.
+"""
+
+import json
+import os
+import pathlib
+import time
+
+
+class SessionStore:
+    """Binder servers saved in a JSON file, keyed by binder url, repo and ref.
+
+    Several servers can be saved for the same key, one per ``slot``, so
+    that sharded runs can reuse all of their binders. The file holds
+    tokens, so it is only readable by its owner.
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    @staticmethod
+    def _key(binder_url, repo, ref):
+        return f"{str(binder_url).rstrip('/')} {repo} {ref}"
+
+    def _load(self):
+        try:
+            with self.path.open() as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, sessions):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(sessions, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def get(self, binder_url, repo, ref, slot=0):
+        """Return the saved ``{'notebook_url', 'token', 'sha'}`` for a slot, or None."""
+        servers = self._load().get(self._key(binder_url, repo, ref), {})
+        return servers.get(str(slot))
+
+    def put(self, binder_url, repo, ref, notebook_url, token, slot=0, sha=None):
+        """Save a server, launched from commit ``sha`` of the ref."""
+        sessions = self._load()
+        servers = sessions.setdefault(self._key(binder_url, repo, ref), {})
+        servers[str(slot)] = {'notebook_url': str(notebook_url), 'token': token,
+                              'sha': sha, 'saved_at': time.time()}
+        self._save(sessions)
+
+    def remove(self, binder_url, repo, ref, slot=0):
+        sessions = self._load()
+        servers = sessions.get(self._key(binder_url, repo, ref), {})
+        if servers.pop(str(slot), None) is not None:
+            self._save(sessions)
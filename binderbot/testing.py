@@ -0,0 +1,521 @@
+"""An offline stand-in for a BinderHub and the Jupyter servers it launches.
+
+``MockBinderHub`` serves the parts of both APIs that binderbot uses:
+
+* ``/build/gh/<repo>/<ref>``, an event stream going through configurable
+  phases before reporting a ready server with its url and token
+* ``api/status``, ``api/kernels`` (with interrupts), ``api/contents``,
+  ``api/shutdown`` and ``files`` on each launched server, which refuse
+  hidden paths like jupyter_server does
+* the kernel ``channels`` websocket, backed by a tiny executor
+
+Every kernel is a small Python process running in the server's own
+directory, so code runs with a working directory and environment separate
+from the caller's, much like on a real binder. It runs code with ``exec``,
+streams stdout and stderr as they are written, and reports the value of a
+trailing expression as an ``execute_result``.
+
+The hub can be used as an async context manager, or as a regular context
+manager that runs it on a background thread, which is handy for driving
+``cli.main`` from a synchronous test::
+
+    with MockBinderHub(tmp_path, phases=[('building', 0.1)]) as hub:
+        runner.invoke(cli.main, ['--binder-url', hub.url, ...])
+
+It can also run in its own process, printing its url on the first line::
+
+    python -m binderbot.testing /tmp/hub --phase building:5 --latency 0.05
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import threading
+import uuid
+import base64
+import signal
+
+import click
+from aiohttp import web
+
+_EXECUTOR_SOURCE = r'''
+import ast, json, os, sys, traceback
+
+# keep the real stdout for the protocol; anything else writing to fd 1
+# (e.g. nested kernels) must not corrupt it
+proto = os.fdopen(os.dup(1), 'w')
+os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+
+
+def emit(**msg):
+    proto.write(json.dumps(msg) + '\n')
+    proto.flush()
+
+
+class Stream:
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, text):
+        if text:
+            emit(type='stream', name=self.name, text=text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+sys.stdout = Stream('stdout')
+sys.stderr = Stream('stderr')
+namespace = {'__name__': '__main__'}
+count = 0
+while True:
+    try:
+        line = sys.stdin.readline()
+    except KeyboardInterrupt:
+        # an interrupt between cells does nothing, like in a real kernel
+        continue
+    if not line:
+        break
+    code = json.loads(line)['code']
+    count += 1
+    emit(type='execute_input', execution_count=count)
+    try:
+        tree = ast.parse(code)
+        last = None
+        if tree.body and isinstance(tree.body[-1], ast.Expr):
+            last = ast.Expression(tree.body.pop().value)
+        exec(compile(tree, '<cell>', 'exec'), namespace)
+        if last is not None:
+            result = eval(compile(last, '<cell>', 'eval'), namespace)
+            if result is not None:
+                emit(type='execute_result', execution_count=count,
+                     data={'text/plain': repr(result)})
+    except (Exception, KeyboardInterrupt) as e:
+        emit(type='error', ename=type(e).__name__, evalue=str(e),
+             traceback=traceback.format_exception(type(e), e, e.__traceback__))
+        emit(type='done', status='error', execution_count=count)
+    else:
+        emit(type='done', status='ok', execution_count=count)
+'''
+
+
+class _MockKernel:
+    def __init__(self, cwd, env):
+        self.id = str(uuid.uuid4())
+        self.proc = subprocess.Popen([sys.executable, '-u', '-c', _EXECUTOR_SOURCE],
+                                     cwd=str(cwd), env=env,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = asyncio.Lock()
+
+    async def execute(self, code):
+        """Run code, yielding the executor's messages until it is done."""
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            self.proc.stdin.write((json.dumps({'code': code}) + '\n').encode('utf8'))
+            self.proc.stdin.flush()
+            while True:
+                line = await loop.run_in_executor(None, self.proc.stdout.readline)
+                if not line:
+                    yield {'type': 'error', 'ename': 'DeadKernel',
+                           'evalue': 'Kernel died', 'traceback': []}
+                    yield {'type': 'done', 'status': 'error', 'execution_count': None}
+                    return
+                msg = json.loads(line)
+                done = msg['type'] == 'done'
+                yield msg
+                if done:
+                    return
+
+    def kill(self):
+        self.proc.kill()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+
+class _MockBuild:
+    def __init__(self):
+        self.events = []
+        self.changed = asyncio.Condition()
+
+    async def emit(self, **data):
+        async with self.changed:
+            self.events.append(data)
+            self.changed.notify_all()
+
+
+class _MockServer:
+    def __init__(self, name, root, env):
+        self.name = name
+        self.token = uuid.uuid4().hex
+        self.root = root
+        self.env = env
+        self.kernels = {}
+        self.running = True
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def shutdown(self):
+        for kernel in self.kernels.values():
+            kernel.kill()
+        self.kernels.clear()
+        self.running = False
+
+
+class MockBinderHub:
+    """A local BinderHub and Jupyter server stand-in.
+
+    root_dir - directory under which each launched server gets its own folder
+    phases - ``(phase, delay)`` pairs reported by the build event stream
+    latency - seconds added to every HTTP request and every code execution
+    kernel_start_delay - extra seconds taken to start a kernel
+    fail_build - report a failed build instead of a ready server
+    env - environment of the kernels (default: a copy of ``os.environ``
+          taken when the hub is created)
+    max_body_size - largest request body accepted, like a proxy's limit
+    heartbeat_interval - seconds of silence after which the build event
+                         stream sends a heartbeat comment (default: never)
+    drop_build_streams - number of build event streams to cut after their
+                         first event, like a flaky proxy would
+    """
+
+    def __init__(self, root_dir, phases=(('waiting', 0), ('building', 0), ('launching', 0)),
+                 latency=0, kernel_start_delay=0, fail_build=False, env=None,
+                 max_body_size=2 * 1024 ** 2, heartbeat_interval=None,
+                 drop_build_streams=0):
+        self.root_dir = pathlib.Path(root_dir)
+        self.phases = list(phases)
+        self.latency = latency
+        self.kernel_start_delay = kernel_start_delay
+        self.fail_build = fail_build
+        self.env = dict(os.environ) if env is None else env
+        self.max_body_size = max_body_size
+        self.heartbeat_interval = heartbeat_interval
+        self.drop_build_streams = drop_build_streams
+        # builds by number, which lost event streams can reattach to
+        self._builds = {}
+        # requests to fail: [method, path regex, status, headers, number to skip]
+        self._faults = []
+        self.servers = {}
+        self.builds = 0
+        self.url = None
+        self._runner = None
+        self._loop = None
+        self._thread = None
+
+    def _make_app(self):
+        @web.middleware
+        async def add_latency(request, handler):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await handler(request)
+
+        @web.middleware
+        async def inject_faults(request, handler):
+            for fault in self._faults:
+                method, pattern, status, headers = fault[:4]
+                if method == request.method and re.search(pattern, request.path):
+                    if fault[4]:
+                        # let this one through
+                        fault[4] -= 1
+                        continue
+                    self._faults.remove(fault)
+                    return web.Response(status=status, headers=headers)
+            return await handler(request)
+
+        app = web.Application(middlewares=[add_latency, inject_faults],
+                              client_max_size=self.max_body_size)
+        user = '/user/{name}/'
+        app.router.add_get('/build/gh/{spec:.+}', self._build)
+        app.router.add_get(user + 'api/status', self._status)
+        app.router.add_post(user + 'api/shutdown', self._shutdown)
+        app.router.add_post(user + 'api/kernels', self._start_kernel)
+        app.router.add_delete(user + 'api/kernels/{kernel_id}', self._stop_kernel)
+        app.router.add_post(user + 'api/kernels/{kernel_id}/interrupt',
+                            self._interrupt_kernel)
+        app.router.add_get(user + 'api/kernels/{kernel_id}/channels', self._channels)
+        app.router.add_get(user + 'api/contents/{path:.*}', self._get_contents)
+        app.router.add_put(user + 'api/contents/{path:.*}', self._put_contents)
+        app.router.add_get(user + 'files/{path:.*}', self._get_file)
+        return app
+
+    def fail_next(self, method, pattern, status=503, count=1, headers=None, after=0):
+        """Answer the next ``count`` requests matching with an error ``status``.
+
+        ``pattern`` is a regular expression searched for in the path. The
+        first ``after`` matching requests are let through.
+        """
+        for _ in range(count):
+            self._faults.append([method, pattern, status, headers or {}, after])
+
+    async def start(self, port=0):
+        self._runner = web.AppRunner(self._make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self.url
+
+    async def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+        await self._runner.cleanup()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def __enter__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self._loop).result()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def _server(self, request):
+        server = self.servers.get(request.match_info['name'])
+        if server is None or not server.running:
+            raise web.HTTPNotFound()
+        if request.headers.get('Authorization') != f'token {server.token}':
+            raise web.HTTPForbidden()
+        return server
+
+    async def _build(self, request):
+        # event ids are "<build>-<event>", so that a stream lost mid-build
+        # can reattach to the same build, like on a real hub
+        last_id = request.headers.get('Last-Event-ID', '')
+        number, _, last = last_id.partition('-')
+        if number.isdigit() and int(number) in self._builds:
+            number, first = int(number), int(last) + 1
+        else:
+            self.builds += 1
+            number, first = self.builds, 0
+            self._builds[number] = _MockBuild()
+            asyncio.ensure_future(self._run_build(self._builds[number]))
+        build = self._builds[number]
+
+        resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await resp.prepare(request)
+        n = first
+        while True:
+            async with build.changed:
+                try:
+                    await asyncio.wait_for(build.changed.wait_for(lambda: len(build.events) > n),
+                                           self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    await resp.write(b':heartbeat\n\n')
+                    continue
+            data = build.events[n]
+            await resp.write(f'id: {number}-{n}\ndata: {json.dumps(data)}\n\n'.encode('utf8'))
+            n += 1
+            if data['phase'] in ('ready', 'failed'):
+                return resp
+            if self.drop_build_streams and n == first + 1:
+                self.drop_build_streams -= 1
+                request.transport.close()
+                return resp
+
+    async def _run_build(self, build):
+        for phase, delay in self.phases:
+            await build.emit(phase=phase, message=f'{phase}\n')
+            await asyncio.sleep(delay)
+        if self.fail_build:
+            await build.emit(phase='failed', message='Build failed\n')
+            return
+        name = f'mock-{uuid.uuid4().hex[:8]}'
+        server = self.servers[name] = _MockServer(name, self.root_dir / name, self.env)
+        await build.emit(phase='ready', message='server running\n',
+                         url=f'{self.url}/user/{name}/', token=server.token)
+
+    async def _status(self, request):
+        server = self._server(request)
+        return web.json_response({'kernels': len(server.kernels)})
+
+    async def _shutdown(self, request):
+        self._server(request).shutdown()
+        return web.json_response({})
+
+    async def _start_kernel(self, request):
+        server = self._server(request)
+        if self.kernel_start_delay:
+            await asyncio.sleep(self.kernel_start_delay)
+        kernel = _MockKernel(server.root, server.env)
+        server.kernels[kernel.id] = kernel
+        return web.json_response({'id': kernel.id, 'name': 'python3'}, status=201)
+
+    async def _stop_kernel(self, request):
+        server = self._server(request)
+        kernel = server.kernels.pop(request.match_info['kernel_id'], None)
+        if kernel is None:
+            raise web.HTTPNotFound()
+        kernel.kill()
+        return web.Response(status=204)
+
+    async def _interrupt_kernel(self, request):
+        server = self._server(request)
+        kernel = server.kernels.get(request.match_info['kernel_id'])
+        if kernel is None:
+            raise web.HTTPNotFound()
+        kernel.proc.send_signal(signal.SIGINT)
+        return web.Response(status=204)
+
+    async def _channels(self, request):
+        server = self._server(request)
+        kernel = server.kernels.get(request.match_info['kernel_id'])
+        if kernel is None:
+            raise web.HTTPNotFound()
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        tasks = []
+        async for msg in ws:
+            if msg.type != web.WSMsgType.TEXT:
+                continue
+            request_msg = json.loads(msg.data)
+            if request_msg['header']['msg_type'] == 'execute_request':
+                tasks.append(asyncio.ensure_future(self._execute(ws, kernel, request_msg)))
+        for task in tasks:
+            task.cancel()
+        return ws
+
+    async def _execute(self, ws, kernel, request_msg):
+        parent = request_msg['header']
+        code = request_msg['content']['code']
+
+        async def send(channel, msg_type, content):
+            header = {'msg_id': uuid.uuid4().hex, 'msg_type': msg_type,
+                      'username': 'jovyan', 'session': parent.get('session', ''),
+                      'date': datetime.datetime.utcnow().isoformat() + 'Z',
+                      'version': '5.3'}
+            await ws.send_json({'header': header, 'parent_header': parent,
+                                'metadata': {}, 'content': content,
+                                'channel': channel, 'msg_type': msg_type,
+                                'buffers': []})
+
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            await send('iopub', 'status', {'execution_state': 'busy'})
+            reply = {}
+            async for out in kernel.execute(code):
+                kind = out.pop('type')
+                if kind == 'execute_input':
+                    await send('iopub', 'execute_input',
+                               {'code': code, 'execution_count': out['execution_count']})
+                elif kind == 'stream':
+                    await send('iopub', 'stream', out)
+                elif kind == 'execute_result':
+                    await send('iopub', 'execute_result', dict(out, metadata={}))
+                elif kind == 'error':
+                    await send('iopub', 'error', out)
+                    reply.update(out)
+                elif kind == 'done':
+                    reply.update(out)
+            await send('shell', 'execute_reply', reply)
+            await send('iopub', 'status', {'execution_state': 'idle'})
+        except ConnectionResetError:
+            pass
+
+    async def _get_contents(self, request):
+        server = self._server(request)
+        path = request.match_info['path']
+        os_path = server.root / path
+        if not os_path.is_file() or _is_hidden(path):
+            raise web.HTTPNotFound()
+        kind = request.query.get('type') or ('notebook' if path.endswith('.ipynb') else 'file')
+        model = {'name': os_path.name, 'path': path, 'type': kind}
+        if kind == 'notebook':
+            model.update(format='json', content=json.loads(os_path.read_text('utf8')))
+        elif request.query.get('format') == 'base64':
+            model.update(format='base64',
+                         content=base64.b64encode(os_path.read_bytes()).decode('ascii'))
+        else:
+            model.update(format='text', content=os_path.read_text('utf8'))
+        return web.json_response(model)
+
+    async def _get_file(self, request):
+        server = self._server(request)
+        os_path = server.root / request.match_info['path']
+        if not os_path.is_file() or _is_hidden(request.match_info['path']):
+            raise web.HTTPNotFound()
+        return web.FileResponse(os_path)
+
+    async def _put_contents(self, request):
+        server = self._server(request)
+        path = request.match_info['path']
+        if _is_hidden(path):
+            # jupyter_server doesn't let clients create hidden files
+            raise web.HTTPBadRequest(text=f'Cannot create file or directory {path!r}')
+        os_path = server.root / path
+        if not os_path.parent.is_dir():
+            # like jupyter_server, parent directories aren't made
+            raise web.HTTPNotFound(text=f'No such directory: {os_path.parent.name!r}')
+        model = await request.json()
+        if model.get('type') == 'directory':
+            if os_path.exists() and not os_path.is_dir():
+                raise web.HTTPBadRequest(text=f'{path!r} exists and is not a directory')
+            os_path.mkdir(exist_ok=True)
+        elif model.get('type') == 'notebook':
+            # the same layout nbformat.write uses
+            os_path.write_text(json.dumps(model['content'], indent=1, sort_keys=True,
+                                          ensure_ascii=False) + '\n', encoding='utf8')
+        elif model.get('format') == 'base64':
+            # chunk 1 starts the file, later ones up to the last (-1) append
+            chunk = model.get('chunk')
+            with os_path.open('ab' if chunk not in (None, 1) else 'wb') as f:
+                f.write(base64.b64decode(model['content']))
+        else:
+            os_path.write_text(model['content'], encoding='utf8')
+        return web.json_response({'name': os_path.name, 'path': path,
+                                  'type': model.get('type', 'file')}, status=201)
+
+
+def _is_hidden(path):
+    return any(part.startswith('.') for part in pathlib.PurePosixPath(path).parts)
+
+
+@click.command()
+@click.argument('root_dir', type=click.Path(file_okay=False))
+@click.option('--port', default=0, help='Port to listen on (default: any free port).')
+@click.option('--phase', 'phases', multiple=True, metavar='PHASE:DELAY',
+              help='A build phase and how long it lasts, in seconds.')
+@click.option('--latency', default=0.0, help='Seconds added to every request.')
+@click.option('--kernel-start-delay', default=0.0, help='Seconds taken to start a kernel.')
+def main(root_dir, port, phases, latency, kernel_start_delay):
+    """Run a mock BinderHub until interrupted."""
+    phases = [(name, float(delay)) for name, delay in
+              (phase.rsplit(':', 1) for phase in phases)]
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        hub = MockBinderHub(root_dir, phases=phases, latency=latency,
+                            kernel_start_delay=kernel_start_delay)
+        async with hub:
+            print(hub.url, flush=True)
+            await stop.wait()
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Timed spans for the phases of a run.
+
+A ``Tracer`` records nested spans (launch, kernel start, upload, execute,
+download, ...) with their parent/child relationships. The current span is
+tracked with a context variable, so spans opened in asyncio tasks nest under
+the span that was current when the task was created. The spans can be
+written as a Chrome trace, which can be loaded in ``chrome://tracing`` or
+https://ui.perfetto.dev to see the critical path of a run.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import time
+
+_current_span = contextvars.ContextVar('binderbot_current_span', default=None)
+
+
+class Span:
+    def __init__(self, name, span_id, parent_id, start, lane, attrs):
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.start = start
+        self.end = None
+        self.lane = lane
+        self.attrs = attrs
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer:
+    """Collects spans; one tracer can be shared by several users."""
+
+    def __init__(self):
+        self.spans = []
+        self._ids = itertools.count(1)
+        self._lanes = {}
+
+    def _lane(self):
+        # spans running concurrently in different tasks go on different lanes
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        return self._lanes.setdefault(id(task), len(self._lanes) + 1)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """Time the body of a ``with`` block as a child of the current span."""
+        parent = _current_span.get()
+        span = Span(name, next(self._ids), parent.span_id if parent else None,
+                    time.monotonic(), self._lane(), attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs['error'] = repr(e)
+            raise
+        finally:
+            span.end = time.monotonic()
+            _current_span.reset(token)
+            self.spans.append(span)
+
+    def record(self, name, start, end, **attrs):
+        """Add a span measured elsewhere as a child of the current span."""
+        parent = _current_span.get()
+        span = Span(name, next(self._ids), parent.span_id if parent else None,
+                    start, self._lane(), attrs)
+        span.end = end
+        self.spans.append(span)
+        return span
+
+    def totals(self):
+        """Total time and count of the spans with each name."""
+        totals = {}
+        for span in self.spans:
+            total = totals.setdefault(span.name, {'total': 0.0, 'count': 0})
+            total['total'] += span.duration
+            total['count'] += 1
+        return totals
+
+    def to_chrome_trace(self):
+        """Return the spans in the Chrome trace event format."""
+        origin = min((span.start for span in self.spans), default=0)
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': lane,
+                   'args': {'name': f'task {lane}'}}
+                  for lane in sorted(set(self._lanes.values()))]
+        for span in sorted(self.spans, key=lambda span: span.start):
+            args = {k: str(v) for k, v in span.attrs.items()}
+            args.update(span_id=span.span_id, parent_id=span.parent_id)
+            events.append({'name': span.name, 'cat': 'binderbot', 'ph': 'X',
+                           'ts': (span.start - origin) * 1e6,
+                           'dur': span.duration * 1e6,
+                           'pid': pid, 'tid': span.lane, 'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
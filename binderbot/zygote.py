@@ -0,0 +1,184 @@
+"""A fork server running notebooks in the binder with warm imports.
+
+Executing a notebook with nbconvert starts a fresh kernel, which pays
+again for importing xarray, dask and the like on every notebook. Instead,
+``zygote`` is started once per server: it imports the ``preload`` modules,
+then forks a child for each notebook it is asked to run. The child starts
+with the modules already imported, in memory shared copy-on-write with
+the zygote, runs the cells with IPython and saves the notebook in place,
+to be downloaded as usual.
+
+Like ``trim_outputs``, it runs in the binder, so it only uses what
+nbconvert needs there and is sent over as source code.
+"""
+
+import inspect
+
+from .outputs import trim_outputs
+
+# paths in the binder's working directory
+SOCKET_PATH = '.binderbot-zygote.sock'
+SCRIPT_PATH = '.binderbot-zygote.py'
+
+
+def zygote(socket_path, preload=()):
+    """Serve notebook runs on the UNIX socket ``socket_path``, forever.
+
+    Each connection sends one JSON request line, ``{"ping": true}``,
+    ``{"stop": true}`` or ``{"path", "timeout", "env", "trim"}``, and gets
+    one JSON reply line with a ``status`` of ``"ok"`` or ``"error"``. A
+    notebook stops at the first cell raising an error, or running for over
+    ``timeout`` seconds.
+    """
+    import importlib
+    import json
+    import os
+    import signal
+    import socket
+    import sys
+
+    import nbformat
+    from IPython.core.displayhook import DisplayHook
+    from IPython.core.displaypub import DisplayPublisher
+    from IPython.core.interactiveshell import InteractiveShell
+    from traitlets.config import Config
+
+    preloaded = {}
+    for name in preload:
+        try:
+            importlib.import_module(name)
+            preloaded[name] = 'ok'
+        except Exception as e:
+            preloaded[name] = repr(e)
+    # the shell is set up once too, and inherited by every child; without
+    # history, which would be saved by a thread that forking leaves behind
+    config = Config()
+    config.HistoryManager.enabled = False
+    shell = InteractiveShell.instance(config=config)
+
+    # outputs of the running cell, collected in order like a kernel sends them
+    outputs = []
+
+    class Stream:
+        def __init__(self, name):
+            self.name = name
+
+        def write(self, text):
+            if outputs and outputs[-1].get('name') == self.name:
+                outputs[-1]['text'] += text
+            elif text:
+                outputs.append(nbformat.v4.new_output('stream', name=self.name, text=text))
+            return len(text)
+
+        def flush(self):
+            pass
+
+        def isatty(self):
+            return False
+
+    class Publisher(DisplayPublisher):
+        def publish(self, data, metadata=None, **kwargs):
+            outputs.append(nbformat.v4.new_output('display_data', data=data,
+                                                  metadata=metadata or {}))
+
+        def clear_output(self, wait=False):
+            del outputs[:]
+
+    class Hook(DisplayHook):
+        def write_output_prompt(self):
+            pass
+
+        def write_format_data(self, format_dict, md_dict=None):
+            outputs.append(nbformat.v4.new_output('execute_result', data=format_dict,
+                                                  metadata=md_dict or {},
+                                                  execution_count=self.prompt_count))
+
+    def show_traceback(etype, evalue, stb):
+        outputs.append(nbformat.v4.new_output('error', ename=etype.__name__,
+                                              evalue=str(evalue), traceback=stb))
+
+    shell.display_pub = Publisher(shell=shell)
+    shell.displayhook = shell.display_trap.hook = Hook(shell=shell)
+    shell._showtraceback = show_traceback
+
+    def on_alarm(signum, frame):
+        raise TimeoutError('Cell execution timed out')
+
+    def run(request):
+        os.environ.update(request.get('env', {}))
+        signal.signal(signal.SIGALRM, on_alarm)
+        with open(request['path']) as f:
+            nb = nbformat.read(f, as_version=4)
+        reply = {'status': 'ok'}
+        for cell in nb.cells:
+            if cell.cell_type != 'code':
+                continue
+            del outputs[:]
+            saved = sys.stdout, sys.stderr
+            sys.stdout, sys.stderr = Stream('stdout'), Stream('stderr')
+            signal.alarm(request.get('timeout') or 0)
+            try:
+                result = shell.run_cell(cell.source, store_history=True)
+            finally:
+                signal.alarm(0)
+                sys.stdout, sys.stderr = saved
+            cell.execution_count = result.execution_count
+            cell.outputs = list(outputs)
+            error = result.error_before_exec or result.error_in_exec
+            if error is not None:
+                reply = {'status': 'error', 'ename': type(error).__name__,
+                         'evalue': str(error)}
+                break
+        if request.get('trim'):
+            trim_outputs(nb, **request['trim'])
+        with open(request['path'], 'w', encoding='utf-8') as f:
+            nbformat.write(nb, f)
+        return reply
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    # children are reaped automatically
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    print(json.dumps({'pid': os.getpid(), 'preloaded': preloaded}), flush=True)
+    sys.stdout = open(os.devnull, 'w')
+
+    while True:
+        conn, _ = server.accept()
+        with conn, conn.makefile('rw') as stream:
+            request = json.loads(stream.readline())
+            if request.get('ping'):
+                stream.write(json.dumps({'status': 'ok', 'preloaded': preloaded}) + '\n')
+                continue
+            if request.get('stop'):
+                stream.write(json.dumps({'status': 'ok'}) + '\n')
+                break
+            if os.fork() != 0:
+                continue
+            # in the child
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            try:
+                reply = run(request)
+            except BaseException as e:
+                reply = {'status': 'error', 'ename': type(e).__name__, 'evalue': str(e)}
+            try:
+                stream.write(json.dumps(reply) + '\n')
+                stream.flush()
+            finally:
+                os._exit(0)
+    server.close()
+    os.remove(socket_path)
+
+
+def zygote_source():
+    """Source code of a script running ``zygote`` with its arguments."""
+    return '\n\n'.join([
+        inspect.getsource(trim_outputs),
+        inspect.getsource(zygote),
+        'if __name__ == "__main__":\n'
+        '    import json, sys\n'
+        '    zygote(sys.argv[1], json.loads(sys.argv[2]))\n',
+    ])
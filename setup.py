@@ -33,6 +33,7 @@ setup(
     entry_points={
         'console_scripts': [
             'binderbot=binderbot.cli:main',
+            'binderbot-loadtest=binderbot.loadtest:main',
         ],
     },
     install_requires=[
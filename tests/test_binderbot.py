@@ -2,14 +2,28 @@
 
 """Tests for `binderbot` package."""
 
+import asyncio
+import hashlib
+import json
 import os
+import struct
+import subprocess
+import sys
+import time
+import zipfile
 
+import aiohttp
 import pytest
+import structlog
 from click.testing import CliRunner
 import nbformat
 
 from binderbot import binderbot
 from binderbot import cli
+from binderbot.connection import make_connector
+from binderbot.retry import RetryPolicy
+from binderbot.sessions import SessionStore
+from binderbot.testing import MockBinderHub
 
 
 @pytest.fixture()
@@ -52,7 +66,7 @@ def test_cli_upload_execute_download(tmp_path, example_nb_data):
     args = ["--binder-url", "http://mybinder.org",
             "--repo", "binder-examples/requirements",
             "--ref", "master", "--nb-timeout", "10",
-            "--pass-env-var",  "MY_VAR",
+            "--pass-env-var",  "MY_VAR", "--no-cache",
             fname]
     result = runner.invoke(cli.main, args)
     assert result.exit_code == 0, result.output
@@ -68,3 +82,657 @@ def test_cli_upload_execute_download(tmp_path, example_nb_data):
     # help_result = runner.invoke(cli.main, ['--help'])
     # assert help_result.exit_code == 0
     # assert '--help  Show this message and exit.' in help_result.output
+
+
+@pytest.fixture()
+def mock_hub(tmp_path):
+    with MockBinderHub(tmp_path / 'hub', phases=[('building', 0.05)]) as hub:
+        yield hub
+
+
+def _write_notebooks(fnames, nb):
+    for fname in fnames:
+        with open(fname, 'w', encoding='utf-8') as f:
+            nbformat.write(nb, f)
+
+
+def test_open_nb_and_strip_output(tmp_path, example_nb_data):
+    from nbconvert.preprocessors import ClearOutputPreprocessor
+
+    nb = nbformat.from_dict(example_nb_data)
+    nb.metadata['widgets'] = {'state': {}}
+    nb.cells[0].metadata.update(collapsed=True, tags=['slow'], custom=1)
+    nb.cells[0].execution_count = 3
+    nb.cells[0].outputs = [nbformat.v4.new_output('stream', text='x' * 100)]
+    nb.cells.append(nbformat.v4.new_markdown_cell('# Title', metadata={'custom': 1}))
+    fname = tmp_path / 'nb.ipynb'
+    with open(fname, 'w') as f:
+        nbformat.write(nb, f)
+
+    # same result as nbconvert, without its schema validation
+    expected, _ = ClearOutputPreprocessor().preprocess(nbformat.read(str(fname), 4), {})
+    stripped = binderbot.open_nb_and_strip_output(fname)
+    assert stripped == expected
+    assert stripped.cells[0].outputs == []
+
+    stripped = binderbot.open_nb_and_strip_output(fname, strip_metadata=True)
+    assert list(stripped.metadata) == ['kernelspec', 'language_info']
+    assert stripped.cells[0].metadata == {'tags': ['slow']}
+    assert stripped.cells[-1].metadata == {}
+
+    # validation is opt-in
+    del nb.cells[0]['source']
+    with open(fname, 'w') as f:
+        f.write(json.dumps(nb))
+    binderbot.open_nb_and_strip_output(fname)
+    with pytest.raises(binderbot.OperationError):
+        binderbot.open_nb_and_strip_output(fname, validate=True)
+
+
+def test_binder_user_lifecycle(mock_hub):
+    async def lifecycle():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            stdout, stderr = await jovyan.run_code("""
+            import sys
+            print('hello')
+            print('oops', file=sys.stderr)
+            """)
+            assert (stdout, stderr) == ('hello\n', 'oops\n')
+            # many calls share the kernel's websocket
+            results = await asyncio.gather(*[jovyan.run_code(f'print({n})')
+                                             for n in range(5)])
+            assert [out for out, _ in results] == [f'{n}\n' for n in range(5)]
+            assert len(jovyan._channels) == 1
+            assert await jovyan.list_notebooks() == []
+            with pytest.raises(binderbot.OperationError):
+                await jovyan.run_code('1 / 0')
+            await jovyan.teardown()
+            assert jovyan.state == binderbot.BinderUser.States.CLEAR
+
+    asyncio.run(lifecycle())
+
+
+def test_shared_connector(mock_hub):
+    async def run_users():
+        # a small pool only works if connections are given back
+        connector = make_connector(limit=2, limit_per_host=2)
+        for _ in range(2):
+            async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master',
+                                            connector=connector) as jovyan:
+                await jovyan.start_binder()
+                await jovyan.start_kernel()
+                assert await jovyan.run_code('print(1)') == ('1\n', '')
+                await jovyan.teardown()
+        # the users' sessions leave the shared pool open
+        assert not connector.closed
+        await connector.close()
+
+    asyncio.run(run_users())
+
+
+def test_binder_build_failure(tmp_path):
+    async def launch(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master') as jovyan:
+            with pytest.raises(binderbot.OperationError):
+                await jovyan.start_binder()
+
+    with MockBinderHub(tmp_path, fail_build=True) as hub:
+        asyncio.run(launch(hub))
+
+
+def test_chunked_upload(tmp_path, example_nb_data):
+    data = os.urandom(2500)
+    (tmp_path / 'small.bin').write_bytes(data[:500])
+    (tmp_path / 'large.bin').write_bytes(data)
+
+    async def upload(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            # a chunk of the old contents would be appended to, not replaced
+            for _ in range(2):
+                for name in ('small.bin', 'large.bin'):
+                    await jovyan.upload_file(str(tmp_path / name), path=name,
+                                             chunk_size=1000)
+            await jovyan.put_contents('big.ipynb', example_nb_data, chunk_size=100)
+            root = hub.servers[jovyan.notebook_url.parts[-2]].root
+            assert (root / 'small.bin').read_bytes() == data[:500]
+            assert (root / 'large.bin').read_bytes() == data
+            assert await jovyan.get_contents('big.ipynb') == example_nb_data
+            # streamed in the layout nbformat writes
+            assert ((root / 'big.ipynb').read_bytes()
+                    == binderbot.notebook_bytes(example_nb_data))
+            await jovyan.teardown()
+
+    # requests bigger than a chunk would be rejected
+    with MockBinderHub(tmp_path / 'hub', max_body_size=2000) as hub:
+        asyncio.run(upload(hub))
+
+
+def test_upload_archive(tmp_path, mock_hub, example_nb_data):
+    os.chdir(tmp_path)
+    os.mkdir('data')
+    with open(os.path.join('data', 'values.csv'), 'w') as f:
+        f.write('a,b\n1,2\n')
+
+    async def upload():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            await jovyan.upload_archive({'nbs/example.ipynb': example_nb_data},
+                                        [os.path.join('data', 'values.csv')])
+            assert await jovyan.get_contents('nbs/example.ipynb') == example_nb_data
+            root = mock_hub.servers[jovyan.notebook_url.parts[-2]].root
+            assert (root / 'data' / 'values.csv').read_text() == 'a,b\n1,2\n'
+            assert sorted(os.listdir(root)) == ['data', 'nbs']
+            # like Jupyter, the mock refuses to create hidden files
+            with pytest.raises(aiohttp.ClientResponseError) as e:
+                await jovyan.upload_file(os.path.join('data', 'values.csv'),
+                                         path='.values.csv')
+            assert e.value.status == 400
+            # nor does it make missing directories, which upload_file does
+            with pytest.raises(aiohttp.ClientResponseError) as e:
+                await jovyan._request('put_contents', 'PUT',
+                                      jovyan.notebook_url / 'api/contents/new/values.csv',
+                                      json={'type': 'file', 'format': 'text',
+                                            'content': 'a,b\n'})
+            assert e.value.status == 404
+            await jovyan.upload_file(os.path.join('data', 'values.csv'),
+                                     path='new/dir/values.csv')
+            assert (root / 'new' / 'dir' / 'values.csv').read_text() == 'a,b\n1,2\n'
+            await jovyan.teardown()
+
+    asyncio.run(upload())
+
+
+def test_pipeline_overlaps_stages(tmp_path, mock_hub, example_nb_data):
+    pytest.importorskip('ipykernel')
+    os.chdir(tmp_path)
+    fnames = [f"example_notebook_{n}.ipynb" for n in range(3)]
+    _write_notebooks(fnames, example_nb_data)
+
+    async def run():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            queue = asyncio.Queue()
+            for fname in fnames:
+                queue.put_nowait(fname)
+            options = binderbot.RunOptions(extra_env_vars={'MY_VAR': 'x'})
+            errors = await jovyan.run_queue(queue, options, pipeline=True)
+            await jovyan.teardown()
+            return errors, jovyan.tracer.spans
+
+    errors, spans = asyncio.run(run())
+    assert errors == {}
+    stages = {(span.name, span.attrs.get('path')): span for span in spans}
+    # the next notebook is uploaded while the first one executes
+    assert stages['upload', fnames[1]].start < stages['execute', fnames[0]].end
+    for fname in fnames:
+        assert stages['execute', fname].end <= stages['download', fname].start
+        # a notebook span covers its stages, like without the pipeline
+        assert stages['notebook', fname].start <= stages['upload', fname].start
+        assert stages['download', fname].end <= stages['notebook', fname].end
+
+
+def test_download_file(tmp_path, mock_hub, example_nb_data):
+    async def download():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.put_contents('nb.ipynb', example_nb_data)
+            await jovyan.download_file('nb.ipynb', tmp_path / 'nb.ipynb', chunk_size=64)
+            with pytest.raises(aiohttp.ClientResponseError):
+                await jovyan.download_file('missing.ipynb', tmp_path / 'missing.ipynb')
+            # like Jupyter, the mock doesn't serve hidden files
+            root = mock_hub.servers[jovyan.notebook_url.parts[-2]].root
+            (root / '.hidden.zip').write_bytes(b'zip')
+            with pytest.raises(aiohttp.ClientResponseError) as e:
+                await jovyan.download_file('.hidden.zip', tmp_path / 'hidden.zip')
+            assert e.value.status == 404
+            await jovyan.teardown()
+
+    asyncio.run(download())
+    binderbot.validate_notebook(tmp_path / 'nb.ipynb')
+    assert nbformat.read(str(tmp_path / 'nb.ipynb'), as_version=4) == example_nb_data
+    assert os.listdir(tmp_path) == ['hub', 'nb.ipynb']
+    (tmp_path / 'bad.ipynb').write_text('{"cells": []}')
+    with pytest.raises(binderbot.OperationError):
+        binderbot.validate_notebook(tmp_path / 'bad.ipynb')
+
+
+def test_extract_archive(tmp_path):
+    archive = tmp_path / 'archive.zip'
+    with zipfile.ZipFile(archive, 'w') as f:
+        for n in range(200):
+            f.writestr(f'figures/{n}.png', b'png')
+        f.writestr('../outside.txt', b'text')
+    # threads extracting into the same new directory must not collide
+    for n in range(100):
+        dest = tmp_path / str(n)
+        names = binderbot.extract_archive(archive, dest)
+        assert len(names) == 201
+        assert len(os.listdir(dest / 'figures')) == 200
+        assert (dest / 'outside.txt').read_bytes() == b'text'
+
+
+def test_cli_import_time():
+    """Importing the CLI, e.g. for --help, leaves the heavy modules out."""
+    code = ("import sys, time; start = time.perf_counter(); import binderbot.cli; "
+            "print(time.perf_counter() - start); "
+            "print(' '.join(m for m in ('aiohttp', 'nbconvert', 'nbformat', 'structlog') "
+            "if m in sys.modules))")
+    # other tests change directory, so run from where binderbot is
+    root = os.path.dirname(os.path.dirname(os.path.abspath(cli.__file__)))
+    out = subprocess.run([sys.executable, '-c', code], check=True, cwd=root,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout.split('\n')
+    print(f'binderbot.cli imported in {float(out[0]):.3f}s')
+    assert out[1] == ''
+
+
+def test_cli_mock_binder(tmp_path, mock_hub, example_nb_data):
+    """Test the CLI end to end with nbconvert running in the binder."""
+    pytest.importorskip('ipykernel')
+
+    os.chdir(tmp_path)
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], example_nb_data)
+
+    env = {"MY_VAR": "SECRET"}
+    runner = CliRunner(env=env)
+    args = ["--binder-url", mock_hub.url,
+            "--repo", "org/repo", "--no-cache", "--validate",
+            "--nb-timeout", "60",
+            "--pass-env-var",  "MY_VAR",
+            fname]
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+    with open(fname) as f:
+        nb = nbformat.read(f, as_version=4)
+    remote_env_var_value = nb['cells'][1]['outputs'][0]['text']
+    assert remote_env_var_value.rstrip() == env['MY_VAR']
+
+
+@pytest.mark.parametrize("parallel_args", [["--concurrency", "2"],
+                                           ["--servers", "2"],
+                                           ["--engine", "client"],
+                                           ["--batch-upload", "--servers", "2"],
+                                           ["--batch-download", "--concurrency", "2"],
+                                           ["--engine", "client", "--concurrency", "2",
+                                            "--kernel-pool-size", "1",
+                                            "--kernel-max-uses", "1"],
+                                           ["--engine", "zygote", "--concurrency", "2",
+                                            "--preload", "json"],
+                                           ["--pipeline"],
+                                           ["--pipeline", "--concurrency", "2",
+                                            "--batch-download"]])
+def test_cli_multiple_notebooks(tmp_path, mock_hub, example_nb_data,
+                                parallel_args):
+    """Test running several notebooks at once."""
+    if "client" not in parallel_args:
+        pytest.importorskip('ipykernel')
+    if "zygote" in parallel_args:
+        pytest.importorskip('IPython')
+
+    os.chdir(tmp_path)
+    fnames = [f"example_notebook_{n}.ipynb" for n in range(3)]
+    _write_notebooks(fnames, example_nb_data)
+
+    env = {"MY_VAR": "SECRET"}
+    runner = CliRunner(env=env)
+    args = ["--binder-url", mock_hub.url,
+            "--repo", "org/repo", "--no-cache",
+            "--nb-timeout", "60",
+            "--pass-env-var",  "MY_VAR"] + parallel_args + fnames
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+    for fname in fnames:
+        with open(fname) as f:
+            nb = nbformat.read(f, as_version=4)
+        remote_env_var_value = nb['cells'][1]['outputs'][0]['text']
+        assert remote_env_var_value.rstrip() == env['MY_VAR']
+    # every binder was shut down
+    assert not any(server.running for server in mock_hub.servers.values())
+
+
+def test_cli_kernel_pool_needs_client_engine(tmp_path, example_nb_data):
+    os.chdir(tmp_path)
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], example_nb_data)
+    for engine in ("nbconvert", "zygote"):
+        result = CliRunner().invoke(cli.main, ["--binder-url", "http://binder.invalid",
+                                               "--repo", "org/repo", "--no-cache",
+                                               "--engine", engine,
+                                               "--kernel-pool-size", "1", fname])
+        assert result.exit_code == 2
+        assert "--kernel-pool-size needs --engine client" in result.output
+
+
+def test_cli_download_artifacts(tmp_path, mock_hub):
+    """Test downloading notebooks and the files they produce in one archive."""
+    pytest.importorskip('ipykernel')
+
+    os.chdir(tmp_path)
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(
+        "import os\nos.makedirs('figures', exist_ok=True)\n"
+        "open('figures/plot.png', 'w').write('png')")])
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], nb)
+    os.mkdir("out")
+
+    runner = CliRunner()
+    args = ["--binder-url", mock_hub.url, "--repo", "org/repo", "--no-cache",
+            "--batch-download", "--download-artifact", "figures/*.png",
+            "--output-dir", "out", "--validate", fname]
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+    assert sorted(os.listdir("out")) == ["example_notebook.ipynb", "figures"]
+    assert (tmp_path / "out" / "figures" / "plot.png").read_text() == "png"
+    nb = nbformat.read(os.path.join("out", fname), as_version=4)
+    assert nb.cells[0].execution_count == 1
+    # the archive was removed from the binder
+    server, = mock_hub.servers.values()
+    assert sorted(os.listdir(server.root)) == ["example_notebook.ipynb", "figures"]
+
+
+def test_cli_upload_file(tmp_path, mock_hub, example_nb_data):
+    """Test uploading a data file bigger than the server's body limit."""
+
+    os.chdir(tmp_path)
+    data = os.urandom(3 * 1024 ** 2)
+    # in a directory the binder doesn't have yet
+    os.makedirs(os.path.join("data", "raw"))
+    with open(os.path.join("data", "raw", "data.bin"), "wb") as f:
+        f.write(data)
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(
+        "import hashlib\n"
+        "print(hashlib.sha256(open('data/raw/data.bin', 'rb').read()).hexdigest())")])
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], nb)
+
+    runner = CliRunner()
+    args = ["--binder-url", mock_hub.url, "--repo", "org/repo",
+            "--no-cache", "--engine", "client", "--upload-file", "data/raw/data.bin",
+            "--output-dir", "out", fname]
+    os.mkdir("out")
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+    nb = nbformat.read(os.path.join("out", fname), as_version=4)
+    assert nb.cells[0].outputs[0].text.strip() == hashlib.sha256(data).hexdigest()
+
+
+def test_cli_trim_outputs(tmp_path, mock_hub):
+    """Test trimming outputs in the binder before downloading them."""
+    pytest.importorskip('ipykernel')
+
+    os.chdir(tmp_path)
+    nb = nbformat.v4.new_notebook(cells=[
+        nbformat.v4.new_code_cell("print('x' * 5000)"),
+        nbformat.v4.new_code_cell("from IPython.display import HTML\nHTML('<b>hi</b>')")])
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], nb)
+
+    runner = CliRunner()
+    args = ["--binder-url", mock_hub.url, "--repo", "org/repo", "--no-cache",
+            "--max-output-size", "100", "--drop-mime-type", "text/html", fname]
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+    nb = nbformat.read(fname, as_version=4)
+    assert len(nb.cells[0].outputs[0].text) < 200
+    assert 'text/html' not in nb.cells[1].outputs[0].data
+    # trimmed in the binder, not after downloading
+    server, = mock_hub.servers.values()
+    remote = nbformat.read(str(server.root / fname), as_version=4)
+    assert remote == nb
+
+
+def test_cli_session_file(tmp_path, mock_hub, example_nb_data):
+    """Test reusing a binder saved by an earlier invocation."""
+
+    os.chdir(tmp_path)
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], example_nb_data)
+
+    runner = CliRunner(env={"MY_VAR": "SECRET"})
+    # a sha, so that the ref resolves without network access
+    args = ["--binder-url", mock_hub.url, "--repo", "org/repo", "--ref", "a" * 40,
+            "--no-cache", "--engine", "client", "--pass-env-var",  "MY_VAR",
+            "--session-file", str(tmp_path / "sessions.json"), fname]
+    for _ in range(2):
+        result = runner.invoke(cli.main, args)
+        assert result.exit_code == 0, result.output
+    assert mock_hub.builds == 1
+
+
+def test_session_not_resumed_for_moved_ref(tmp_path, mock_hub):
+    """A binder saved for an older commit of the ref is replaced."""
+    store = SessionStore(tmp_path / "sessions.json")
+
+    async def launch(sha):
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_or_resume_binder(store, sha=sha)
+            await jovyan.teardown(shutdown=not jovyan.saved)
+
+    def running():
+        return sum(server.running for server in mock_hub.servers.values())
+
+    async def run():
+        await launch('a' * 40)
+        await launch('a' * 40)
+        assert mock_hub.builds == 1
+        await launch('b' * 40)
+        assert mock_hub.builds == 2
+        assert store.get(mock_hub.url, 'org/repo', 'master')['sha'] == 'b' * 40
+        # the replaced binder was shut down
+        assert running() == 1
+        # nor when the ref can't be resolved, and then the binder isn't kept
+        await launch(None)
+        await launch(None)
+        assert mock_hub.builds == 4
+        assert running() == 1
+        assert store.get(mock_hub.url, 'org/repo', 'master')['sha'] == 'b' * 40
+
+    asyncio.run(run())
+
+
+def test_cli_trace_file(tmp_path, mock_hub, example_nb_data):
+    """Test writing the timed phases of a run as a Chrome trace."""
+
+    os.chdir(tmp_path)
+    fname = "example_notebook.ipynb"
+    _write_notebooks([fname], example_nb_data)
+
+    runner = CliRunner(env={"MY_VAR": "SECRET"})
+    args = ["--binder-url", mock_hub.url, "--repo", "org/repo",
+            "--no-cache", "--pass-env-var",  "MY_VAR",
+            "--trace-file", "trace.json", fname]
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+
+    with open("trace.json") as f:
+        events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+    spans = {e['args']['span_id']: e for e in events}
+    names = {e['name'] for e in events}
+    assert {'run', 'launch', 'kernel-start', 'notebook', 'upload',
+            'execute', 'download'} <= names
+    for e in events:
+        parent_id = e['args']['parent_id']
+        if e['name'] == 'run':
+            assert parent_id is None
+        else:
+            assert parent_id in spans
+    notebook = next(e for e in events if e['name'] == 'notebook')
+    execute = next(e for e in events if e['name'] == 'execute')
+    assert spans[execute['args']['parent_id']] is notebook
+
+
+def test_worker_kernel_failure(tmp_path, mock_hub, example_nb_data):
+    """A kernel failing to start leaves the notebooks in the queue."""
+    os.chdir(tmp_path)
+    fnames = [f"example_notebook_{n}.ipynb" for n in range(3)]
+    _write_notebooks(fnames, example_nb_data)
+
+    async def run():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            queue = asyncio.Queue()
+            for fname in fnames:
+                queue.put_nowait(fname)
+            # the second worker's kernel starts, the third one's does not
+            mock_hub.fail_next('POST', 'api/kernels$', 400, after=1)
+            with pytest.raises(binderbot.OperationError):
+                await jovyan.run_queue(queue, concurrency=3)
+            assert queue.qsize() == len(fnames)
+            server, = mock_hub.servers.values()
+            assert list(server.kernels) == [jovyan.kernel_id]
+            await jovyan.teardown()
+
+    asyncio.run(run())
+
+
+def test_run_on_binders_reports_every_notebook(tmp_path, mock_hub, example_nb_data):
+    """Notebooks a failed binder leaves behind are reported as errors."""
+    os.chdir(tmp_path)
+    fnames = [f"example_notebook_{n}.ipynb" for n in range(4)]
+    _write_notebooks(fnames, example_nb_data)
+
+    # the second kernel of the binder fails to start
+    mock_hub.fail_next('POST', 'api/kernels$', 400, after=1)
+    errors = asyncio.run(binderbot.run_on_binders(mock_hub.url, 'org/repo', 'master',
+                                                  fnames, concurrency=2))
+    assert sorted(errors) == fnames
+
+    async def run():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            queue = asyncio.Queue()
+            for fname in fnames:
+                queue.put_nowait(fname)
+
+            async def broken_worker(take, process, results, kernel_id=None, pool=None):
+                await take()
+                raise RuntimeError('worker died')
+
+            jovyan._run_worker = broken_worker
+            errors = await jovyan.run_queue(queue)
+            await jovyan.teardown()
+            return errors, queue.qsize()
+
+    errors, left = asyncio.run(run())
+    assert list(errors) == fnames[:1]
+    assert left == len(fnames) - 1
+
+
+def test_run_on_binders_skips_late_binders(tmp_path, mock_hub, example_nb_data):
+    """A binder still launching once the notebooks are done is cancelled."""
+    os.chdir(tmp_path)
+    fnames = [f"example_notebook_{n}.ipynb" for n in range(2)]
+    _write_notebooks(fnames, example_nb_data)
+
+    # one of the builds is asked to come back much later
+    mock_hub.fail_next('GET', '^/build/', 503, headers={'Retry-After': '60'})
+    start = time.monotonic()
+    errors = asyncio.run(binderbot.run_on_binders(
+        mock_hub.url, 'org/repo', 'master', fnames, servers=2,
+        retry_policies={'start_binder': RetryPolicy(max_delay=60)},
+        options=binderbot.RunOptions(engine='client',
+                                     extra_env_vars={'MY_VAR': 'x'})))
+    assert errors == {}
+    assert time.monotonic() - start < 30
+    assert mock_hub.builds == 1
+
+
+def test_pipeline_failure_reports_every_notebook(tmp_path, mock_hub, example_nb_data):
+    """Notebooks in flight when a pipeline stage fails are reported as errors."""
+    os.chdir(tmp_path)
+    fnames = [f"example_notebook_{n}.ipynb" for n in range(6)]
+    _write_notebooks(fnames, example_nb_data)
+
+    async def run():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            queue = asyncio.Queue()
+            for fname in fnames:
+                queue.put_nowait(fname)
+
+            async def broken_worker(take, process, results, kernel_id=None, pool=None):
+                # wait for the upload stage to fill the pipeline
+                await asyncio.sleep(0.5)
+                await take()
+                raise RuntimeError('worker died')
+
+            jovyan._run_worker = broken_worker
+            errors = await jovyan.run_queue(queue, pipeline=True, concurrency=2)
+            await jovyan.teardown()
+            left = [queue.get_nowait() for _ in range(queue.qsize())]
+            return errors, left
+
+    errors, left = asyncio.run(run())
+    # the notebooks taken are errors, the others are left to other binders
+    assert len(errors) > 2
+    assert sorted(list(errors) + left) == fnames
+
+
+def test_cell_timeout_interrupts_kernel(tmp_path, mock_hub):
+    """A cell timing out is interrupted, so the kernel runs the next notebook."""
+    os.chdir(tmp_path)
+    for fname, source in [('a.ipynb', 'import time\nwhile True: time.sleep(0.1)'),
+                          ('b.ipynb', 'print(1)')]:
+        nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(source)])
+        with open(fname, 'w', encoding='utf-8') as f:
+            nbformat.write(nb, f)
+
+    async def run():
+        async with binderbot.BinderUser(mock_hub.url, 'org/repo', 'master') as jovyan:
+            errors = await asyncio.wait_for(
+                jovyan.run(['a.ipynb', 'b.ipynb'], engine='client', nb_timeout=2), 30)
+            await jovyan.teardown()
+        return errors
+
+    errors = asyncio.run(run())
+    assert list(errors) == ['a.ipynb']
+    assert 'timed out' in str(errors['a.ipynb'])
+    nb = nbformat.read('b.ipynb', as_version=4)
+    assert nb.cells[0].outputs[0].text == '1\n'
+
+
+def test_kernel_channel_binary_frames():
+    """Messages with buffers arrive in binary frames without ending the channel."""
+    def message(msg_type, parent_id):
+        return {'header': {'msg_id': 'x', 'msg_type': msg_type},
+                'parent_header': {'msg_id': parent_id}, 'metadata': {},
+                'content': {}, 'channel': 'iopub', 'msg_type': msg_type}
+
+    # the layout Jupyter uses: number of parts, offsets, message, buffers
+    msg = json.dumps(message('comm_msg', 'a')).encode('utf8')
+    binary = (struct.pack('!III', 2, 12, 12 + len(msg)) + msg + b'\0\1')
+    frames = [aiohttp.WSMessage(aiohttp.WSMsgType.BINARY, binary, None),
+              aiohttp.WSMessage(aiohttp.WSMsgType.BINARY, b'junk', None),
+              aiohttp.WSMessage(aiohttp.WSMsgType.TEXT,
+                                json.dumps(message('status', 'a')), None)]
+
+    class FakeWebSocket:
+        async def __aiter__(self):
+            for frame in frames:
+                yield frame
+
+    async def read():
+        channel = binderbot.KernelChannel(None, 'ws://kernel', structlog.get_logger())
+        channel.ws = FakeWebSocket()
+        queue = channel._queues['a'] = asyncio.Queue()
+        await channel._read()
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    comm_msg, status, end = asyncio.run(read())
+    assert comm_msg['msg_type'] == 'comm_msg'
+    assert comm_msg['buffers'] == [b'\0\1']
+    assert status['msg_type'] == 'status'
+    assert end is None
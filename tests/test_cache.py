@@ -0,0 +1,116 @@
+"""Tests for the result cache."""
+
+import asyncio
+import os
+import time
+
+import nbformat
+from click.testing import CliRunner
+
+from binderbot import cli
+from binderbot import binderbot
+from binderbot.binderbot import open_nb_and_strip_output
+from binderbot.cache import ResultCache, pick_ref
+
+SHA = 'a' * 40
+
+
+def _write_nb(path, source):
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(source)])
+    with open(path, 'w', encoding='utf-8') as f:
+        nbformat.write(nb, f)
+    return nb
+
+
+def test_key_depends_on_inputs(tmp_path):
+    nb = _write_nb(tmp_path / 'a.ipynb', 'print(1)')
+    key = ResultCache.key(nb, 'org/repo', SHA, 'https://mybinder.org', ['A'])
+    assert key == ResultCache.key(nb, 'org/repo', SHA, 'https://mybinder.org/', ['A'])
+    assert key != ResultCache.key(nb, 'org/repo', 'b' * 40, 'https://mybinder.org', ['A'])
+    assert key != ResultCache.key(nb, 'org/repo', SHA, 'https://mybinder.org', [])
+    assert (ResultCache.key(nb, 'org/repo', SHA, 'https://mybinder.org', ['A'],
+                            options={'engine': 'nbconvert'})
+            != ResultCache.key(nb, 'org/repo', SHA, 'https://mybinder.org', ['A'],
+                               options={'engine': 'zygote'}))
+    other = _write_nb(tmp_path / 'b.ipynb', 'print(2)')
+    assert key != ResultCache.key(other, 'org/repo', SHA, 'https://mybinder.org', ['A'])
+
+
+def test_pick_ref():
+    output = (f"{'1' * 40}\trefs/heads/main\n"
+              f"{'2' * 40}\trefs/tags/v1\n"
+              f"{'3' * 40}\trefs/tags/v1^{{}}\n"
+              f"{'4' * 40}\trefs/heads/feature/main\n")
+    assert pick_ref(output, 'main') == '1' * 40
+    assert pick_ref(output, 'v1') == '3' * 40
+    assert pick_ref(output, 'v2') is None
+    assert pick_ref('', 'main') is None
+
+
+def test_put_get_evict(tmp_path):
+    cache = ResultCache(tmp_path / 'cache', max_size=1000, max_age=60)
+    src = tmp_path / 'out.ipynb'
+    src.write_text('x' * 400)
+    cache.put('1' * 64, src)
+    cache.put('2' * 64, src)
+    assert cache.get('1' * 64).read_text() == 'x' * 400
+
+    # '1' was used most recently, so '2' goes first
+    old = time.time() - 30
+    os.utime(cache.get('2' * 64), (old, old))
+    cache.put('3' * 64, src)
+    assert cache.get('2' * 64) is None
+    assert cache.get('1' * 64) is not None
+
+    old = time.time() - 120
+    os.utime(cache._path('3' * 64), (old, old))
+    assert cache.get('3' * 64) is None
+
+
+def test_cli_all_cached_skips_binder(tmp_path):
+    os.chdir(tmp_path)
+    fname = 'example_notebook.ipynb'
+    _write_nb(fname, 'print(1)')
+    cache = ResultCache(tmp_path / 'cache')
+    key = cache.key(open_nb_and_strip_output(fname), 'org/repo', SHA,
+                    'http://binder.invalid', [],
+                    options={'engine': 'nbconvert', 'trim': None})
+    executed = tmp_path / 'executed.ipynb'
+    executed.write_text('{"executed": true}')
+    cache.put(key, executed)
+
+    runner = CliRunner()
+    args = ["--binder-url", "http://binder.invalid", "--repo", "org/repo",
+            "--ref", SHA, "--cache-dir", str(tmp_path / 'cache'), fname]
+    result = runner.invoke(cli.main, args)
+    assert result.exit_code == 0, result.output
+    assert 'not starting binder' in result.output
+    assert (tmp_path / fname).read_text() == '{"executed": true}'
+
+
+def test_prepare_run_returns_at_first_miss(tmp_path, monkeypatch):
+    os.chdir(tmp_path)
+    fnames = ['a.ipynb', 'b.ipynb']
+    for n, fname in enumerate(fnames):
+        _write_nb(fname, f'print({n})')
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        first, second = loop.create_future(), loop.create_future()
+        first.set_result((open_nb_and_strip_output('a.ipynb'), None))
+        monkeypatch.setattr(binderbot, 'prepare_notebooks', lambda filenames, **kwargs:
+                            {'a.ipynb': first, 'b.ipynb': second})
+        queue = asyncio.Queue()
+        lookup, _, sha = await binderbot.prepare_run(
+            fnames, queue, 'org/repo', SHA, 'http://binder.invalid',
+            binderbot.RunOptions(), cache=ResultCache(tmp_path / 'cache'))
+        assert sha == SHA
+        # the binder can be launched while b.ipynb is still being stripped
+        assert not lookup.done()
+        second.set_result((open_nb_and_strip_output('b.ipynb'), None))
+        filenames, cache_keys = await lookup
+        assert filenames == fnames
+        assert sorted(cache_keys) == fnames
+        assert queue.qsize() == 2
+
+    asyncio.run(run())
@@ -0,0 +1,65 @@
+"""Tests for following the build event stream."""
+
+import asyncio
+
+from binderbot import binderbot
+from binderbot.events import EventStreamParser
+from binderbot.testing import MockBinderHub
+
+
+def _feed(parser, text):
+    events = [parser.feed(line) for line in text.splitlines(keepends=True)]
+    return [event for event in events if event is not None]
+
+
+def test_event_stream_parser():
+    parser = EventStreamParser()
+    events = _feed(parser, ':heartbeat\n\n'
+                           'id: 1-0\ndata: {"phase":\ndata: "building"}\n\n'
+                           'retry: 1500\n: another\n\n'
+                           'event: progress\r\ndata:x\r\n\r\n')
+    assert [(e.event, e.data, e.id) for e in events] == [
+        ('message', '{"phase":\n"building"}', '1-0'),
+        ('progress', 'x', '1-0'),
+    ]
+    assert parser.heartbeats == 2
+    assert parser.retry == 1.5
+
+    # a partial event is dropped on reset, the last id is kept
+    assert _feed(parser, 'id: 1-1\ndata: cut') == []
+    parser.reset()
+    assert _feed(parser, '\n') == []
+    assert parser.last_event_id == '1-1'
+
+
+def _start(hub, **kwargs):
+    async def start():
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder(**kwargs)
+            state = jovyan.state
+            await jovyan.shutdown_binder()
+            return state, jovyan.tracer.totals()
+    return asyncio.run(start())
+
+
+def test_reconnect_to_build(tmp_path):
+    with MockBinderHub(tmp_path, drop_build_streams=2) as hub:
+        state, totals = _start(hub, spawn_refresh_time=0.01)
+        assert state == binderbot.BinderUser.States.BINDER_STARTED
+        assert totals['reconnect-wait']['count'] == 2
+        assert hub.builds == 1
+
+
+def test_heartbeats_keep_stream_alive(tmp_path):
+    phases = [('building', 0.5)]
+    with MockBinderHub(tmp_path, phases=phases, heartbeat_interval=0.05) as hub:
+        state, totals = _start(hub, spawn_refresh_time=0.01, stream_timeout=0.2)
+        assert state == binderbot.BinderUser.States.BINDER_STARTED
+        assert 'reconnect-wait' not in totals
+
+    # without heartbeats the silent stream is reconnected, to the same build
+    with MockBinderHub(tmp_path, phases=phases) as hub:
+        state, totals = _start(hub, spawn_refresh_time=0.01, stream_timeout=0.2)
+        assert state == binderbot.BinderUser.States.BINDER_STARTED
+        assert totals['reconnect-wait']['count'] >= 1
+        assert hub.builds == 1
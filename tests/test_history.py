@@ -0,0 +1,68 @@
+"""Tests for the history of binder launches."""
+
+import asyncio
+
+import pytest
+
+from binderbot import binderbot
+from binderbot.history import (BuildHistory, Launch, estimate_remaining,
+                               slow_launch_threshold)
+from binderbot.testing import MockBinderHub
+
+
+def test_build_history(tmp_path):
+    history = BuildHistory(tmp_path / 'history.sqlite', window=3)
+    for n in range(4):
+        history.record('https://binder.example/', 'org/repo', 'master', started_at=n,
+                       duration=10 + n, phases=[('waiting', 0), ('building', 2),
+                                                ('building', 5), ('ready', 10 + n)],
+                       outcome='ready')
+    history.record('https://binder.example', 'org/repo', 'master', started_at=9,
+                   duration=100, phases=[('waiting', 0)], outcome='timeout')
+    history.record('https://binder.example', 'org/other', 'master', started_at=9,
+                   duration=1, phases=[('ready', 1)], outcome='ready')
+
+    launches = history.launches('https://binder.example', 'org/repo', 'master')
+    # the most recent successful ones, within the window
+    assert [launch.duration for launch in launches] == [13, 12, 11]
+    assert launches[0].phases == {'waiting': 0, 'building': 2, 'ready': 13}
+    assert history.suggest_timeout('https://binder.example', 'org/repo', 'master',
+                                   min_launches=3) == 20
+    assert history.suggest_timeout('https://binder.example', 'org/repo', 'master') is None
+
+
+def test_estimates():
+    launches = [Launch(30, {'waiting': 0, 'building': 10}),
+                Launch(40, {'waiting': 0, 'building': 30}),
+                Launch(20, {'waiting': 0})]
+    assert estimate_remaining(launches, 'building', 12) == 10
+    # not seen before, so based on the whole launch
+    assert estimate_remaining(launches, 'pushing', 12) == 18
+    assert estimate_remaining([], 'building', 12) is None
+    assert slow_launch_threshold(launches) is None
+    assert slow_launch_threshold(launches, min_launches=3) == 40
+
+
+def test_launches_recorded(tmp_path, capsys):
+    history = BuildHistory(tmp_path / 'history.sqlite')
+
+    async def launch(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master',
+                                        history=history) as jovyan:
+            await jovyan.start_binder()
+            await jovyan.shutdown_binder()
+
+    with MockBinderHub(tmp_path / 'hub', phases=[('building', 0.1)]) as hub:
+        asyncio.run(launch(hub))
+        assert 'ready in about' not in capsys.readouterr().out
+        asyncio.run(launch(hub))
+        assert '⌛️ Binder building, ready in about 0s' in capsys.readouterr().out
+
+        hub.fail_build = True
+        with pytest.raises(binderbot.OperationError):
+            asyncio.run(launch(hub))
+
+    launches = history.launches(hub.url, 'org/repo', 'master')
+    assert len(launches) == 2
+    assert list(launches[0].phases) == ['building', 'ready']
+    assert launches[0].duration >= 0.1
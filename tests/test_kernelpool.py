@@ -0,0 +1,69 @@
+"""Tests for the pool of warm kernels."""
+
+import asyncio
+
+from binderbot import binderbot
+from binderbot.kernelpool import KernelPool
+from binderbot.testing import MockBinderHub
+
+
+def _running_kernels(hub):
+    return sum(len(server.kernels) for server in hub.servers.values())
+
+
+def test_kernel_pool(tmp_path):
+    async def use_pool(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            assert await jovyan.kernel_memory() > 0
+
+            pool = KernelPool(jovyan, size=2, max_uses=2)
+            pool.start()
+            used = []
+            for n in range(4):
+                async with pool.kernel() as kernel_id:
+                    used.append(kernel_id)
+                    await jovyan.run_code("print(1)", kernel_id=kernel_id)
+            # kernels are reused until they have run two notebooks
+            assert len(set(used)) < len(used)
+            assert all(used.count(k) <= 2 for k in used)
+            assert jovyan.tracer.totals()['kernel-acquire']['count'] == 4
+
+            # a failure always replaces the kernel
+            try:
+                async with pool.kernel() as failed_id:
+                    raise binderbot.OperationError()
+            except binderbot.OperationError:
+                pass
+            async with pool.kernel() as kernel_id:
+                assert kernel_id != failed_id
+
+            await pool.close()
+            # only the default kernel is left
+            assert _running_kernels(hub) == 1
+            await jovyan.teardown()
+
+    with MockBinderHub(tmp_path) as hub:
+        asyncio.run(use_pool(hub))
+
+
+def test_kernel_pool_memory(tmp_path):
+    async def use_pool(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            # every kernel is over the limit, so none is reused
+            pool = KernelPool(jovyan, size=1, max_memory=1)
+            pool.start()
+            used = []
+            for n in range(3):
+                async with pool.kernel() as kernel_id:
+                    used.append(kernel_id)
+            assert len(set(used)) == 3
+            await pool.close()
+            assert _running_kernels(hub) == 1
+            await jovyan.teardown()
+
+    with MockBinderHub(tmp_path) as hub:
+        asyncio.run(use_pool(hub))
@@ -0,0 +1,55 @@
+"""Tests for the load testing mode."""
+
+import asyncio
+import json
+import os
+
+from click.testing import CliRunner
+
+from binderbot import loadtest
+from binderbot.testing import MockBinderHub
+
+
+def test_arrival_times():
+    assert loadtest.arrival_times(3, ramp_up=10) == [0, 5, 10]
+    times = loadtest.arrival_times(100, arrival_rate=10, seed=0)
+    assert times == sorted(times)
+    assert 5 < times[-1] < 20
+
+
+def test_loadtest(tmp_path):
+    os.chdir(tmp_path)
+    with MockBinderHub(tmp_path / 'hub', phases=[('building', 0.05)]) as hub:
+        runner = CliRunner()
+        result = runner.invoke(loadtest.main, [
+            "--binder-url", hub.url, "--repo", "org/repo", "--users", "3",
+            "--ramp-up", "0.2", "--code", "print('hi')", "--output", "results.json"])
+        assert result.exit_code == 0, result.output
+        assert hub.builds == 3
+
+    with open("results.json") as f:
+        summary = json.load(f)['summary']
+    assert summary['users'] == 3
+    for phase in loadtest.PHASES:
+        stats = summary['phases'][phase]
+        assert stats['count'] == 3
+        assert stats['failure_rate'] == 0
+        assert stats['p50'] <= stats['p90'] <= stats['p99']
+    assert sum(b['completed'] for b in summary['throughput']) == 3
+
+
+def test_loadtest_build_failure(tmp_path):
+    with MockBinderHub(tmp_path / 'hub', fail_build=True) as hub:
+        results = asyncio.run(loadtest.run_loadtest(hub.url, 'org/repo', 'master', 2))
+    summary = loadtest.summarize(results)
+    assert summary['phases']['start_binder']['failure_rate'] == 1
+    assert summary['phases']['start_kernel']['count'] == 0
+    assert summary['throughput'][0]['failed'] == 2
+
+
+def test_loadtest_failures_not_retried(tmp_path):
+    with MockBinderHub(tmp_path / 'hub') as hub:
+        hub.fail_next('DELETE', '/api/kernels/', 503)
+        results = asyncio.run(loadtest.run_loadtest(hub.url, 'org/repo', 'master', 1))
+    summary = loadtest.summarize(results)
+    assert summary['phases']['stop_kernel']['failures'] == 1
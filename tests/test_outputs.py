@@ -0,0 +1,50 @@
+"""Tests for trimming notebook outputs."""
+
+import nbformat
+
+from binderbot.outputs import trim_outputs, trim_outputs_source
+
+
+def _notebook():
+    outputs = [
+        nbformat.v4.new_output('stream', name='stdout', text='x' * 1000),
+        nbformat.v4.new_output('display_data', data={'image/png': 'A' * 1000,
+                                                     'text/plain': '<Figure>'},
+                               metadata={'image/png': {'width': 100}}),
+        nbformat.v4.new_output('execute_result', data={'text/html': '<b>hi</b>'},
+                               execution_count=1),
+    ]
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('', outputs=outputs)])
+    nb.metadata['widgets'] = {'application/vnd.jupyter.widget-state+json': {'state': {}}}
+    return nb
+
+
+def test_trim_outputs_max_size():
+    nb = _notebook()
+    removed = trim_outputs(nb, max_output_size=100)
+    stream, image, html = nb.cells[0].outputs
+    assert stream.text.startswith('x' * 100 + '\n[900 characters')
+    assert image.data == {'text/plain': '<Figure>'}
+    assert image.metadata == {}
+    assert html.data == {'text/html': '<b>hi</b>'}
+    assert removed == 1900
+    assert 'widgets' in nb.metadata
+    nbformat.validate(nb)
+
+
+def test_trim_outputs_mime_types_and_widgets():
+    nb = _notebook()
+    trim_outputs(nb, drop_mime_types=['image/*', 'text/html'], strip_widget_state=True)
+    stream, image, html = nb.cells[0].outputs
+    assert stream.text == 'x' * 1000
+    assert image.data == {'text/plain': '<Figure>'}
+    assert html.data == {'text/plain': '[9 characters of text/html removed by binderbot]'}
+    assert 'widgets' not in nb.metadata
+    nbformat.validate(nb)
+
+
+def test_trim_outputs_source_is_standalone():
+    namespace = {}
+    exec(trim_outputs_source(), namespace)
+    nb = _notebook()
+    assert namespace['trim_outputs'](nb, max_output_size=100) == 1900
@@ -0,0 +1,118 @@
+"""Tests for retrying failed operations."""
+
+import asyncio
+
+import aiohttp
+import pytest
+import structlog
+
+from binderbot import binderbot
+from binderbot.retry import RetryPolicy, is_retriable, retry_after
+from binderbot.testing import MockBinderHub
+from binderbot.trace import Tracer
+
+
+def _response_error(status, headers=None):
+    return aiohttp.ClientResponseError(None, (), status=status, headers=headers)
+
+
+def test_is_retriable():
+    assert is_retriable(_response_error(503))
+    assert is_retriable(_response_error(429))
+    assert not is_retriable(_response_error(404))
+    assert is_retriable(aiohttp.ServerDisconnectedError())
+    assert is_retriable(asyncio.TimeoutError())
+    assert not is_retriable(binderbot.OperationError())
+    # a request that isn't idempotent may have been handled already
+    assert not is_retriable(_response_error(500), idempotent=False)
+    assert not is_retriable(asyncio.TimeoutError(), idempotent=False)
+    assert not is_retriable(aiohttp.ServerDisconnectedError(), idempotent=False)
+    assert is_retriable(_response_error(503), idempotent=False)
+    assert is_retriable(_response_error(429), idempotent=False)
+
+
+def test_retry_after():
+    assert retry_after(_response_error(429, {'Retry-After': '7'})) == 7
+    assert retry_after(_response_error(429, {'Retry-After': 'soon'})) is None
+    assert retry_after(_response_error(503)) is None
+    policy = RetryPolicy(base_delay=0, max_delay=5)
+    assert policy.delay(0, _response_error(429, {'Retry-After': '3'})) == 3
+    assert policy.delay(0, _response_error(429, {'Retry-After': '30'})) == 5
+
+
+def test_retry_policy_call():
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise _response_error(502)
+        return 'ok'
+
+    async def fatal():
+        calls.append(1)
+        raise _response_error(403)
+
+    tracer = Tracer()
+    log = structlog.get_logger()
+    policy = RetryPolicy(max_retries=2, base_delay=0.01)
+    assert asyncio.run(policy.call('flaky', flaky, log, tracer)) == 'ok'
+    assert tracer.totals()['retry-wait']['count'] == 2
+
+    calls.clear()
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(policy.replace(max_retries=1).call('flaky', flaky, log, tracer))
+    assert len(calls) == 2
+
+    calls.clear()
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(policy.call('fatal', fatal, log, tracer))
+    assert len(calls) == 1
+
+
+def test_binder_user_retries(tmp_path):
+    policies = {'default': RetryPolicy(base_delay=0.01),
+                'start_binder': RetryPolicy(base_delay=0.01)}
+
+    async def lifecycle(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master',
+                                        retry_policies=policies) as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            await jovyan.run_code('print(1)')
+            await jovyan.put_contents('nb.ipynb', {'cells': [], 'metadata': {},
+                                                   'nbformat': 4, 'nbformat_minor': 4})
+            assert (await jovyan.get_contents('nb.ipynb'))['cells'] == []
+            # not transient, not retried
+            with pytest.raises(binderbot.OperationError):
+                await jovyan.stop_kernel('no-such-kernel')
+            await jovyan.teardown()
+            return jovyan.tracer.totals()['retry-wait']['count']
+
+    with MockBinderHub(tmp_path) as hub:
+        hub.fail_next('GET', '^/build/', 503)
+        hub.fail_next('POST', '/api/kernels$', 429, headers={'Retry-After': '0'})
+        hub.fail_next('GET', '/channels$', 502)
+        hub.fail_next('PUT', '/api/contents/', 500, count=2)
+        hub.fail_next('GET', '/api/contents/', 504)
+        assert asyncio.run(lifecycle(hub)) == 6
+        assert hub.builds == 1
+
+
+def test_post_not_retried_after_server_error(tmp_path):
+    policies = {'default': RetryPolicy(base_delay=0.01)}
+
+    async def start_kernel(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master',
+                                        retry_policies=policies) as jovyan:
+            await jovyan.start_binder()
+            hub.fail_next('POST', '/api/kernels$', 500)
+            with pytest.raises(binderbot.OperationError):
+                await jovyan.start_kernel()
+            # refused before being handled, so it can't start a kernel twice
+            hub.fail_next('POST', '/api/kernels$', 503)
+            await jovyan.start_kernel()
+            await jovyan.teardown()
+
+    with MockBinderHub(tmp_path) as hub:
+        asyncio.run(start_kernel(hub))
@@ -0,0 +1,26 @@
+"""Tests for the binder session store."""
+
+import os
+import stat
+
+from binderbot.sessions import SessionStore
+
+
+def test_put_get_remove(tmp_path):
+    store = SessionStore(tmp_path / 'sessions.json')
+    assert store.get('https://mybinder.org', 'org/repo', 'master') is None
+
+    store.put('https://mybinder.org/', 'org/repo', 'master',
+              'https://hub.mybinder.org/user/abc/', 'secret', sha='a' * 40)
+    store.put('https://mybinder.org', 'org/repo', 'master',
+              'https://hub.mybinder.org/user/def/', 'other', slot=1)
+    saved = store.get('https://mybinder.org', 'org/repo', 'master')
+    assert saved['notebook_url'] == 'https://hub.mybinder.org/user/abc/'
+    assert saved['token'] == 'secret'
+    assert saved['sha'] == 'a' * 40
+    assert store.get('https://mybinder.org', 'org/repo', 'main') is None
+    assert stat.S_IMODE(os.stat(store.path).st_mode) == 0o600
+
+    store.remove('https://mybinder.org', 'org/repo', 'master')
+    assert store.get('https://mybinder.org', 'org/repo', 'master') is None
+    assert store.get('https://mybinder.org', 'org/repo', 'master', slot=1)['token'] == 'other'
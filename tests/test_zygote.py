@@ -0,0 +1,49 @@
+"""Tests for running notebooks in the binder's fork server."""
+
+import asyncio
+
+import nbformat
+import pytest
+
+from binderbot import binderbot
+from binderbot.testing import MockBinderHub
+
+
+def test_zygote(tmp_path):
+    pytest.importorskip('IPython')
+
+    def notebook(*sources):
+        return nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(source)
+                                               for source in sources])
+
+    async def run(hub):
+        async with binderbot.BinderUser(hub.url, 'org/repo', 'master') as jovyan:
+            await jovyan.start_binder()
+            await jovyan.start_kernel()
+            preloaded = await jovyan.start_zygote(['colorsys', 'no_such_module'])
+            assert preloaded['colorsys'] == 'ok'
+            assert 'ModuleNotFoundError' in preloaded['no_such_module']
+            # already running, so not started again
+            assert list(await jovyan.start_zygote(['colorsys'])) == ['colorsys', 'no_such_module']
+
+            await jovyan.put_contents('ok.ipynb', notebook(
+                "import os, sys\nprint('colorsys' in sys.modules, os.environ['MY_VAR'])",
+                "1 + 1"))
+            await jovyan.execute_notebook_zygote('ok.ipynb', env_vars={'MY_VAR': 'x'})
+            cells = (await jovyan.get_contents('ok.ipynb'))['cells']
+            assert ''.join(cells[0]['outputs'][0]['text']) == 'True x\n'
+            assert ''.join(cells[1]['outputs'][0]['data']['text/plain']) == '2'
+
+            await jovyan.put_contents('fail.ipynb', notebook('1 / 0', 'print(1)'))
+            with pytest.raises(binderbot.OperationError):
+                await jovyan.execute_notebook_zygote('fail.ipynb')
+            cells = (await jovyan.get_contents('fail.ipynb'))['cells']
+            assert cells[0]['outputs'][-1]['ename'] == 'ZeroDivisionError'
+            assert cells[1]['outputs'] == []
+
+            await jovyan.teardown()
+            assert not jovyan._zygote
+
+    with MockBinderHub(tmp_path) as hub:
+        asyncio.run(run(hub))
+        assert not list(tmp_path.glob('*/.binderbot-zygote.sock'))